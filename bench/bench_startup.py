@@ -0,0 +1,86 @@
+"""
+Worker cold start benchmark. Each sample runs in a fresh interpreter and measures
+the time to import the app and build it with create_app(config), and the time until
+the first request ('/app-data') is answered.
+The same is measured for a baseline: the app of another commit (by default the first one,
+before the factory), exported with `git archive`, its module-level `main.app` when it has
+no create_app. The factory configs are printed next to it, with the difference.
+usage: python bench/bench_startup.py [-n 10] [--baseline <commit>]
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+SRC = os.path.join(ROOT, 'src')
+
+SAMPLE = '''
+import sys, time, json
+t0 = time.perf_counter()
+import main
+app = main.create_app(%r) if hasattr(main, 'create_app') else main.app
+t1 = time.perf_counter()
+with app.app_context():
+    main.db.create_all()
+app.test_client().get('/app-data')
+t2 = time.perf_counter()
+print(json.dumps({'create_app': t1 - t0, 'first_request': t2 - t0, 'heavy': sorted(m for m in ('numpy', 'PIL') if m in sys.modules)}))
+'''
+
+
+def sample(config, src=SRC):
+    env = dict(os.environ, DB_CONNECTION_STRING='sqlite://')
+    out = subprocess.check_output([sys.executable, '-c', SAMPLE % config], cwd=src, env=env)
+    return json.loads(out.decode().strip().splitlines()[-1])
+
+
+def measure(config, n, src=SRC):
+    samples = [sample(config, src) for _ in range(n)]
+    return {
+        'create_app': statistics.median(s['create_app'] for s in samples) * 1000,
+        'first_request': statistics.median(s['first_request'] for s in samples) * 1000,
+        'heavy': samples[-1]['heavy'],
+    }
+
+
+def export_src(commit):
+    """src/ of `commit` in a temporary directory, removed by the caller"""
+    tmp = tempfile.mkdtemp(prefix='startup-')
+    archive = subprocess.check_output(['git', 'archive', commit, 'src'], cwd=ROOT)
+    subprocess.run(['tar', '-x', '-C', tmp], input=archive, check=True)
+    return tmp
+
+
+def report(name, result, baseline=None):
+    line = '%-10s create_app: %6.1f ms   first request: %6.1f ms' % (name, result['create_app'], result['first_request'])
+    if baseline is not None:
+        line += '   (%+.1f%% / %+.1f%%)' % (
+            (result['create_app'] / baseline['create_app'] - 1) * 100,
+            (result['first_request'] / baseline['first_request'] - 1) * 100
+        )
+    print(line + '   imported: %s' % (', '.join(result['heavy']) or '-'))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', type=int, default=10)
+    parser.add_argument('--baseline', default=None, help='commit to compare with, the first one by default')
+    args = parser.parse_args()
+
+    commit = args.baseline or subprocess.check_output(
+        ['git', 'rev-list', '--max-parents=0', 'HEAD'], cwd=ROOT
+    ).decode().split()[0]
+    tmp = export_src(commit)
+    try:
+        baseline = measure('default', args.n, os.path.join(tmp, 'src'))
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    print('median of %s, baseline %s' % (args.n, commit[:10]))
+    report('baseline', baseline)
+    for config in ('default', 'production'):
+        report(config, measure(config, args.n), baseline)
@@ -0,0 +1,60 @@
+"""
+Micro-benchmark: cost of validating the /registro body with the old ad-hoc
+checks (uncompiled regex, re-parsed on every call) versus REGISTER_SCHEMA.
+usage: python bench/bench_validation.py [-n 200000]
+"""
+import argparse
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from validation import REGISTER_SCHEMA  # noqa: E402
+
+PAYLOADS = [
+    {'email': 'juan.perez@mail.com', 'password': '1234', 'f_name': 'Juan', 'l_name': 'Perez'},
+    {'email': 'no-es-un-email', 'password': '1234', 'f_name': 'Juan', 'l_name': 'Perez'},
+    {'email': 'ana@mail.cl', 'password': '1234', 'f_name': 'Ana'},
+]
+
+
+def legacy_validate(body):
+    # copy of the checks previously inlined in create_new_user()
+    ereg = '^\\w+([\\.-]?\\w+)*@\\w+([\\.-]?\\w+)*(\\.\\w{2,3})+$'
+    email = body.get('email', None)
+    password = body.get('password', None)
+    fname = body.get('f_name', None)
+    lname = body.get('l_name', None)
+    if not (re.search(ereg, email)):
+        return 'Formato del Email inválido'
+    if password is None:
+        return 'No se encuentra Contraseña en request'
+    if fname is None:
+        return 'No se encuentra primer nombre en request'
+    if lname is None:
+        return 'No se encuentra apellido en request'
+    return None
+
+
+def run(fn, number):
+    def loop():
+        for p in PAYLOADS:
+            fn(p)
+    return min(timeit.repeat(loop, number=number, repeat=5)) / (number * len(PAYLOADS))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', type=int, default=200000)
+    args = parser.parse_args()
+
+    for p in PAYLOADS:
+        assert legacy_validate(p) == REGISTER_SCHEMA.validate(p)
+
+    legacy = run(legacy_validate, args.n)
+    schema = run(REGISTER_SCHEMA.validate, args.n)
+    print('legacy ad-hoc : %.3f us/body' % (legacy * 1e6))
+    print('schema        : %.3f us/body' % (schema * 1e6))
+    print('speedup       : %.2fx' % (legacy / schema))
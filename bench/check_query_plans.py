@@ -0,0 +1,127 @@
+"""
+Query plan regression check of the hot endpoints.
+Every SQL statement sent by each endpoint is captured over a seeded SQLite database and run
+through EXPLAIN QUERY PLAN. The check fails (exit status 1) when an endpoint:
+    - scans a table listed in its "no_scan" (the hot lookups must use an index), or
+    - sends more statements than its "max_statements".
+Both budgets are kept per endpoint in bench/query_budgets.json. The data sizes and seed are fixed,
+so statement counts only change when the code does.
+
+usage:
+    python bench/check_query_plans.py            # check, prints the offending statements and plans
+    python bench/check_query_plans.py --update   # save the current statement counts as the budgets
+"""
+import argparse
+import json
+import os
+import re
+import shutil
+import sqlite3
+import sys
+import tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+
+from sqlalchemy import event  # noqa: E402
+from run_bench import build_app, pick_targets, login  # noqa: E402
+from datagen import Sizes, PASSWORD  # noqa: E402
+from models import db, Offer, User  # noqa: E402
+
+BUDGETS = os.path.join(HERE, 'query_budgets.json')
+SIZES = Sizes(regions=5, comunas=40, categories=10, users=300, requests=1200, offers=3600, contracts=150, reviews=200)
+SEED = 42
+# full scans: "SCAN offer", "SCAN TABLE offer" (older SQLite), "SCAN TABLE offer AS o". Not the
+# index scans, "SCAN offer USING COVERING INDEX ..." reads the index alone
+SCAN_RE = re.compile(r'^SCAN (?:TABLE )?(\w+)(?: AS \w+)?$')
+
+
+class StatementRecorder:
+    def __init__(self, engine):
+        self.statements = []
+        event.listen(engine, 'before_cursor_execute', self)
+
+    def __call__(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append((statement, parameters))
+
+
+def scenarios(client, targets, offer_id):
+    provider = login(client, targets['provider_email'])
+    employer = login(client, targets['employer_email'])
+    return [
+        ('POST /login', 'POST', '/login', {'email': targets['provider_email'], 'password': PASSWORD}, None),
+        ('GET /user/get_profile', 'GET', '/user/get_profile', None, provider),
+        ('GET /find/service-request', 'GET', '/find/service-request?comuna=%s' % targets['comuna_id'], None, provider),
+        ('GET /feed/service-requests', 'GET', '/feed/service-requests', None, provider),
+        ('GET /service-request/<id>/offer', 'GET', '/service-request/%s/offer' % targets['request_id'], None, employer),
+        ('GET /offer/<id>', 'GET', '/offer/%s' % offer_id, None, provider),
+        ('GET /my-provider-info', 'GET', '/my-provider-info', None, provider),
+        ('GET /my-employer-info', 'GET', '/my-employer-info', None, employer),
+        ('GET /provider/<id>/reviews', 'GET', '/provider/%s/reviews' % targets['provider_id'], None, employer),
+    ]
+
+
+def scanned_tables(connection, statement, parameters):
+    plan = connection.execute('EXPLAIN QUERY PLAN ' + statement, parameters).fetchall()
+    details = [row[-1] for row in plan]
+    return {m.group(1) for m in map(SCAN_RE.match, details) if m}, details
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--update', action='store_true', help='save the current statement counts as budgets')
+    args = parser.parse_args()
+
+    with open(BUDGETS) as f:
+        budgets = json.load(f)
+
+    tmp = tempfile.mkdtemp(prefix='plans-')
+    path = os.path.join(tmp, 'plans.db')
+    # every request must reach the database
+    app = build_app(path, SIZES, SEED, RESPONSE_CACHE_ENABLED=False)
+    targets = pick_targets(app)
+    with app.app_context():
+        recorder = StatementRecorder(db.engine)
+        targets['provider_id'] = User.query.filter_by(email=targets['provider_email']).first().id
+        offer_id = db.session.query(Offer.id).filter(Offer.provider_id == targets['provider_id']) \
+            .order_by(Offer.id).first()[0]
+    client = app.test_client()
+    explain = sqlite3.connect(path)
+    failures = []
+
+    for name, method, path_, body, headers in scenarios(client, targets, offer_id):
+        recorder.statements = []
+        resp = client.open(path_, method=method, json=body, headers=headers)
+        assert resp.status_code < 400, '%s -> %s' % (name, resp.status_code)
+        budget = budgets['endpoints'].setdefault(name, {'no_scan': []})
+        count = len(recorder.statements)
+        scans = set()
+        for statement, parameters in recorder.statements:
+            tables, plan = scanned_tables(explain, statement, parameters)
+            scans |= tables
+            for table in sorted(tables & set(budget['no_scan'])):
+                failures.append('%s scans %s:\n    %s\n    plan: %s' % (name, table, ' '.join(statement.split()), plan))
+
+        if args.update:
+            budget['max_statements'] = count
+        elif count > budget.get('max_statements', count):
+            failures.append('%s sent %s statements, budget %s' % (name, count, budget['max_statements']))
+        print('%-32s statements %4d / %-4s scans: %s' % (
+            name, count, budget.get('max_statements', '-'), ', '.join(sorted(scans)) or '-'))
+
+    explain.close()
+    shutil.rmtree(tmp, ignore_errors=True)
+    if args.update:
+        with open(BUDGETS, 'w') as f:
+            json.dump(budgets, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print('budgets saved in %s' % BUDGETS)
+    if failures:
+        print('\n%s query plan regressions:' % len(failures))
+        for failure in failures:
+            print('  - ' + failure)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+"""
+Cross-region check of the sharded endpoints (sharding.py).
+Builds a seeded primary with region 1 moved to a shard (`flask shards create` and `move`), then
+a provider of region 2 works on requests of region 1: the one moved from the primary (id below
+SHARD_ID_BLOCK) and one created in the shard (id in its block). Every write must land in the shard
+holding the request, and the primary's rows with other ids must stay untouched. The check fails
+(exit status 1) when a row is written to, or looked up in, the wrong database. SQLite enforces the
+foreign keys here, as Postgres and MySQL would.
+
+usage:
+    python bench/check_shard_routing.py
+"""
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+
+from run_bench import build_app, login  # noqa: E402
+from datagen import Sizes, user_email  # noqa: E402
+from models import db, User, Comuna  # noqa: E402
+
+SIZES = Sizes(regions=3, comunas=12, categories=5, users=40, requests=120, offers=300, contracts=10, reviews=5)
+SEED = 42
+
+
+@event.listens_for(Engine, 'connect')
+def _foreign_keys(connection, record):
+    connection.execute('PRAGMA foreign_keys=ON')
+
+
+def count(path, query, *args):
+    connection = sqlite3.connect(path)
+    try:
+        row = connection.execute(query, args).fetchone()
+        return row[0] if row is not None else None
+    finally:
+        connection.close()
+
+
+def main():
+    tmp = tempfile.mkdtemp(prefix='shards-')
+    primary, shard = os.path.join(tmp, 'primary.db'), os.path.join(tmp, 'region1.db')
+    app = build_app(primary, SIZES, SEED, RESPONSE_CACHE_ENABLED=False, SQLALCHEMY_SHARD_URIS={'1': 'sqlite:///%s' % shard})
+    runner = app.test_cli_runner()
+    for args in (['shards', 'create'], ['shards', 'move', '1']):
+        result = runner.invoke(args=args)
+        assert result.exit_code == 0, result.output
+    block = app.config['SHARD_ID_BLOCK']
+
+    with app.app_context():
+        region1 = [comuna_id for comuna_id, in db.session.query(Comuna.id).filter(Comuna.region_id == 1)]
+        region2 = [comuna_id for comuna_id, in db.session.query(Comuna.id).filter(Comuna.region_id == 2)]
+        employer_id = db.session.query(User.id).filter(User.comuna_id.in_(region1)).order_by(User.id).first()[0]
+        provider_id = db.session.query(User.id).filter(User.comuna_id.in_(region2)).order_by(User.id).first()[0]
+        comuna_name = Comuna.query.get(region1[0]).name
+    client = app.test_client()
+    employer, provider = login(client, user_email(employer_id)), login(client, user_email(provider_id))
+    failures = []
+
+    def expect(name, resp, status):
+        if resp.status_code != status:
+            failures.append('%s: %s, expected %s: %s' % (name, resp.status_code, status, resp.get_data(as_text=True)[:200]))
+        return resp.get_json() or {}
+
+    moved = count(shard, "SELECT MIN(id) FROM request WHERE service_status = 'active' AND employer_id != ? AND id NOT IN "
+                         "(SELECT request_id FROM offer WHERE provider_id = ?)", provider_id, provider_id)
+    expect('create request in region 1', client.post('/service-request/create', headers=employer, json={
+        'name': 'cross region', 'description': 'check', 'street': 's', 'home_number': '1', 'comuna': comuna_name, 'category': 1
+    }), 200)
+    created = count(shard, 'SELECT MAX(id) FROM request')
+    if created < block:
+        failures.append('request created in the shard with id %s, below its block %s' % (created, block))
+
+    offer_id = None
+    primary_offers = count(primary, 'SELECT COUNT(*) FROM offer')
+    for label, request_id in (('moved request %s' % moved, moved), ('shard request %s' % created, created)):
+        found = expect('find %s' % label, client.get('/find/service-request?comuna=%s&cat1=1' % region1[0], headers=provider), 200)
+        if request_id == created and request_id not in [service['id'] for service in found.get('services', [])]:
+            failures.append('find: %s not listed' % label)
+        expect('offer on %s' % label, client.post('/service-request/%s/offer' % request_id, headers=provider, json={'description': 'x'}), 201)
+        offer_id = count(shard, 'SELECT MAX(id) FROM offer WHERE request_id = ? AND provider_id = ?', request_id, provider_id)
+        if offer_id is None:
+            failures.append('offer on %s: not in the shard' % label)
+            continue
+        expect('get offer of %s' % label, client.get('/offer/%s' % offer_id, headers=provider), 200)
+    expect('offers of the shard request', client.get('/service-request/%s/offer' % created, headers=employer), 200)
+    if count(primary, 'SELECT COUNT(*) FROM offer') != primary_offers:
+        failures.append('offers written to the primary: %s -> %s' % (primary_offers, count(primary, 'SELECT COUNT(*) FROM offer')))
+
+    expect('accept offer', client.post('/offer/%s/accept' % offer_id, headers=employer), 200)
+    if count(shard, 'SELECT status FROM offer WHERE id = ?', offer_id) != 'accepted':
+        failures.append('accept: offer %s not accepted in the shard' % offer_id)
+    contract = expect('create contract', client.post('/contract/create', headers=employer, json={
+        'provider': provider_id, 'service': created
+    }), 200).get('contract', {})
+    if count(shard, 'SELECT COUNT(*) FROM contract WHERE service_id = ?', created) != 1:
+        failures.append('contract of request %s not in the shard' % created)
+    expect('review by the provider', client.post('/review', headers=provider, json={
+        'contract': contract.get('id'), 'score': 5
+    }), 201)
+    listed = expect('provider activity', client.get('/my-provider-info', headers=provider), 200).get('provider', {})
+    if offer_id not in [offer['id'] for offer in listed.get('offers', [])]:
+        failures.append('/my-provider-info: offer %s of region 1 not listed' % offer_id)
+    if contract.get('id') not in [item['id'] for item in listed.get('contracts', [])]:
+        failures.append('/my-provider-info: contract %s of region 1 not listed' % contract.get('id'))
+    if count(primary, 'SELECT COUNT(*) FROM review WHERE contract_id = ?', contract.get('id')) != 1:
+        failures.append('review of contract %s not in the primary' % contract.get('id'))
+    expect('close request', client.put('/service-request/%s/status' % moved, headers=employer, json={'status': 'closed'}), 401)
+
+    app.extensions['audit_log'].flush() # before its database is removed
+    shutil.rmtree(tmp, ignore_errors=True)
+    print('moved request %s, shard request %s, offer %s, contract %s' % (moved, created, offer_id, contract.get('id')))
+    if failures:
+        print('\n%s cross-region failures:' % len(failures))
+        for failure in failures:
+            print('  - ' + failure)
+        sys.exit(1)
+    print('ok')
+
+
+if __name__ == '__main__':
+    main()
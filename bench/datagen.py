@@ -0,0 +1,158 @@
+"""
+Deterministic synthetic marketplace data generator.
+Fills the database of an app with regions, comunas, categories, users (each one with
+its provider and employer rows), service requests, offers, contracts and reviews.
+The same sizes and seed always produce the same rows, so benchmark runs are comparable.
+
+usage (from python):
+    from datagen import Sizes, generate
+    with app.app_context():
+        generate(db, Sizes(users=500, requests=2000), seed=42)
+"""
+import random
+from datetime import datetime, timedelta
+
+from models import (
+    User, Employer, Provider, Category, Contract, Request, Offer, Review,
+    Region, Comuna, provider_category
+)
+from reviews import rebuild_review_summaries
+
+BASE_DATE = datetime(2020, 1, 1)
+PASSWORD = 'bench-password'
+BATCH = 1000
+
+
+class Sizes:
+    def __init__(self, regions=16, comunas=200, categories=20, users=500, requests=2000,
+                 offers=6000, contracts=500, reviews=800):
+        self.regions = regions
+        self.comunas = comunas
+        self.categories = categories
+        self.users = users
+        self.requests = requests
+        self.offers = offers
+        self.contracts = contracts
+        self.reviews = reviews
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
+
+def user_email(user_id):
+    return 'user%s@bench.cl' % user_id
+
+
+def _insert(db, table, rows):
+    for i in range(0, len(rows), BATCH):
+        db.session.execute(table.insert(), rows[i:i + BATCH])
+
+
+def generate(db, sizes=None, seed=42):
+    """inserts the rows with bulk (executemany) inserts and commits, returns sizes"""
+    sizes = sizes or Sizes()
+    rnd = random.Random(seed)
+
+    regions = [{'id': i, 'name': 'Region %s' % i} for i in range(1, sizes.regions + 1)]
+    comunas = [
+        {'id': i, 'name': 'Comuna %s' % i, 'region_id': rnd.randint(1, sizes.regions)}
+        for i in range(1, sizes.comunas + 1)
+    ]
+    categories = [
+        {'id': i, 'name': 'Categoria %s' % i, 'logo': 'fa-bench-%s' % i}
+        for i in range(1, sizes.categories + 1)
+    ]
+
+    users, providers, employers, provider_categories = [], [], [], []
+    for i in range(1, sizes.users + 1):
+        users.append({
+            'id': i,
+            'role': 'client',
+            'email': user_email(i),
+            'password': PASSWORD,
+            'register_date': BASE_DATE + timedelta(minutes=i),
+            'fname': 'Nombre%s' % i,
+            'lname': 'Apellido%s' % i,
+            'street': 'Calle %s' % rnd.randint(1, 500),
+            'home_number': str(rnd.randint(1, 9999)),
+            'comuna_id': rnd.randint(1, sizes.comunas),
+        })
+        providers.append({'id': i, 'score': 0})
+        employers.append({'id': i, 'score': 0})
+        for cat in rnd.sample(range(1, sizes.categories + 1), min(3, sizes.categories)):
+            provider_categories.append({'provider_id': i, 'category_id': cat})
+
+    requests = []
+    for i in range(1, sizes.requests + 1):
+        requests.append({
+            'id': i,
+            'name': 'Solicitud %s' % i,
+            'description': 'Descripcion de la solicitud %s' % i,
+            'street': 'Calle %s' % rnd.randint(1, 500),
+            'home_number': str(rnd.randint(1, 9999)),
+            'creation_date': BASE_DATE + timedelta(minutes=10 * i),
+            'service_status': 'active',
+            'employer_id': rnd.randint(1, sizes.users),
+            'category_id': rnd.randint(1, sizes.categories),
+            'comuna_id': rnd.randint(1, sizes.comunas),
+        })
+
+    offers, offered = [], set()
+    while len(offers) < sizes.offers and sizes.users > 1 and len(offered) < sizes.requests * (sizes.users - 1):
+        req = requests[rnd.randint(0, sizes.requests - 1)]
+        provider_id = rnd.randint(1, sizes.users)
+        if provider_id == req['employer_id'] or (provider_id, req['id']) in offered:
+            continue
+        offered.add((provider_id, req['id']))
+        offers.append({
+            'id': len(offers) + 1,
+            'offer_date': req['creation_date'] + timedelta(minutes=rnd.randint(1, 600)),
+            'description': 'Oferta %s' % (len(offers) + 1),
+            'status': 'active',
+            'provider_id': provider_id,
+            'request_id': req['id'],
+        })
+
+    contracts, contracted = [], set()
+    for offer in rnd.sample(offers, min(len(offers), sizes.contracts * 2)):
+        if len(contracts) == sizes.contracts:
+            break
+        if offer['request_id'] in contracted:
+            continue
+        contracted.add(offer['request_id'])
+        contracts.append({
+            'id': len(contracts) + 1,
+            'contract_status': 'active',
+            'contract_start_date': offer['offer_date'] + timedelta(days=1),
+            'employer_id': requests[offer['request_id'] - 1]['employer_id'],
+            'provider_id': offer['provider_id'],
+            'service_id': offer['request_id'],
+        })
+
+    reviews = []
+    # each side of a contract reviews the other at most once
+    sides = rnd.sample(range(len(contracts) * 2), min(sizes.reviews, len(contracts) * 2))
+    for i, side in enumerate(sides, 1):
+        contract = contracts[side // 2]
+        by_employer = side % 2 == 0 # employer reviews the provider or the other way around
+        reviews.append({
+            'id': i,
+            'contract_id': contract['id'],
+            'score': rnd.randint(1, 5),
+            'body': 'Comentario %s' % i,
+            'review_date': contract['contract_start_date'] + timedelta(days=2),
+            'review_author': contract['employer_id'] if by_employer else contract['provider_id'],
+            'provider_id': contract['provider_id'] if by_employer else None,
+            'employer_id': None if by_employer else contract['employer_id'],
+        })
+
+    for model, rows in (
+        (Region, regions), (Comuna, comunas), (Category, categories), (User, users),
+        (Provider, providers), (Employer, employers), (Request, requests), (Offer, offers),
+        (Contract, contracts), (Review, reviews)
+    ):
+        _insert(db, model.__table__, rows)
+    _insert(db, provider_category, provider_categories)
+    db.session.commit()
+    rebuild_review_summaries()
+    return sizes
@@ -0,0 +1,190 @@
+"""
+Load-test of the hot endpoints against a seeded SQLite database.
+For every endpoint it reports p50/p95/p99 latency, SQL statements per request and
+response bytes, and saves the results as JSON so runs of different builds can be compared.
+The response cache (cache.py) is off, so the numbers are the ones of a miss. --response-cache
+turns it on to measure the hits.
+
+usage:
+    python bench/run_bench.py                        # default sizes, saves bench/results/<timestamp>.json
+    python bench/run_bench.py --users 2000 --requests 10000 -n 200
+    python bench/run_bench.py --compare bench/results/<previous>.json
+    python bench/run_bench.py --response-cache
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'src'))
+sys.path.insert(0, HERE)
+
+from sqlalchemy import event, func  # noqa: E402
+from main import create_app  # noqa: E402
+from models import db, Request, Offer  # noqa: E402
+from datagen import Sizes, generate, user_email, PASSWORD  # noqa: E402
+
+
+def percentile(values, pct):
+    """nearest-rank percentile of an already sorted list"""
+    if not values:
+        return None
+    rank = max(int(round(pct / 100.0 * len(values) + 0.5)) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+class StatementCounter:
+    def __init__(self, engine):
+        self.count = 0
+        event.listen(engine, 'before_cursor_execute', self)
+
+    def __call__(self, *args, **kwargs):
+        self.count += 1
+
+
+def build_app(path, sizes, seed, **config):
+    app = create_app(dict({
+        'SQLALCHEMY_DATABASE_URI': 'sqlite:///%s' % path,
+        'ENABLE_MIGRATIONS': False,
+        'RATELIMIT_ENABLED': False, # the benchmark hammers the same endpoints from a single client
+    }, **config))
+    with app.app_context():
+        db.create_all()
+        generate(db, sizes, seed=seed)
+    return app
+
+
+def pick_targets(app):
+    """chooses the users and ids used by the scenarios, the busiest ones so the numbers are pessimistic"""
+    with app.app_context():
+        request_id, employer_id = db.session.query(Request.id, Request.employer_id) \
+            .join(Offer, Offer.request_id == Request.id) \
+            .group_by(Request.id, Request.employer_id) \
+            .order_by(func.count(Offer.id).desc(), Request.id).first()
+        provider_id = db.session.query(Offer.provider_id) \
+            .group_by(Offer.provider_id) \
+            .order_by(func.count(Offer.id).desc(), Offer.provider_id).first()[0]
+        comuna_id = db.session.query(Request.comuna_id) \
+            .group_by(Request.comuna_id) \
+            .order_by(func.count(Request.id).desc(), Request.comuna_id).first()[0]
+    return {
+        'request_id': request_id,
+        'employer_email': user_email(employer_id),
+        'provider_email': user_email(provider_id),
+        'comuna_id': comuna_id,
+    }
+
+
+def login(client, email):
+    resp = client.post('/login', json={'email': email, 'password': PASSWORD})
+    assert resp.status_code == 200, resp.get_data(as_text=True)
+    return {'Authorization': 'Bearer %s' % resp.get_json()['access_token']}
+
+
+def scenarios(client, targets):
+    provider = login(client, targets['provider_email'])
+    employer = login(client, targets['employer_email'])
+    return [
+        ('GET /', 'GET', '/', None, None),
+        ('GET /app-data', 'GET', '/app-data', None, None),
+        ('POST /login', 'POST', '/login', {'email': targets['provider_email'], 'password': PASSWORD}, None),
+        ('GET /find/service-request', 'GET', '/find/service-request?comuna=%s' % targets['comuna_id'], None, provider),
+        ('GET /service-request/<id>/offer', 'GET', '/service-request/%s/offer' % targets['request_id'], None, employer),
+        ('GET /my-provider-info', 'GET', '/my-provider-info', None, provider),
+    ]
+
+
+def run_scenario(client, counter, method, path, body, headers, iterations, warmup):
+    latencies, statements, sizes = [], [], []
+    for i in range(warmup + iterations):
+        counter.count = 0
+        start = time.perf_counter()
+        resp = client.open(path, method=method, json=body, headers=headers)
+        elapsed = time.perf_counter() - start
+        assert resp.status_code < 400, '%s %s -> %s' % (method, path, resp.status_code)
+        if i >= warmup:
+            latencies.append(elapsed * 1000)
+            statements.append(counter.count)
+            sizes.append(len(resp.get_data()))
+    latencies.sort()
+    return {
+        'iterations': iterations,
+        'p50_ms': percentile(latencies, 50),
+        'p95_ms': percentile(latencies, 95),
+        'p99_ms': percentile(latencies, 99),
+        'sql_per_request': max(statements),
+        'response_bytes': max(sizes),
+    }
+
+
+def compare(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = json.load(f)['endpoints']
+    print('\ncompared with %s' % baseline_path)
+    for name, current in results.items():
+        before = baseline.get(name)
+        if before is None:
+            continue
+        print('%-32s p50 %+7.1f%%   sql %+d   bytes %+d' % (
+            name,
+            (current['p50_ms'] / before['p50_ms'] - 1) * 100 if before['p50_ms'] else 0,
+            current['sql_per_request'] - before['sql_per_request'],
+            current['response_bytes'] - before['response_bytes'],
+        ))
+
+
+def main():
+    defaults = Sizes()
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    for name, value in defaults.to_dict().items():
+        parser.add_argument('--%s' % name, type=int, default=value)
+    parser.add_argument('-n', '--iterations', type=int, default=100)
+    parser.add_argument('--warmup', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help='results file, default bench/results/<timestamp>.json')
+    parser.add_argument('--compare', help='previous results file to diff against')
+    parser.add_argument('--response-cache', action='store_true', help='measure with the response cache on')
+    args = parser.parse_args()
+
+    sizes = Sizes(**{name: getattr(args, name) for name in defaults.to_dict()})
+    tmp = tempfile.mkdtemp(prefix='bench-')
+    app = build_app(os.path.join(tmp, 'bench.db'), sizes, args.seed, RESPONSE_CACHE_ENABLED=args.response_cache)
+    targets = pick_targets(app)
+
+    # requests must not run inside an outer app context, it would keep one session
+    # (and its identity map) alive across requests and hide the real SQL count
+    with app.app_context():
+        counter = StatementCounter(db.engine)
+    client = app.test_client()
+    results = {}
+    for name, method, path, body, headers in scenarios(client, targets):
+        results[name] = run_scenario(client, counter, method, path, body, headers, args.iterations, args.warmup)
+        r = results[name]
+        print('%-32s p50 %7.2f ms  p95 %7.2f ms  p99 %7.2f ms  sql %4d  bytes %8d' % (
+            name, r['p50_ms'], r['p95_ms'], r['p99_ms'], r['sql_per_request'], r['response_bytes']))
+
+    output = args.output or os.path.join(HERE, 'results', '%s.json' % datetime.now().strftime('%Y%m%d-%H%M%S'))
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump({
+            'date': datetime.now().isoformat(),
+            'sizes': sizes.to_dict(),
+            'seed': args.seed,
+            'response_cache': args.response_cache,
+            'targets': targets,
+            'endpoints': results,
+        }, f, indent=2, sort_keys=True)
+    print('results saved in %s' % output)
+    shutil.rmtree(tmp, ignore_errors=True)
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,26 @@
+# gunicorn settings, read from the repo root before --chdir is applied.
+# The app is imported once in the master (preload) and the workers are forked from it,
+# so each worker starts serving without paying the import cost again.
+import os
+
+preload_app = True
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+
+
+def post_fork(server, worker):
+    # connections opened by the master before forking can't be shared between workers
+    from main import dispose_engines
+    from wsgi import application
+    dispose_engines(application)
+
+
+def worker_exit(server, worker):
+    # buffered audit events are written (or spooled) before the worker goes away
+    from audit import close_audit_log
+    from wsgi import application
+    close_audit_log(application)
+
+
+def worker_abort(server, worker):
+    # SIGABRT after a worker timeout, the process exits right after this hook
+    worker_exit(server, worker)
@@ -0,0 +1,88 @@
+"""
+Archival of closed and expired service requests.
+Rows are moved in batches from `request`/`offer` to `request_archive`/`offer_archive`
+with INSERT ... SELECT + DELETE statements, one transaction per batch, so the
+tables scanned by /find/service-request only keep the live requests.
+Requests with a contract are never moved, the contract still references them.
+
+run it from the CLI (ej: daily with heroku scheduler):
+    $ flask archive-requests [--batch-size 500] [--closed-days 7] [--expire-days 90]
+"""
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import and_, or_, select, exists
+
+from models import db, Request, Offer, Contract, RequestArchive, OfferArchive
+from sharding import for_each_database
+
+REQUEST_COLUMNS = (
+    'id', 'name', 'description', 'street', 'home_number', 'more_info', 'creation_date',
+    'closed_date', 'service_status', 'employer_id', 'category_id', 'comuna_id'
+)
+OFFER_COLUMNS = ('id', 'offer_date', 'description', 'status', 'provider_id', 'request_id')
+
+
+def _archivable_ids(closed_before, created_before, batch_size):
+    request_t = Request.__table__
+    query = select([request_t.c.id]).where(
+        and_(
+            or_(
+                and_(request_t.c.service_status == 'closed', request_t.c.closed_date < closed_before),
+                and_(request_t.c.service_status != 'closed', request_t.c.creation_date < created_before)
+            ),
+            ~exists().where(Contract.__table__.c.service_id == request_t.c.id)
+        )
+    ).order_by(request_t.c.id).limit(batch_size)
+    return [row[0] for row in db.session.execute(query)]
+
+
+def _move(source, target, columns, condition, now):
+    source_cols = [source.c[name] for name in columns]
+    db.session.execute(target.insert().from_select(
+        list(columns) + ['archived_date'],
+        select(source_cols + [db.literal(now).label('archived_date')]).where(condition)
+    ))
+    db.session.execute(source.delete().where(condition))
+
+
+def archive_requests(batch_size=500, closed_days=7, expire_days=90):
+    """
+    moves requests closed more than `closed_days` ago, and requests still open after
+    `expire_days`, together with their offers. Returns the number of archived requests.
+    """
+    now = datetime.now()
+    closed_before = now - timedelta(days=closed_days)
+    created_before = now - timedelta(days=expire_days)
+    request_t, offer_t = Request.__table__, Offer.__table__
+    total = 0
+
+    while True:
+        ids = _archivable_ids(closed_before, created_before, batch_size)
+        if not ids:
+            break
+        # offers first, they reference the requests
+        _move(offer_t, OfferArchive.__table__, OFFER_COLUMNS, offer_t.c.request_id.in_(ids), now)
+        _move(request_t, RequestArchive.__table__, REQUEST_COLUMNS, request_t.c.id.in_(ids), now)
+        db.session.commit()
+        total += len(ids)
+
+    return total
+
+
+@click.command('archive-requests')
+@click.option('--batch-size', type=int, default=None, help='requests moved per transaction')
+@click.option('--closed-days', type=int, default=None, help='archive requests closed more than N days ago')
+@click.option('--expire-days', type=int, default=None, help='archive open requests created more than N days ago')
+@with_appcontext
+def archive_command(batch_size, closed_days, expire_days):
+    """Move closed and expired service requests to the archive tables."""
+    config = current_app.config
+    total = sum(for_each_database(lambda: archive_requests( # the primary and each region shard
+        batch_size=batch_size or config['ARCHIVE_BATCH_SIZE'],
+        closed_days=closed_days if closed_days is not None else config['ARCHIVE_CLOSED_AFTER_DAYS'],
+        expire_days=expire_days if expire_days is not None else config['REQUEST_EXPIRATION_DAYS']
+    )))
+    click.echo('%s service requests archived' % total)
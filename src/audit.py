@@ -0,0 +1,247 @@
+"""
+Audit log of the changes made through the api (admin edits, contracts, offers...).
+
+    audit('offer.accept', offer_q, price=...)
+    db.session.commit()
+
+audit() only takes note of the event in the session, it's kept when the transaction commits and
+forgotten if it's rolled back. Committed events wait in a buffer of the worker and a thread writes
+them to models.AuditEvent with one multi-row INSERT per AUDIT_BATCH_SIZE events, every
+AUDIT_FLUSH_SECONDS or as soon as a batch is full. Endpoints never wait for the audit INSERTs,
+an event shows up in /admin/audit a few seconds after its change.
+
+While the database is down the events stay in the buffer (at most AUDIT_MAX_BUFFER, the oldest
+are dropped). On exit (atexit, gunicorn worker_exit/worker_abort) the buffer is flushed, and what
+can't be written is saved to AUDIT_SPOOL_DIR, written by the next worker to start.
+"""
+import atexit
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+
+from flask import current_app, g, has_request_context
+from flask_jwt_extended.config import config as jwt_config
+from sqlalchemy import and_, event, inspect, or_
+
+from models import db, AuditEvent
+from routing import RoutingSession
+
+logger = logging.getLogger(__name__)
+
+
+class AuditLog:
+    def __init__(self, app):
+        config = app.config
+        self.app = app
+        self.batch_size = config['AUDIT_BATCH_SIZE']
+        self.interval = config['AUDIT_FLUSH_SECONDS']
+        self.max_buffer = config['AUDIT_MAX_BUFFER']
+        self.spool_dir = config['AUDIT_SPOOL_DIR']
+        self.counters = dict.fromkeys(('written', 'dropped', 'spooled', 'failed_flushes'), 0)
+        self._events = []
+        self._pid = None
+        self._stopping = False
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock() # one flush at a time, keeps the events in order
+        self._wakeup = threading.Event()
+
+    def ensure_started(self):
+        """starts the flush thread once per process, a forked worker starts its own"""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._events = [] # inherited from the master, it flushes them itself
+                threading.Thread(target=self._run, name='audit-flush', daemon=True).start()
+                atexit.register(self.close)
+
+    def add(self, events):
+        self.ensure_started()
+        with self._lock:
+            self._events.extend(events)
+            overflow = len(self._events) - self.max_buffer
+            if overflow > 0:
+                del self._events[:overflow]
+                self.counters['dropped'] += overflow
+            full = len(self._events) >= self.batch_size
+        if full:
+            self._wakeup.set()
+
+    def _run(self):
+        self._replay_spool()
+        while not self._stopping:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        """writes the buffered events, the ones that fail go back to the buffer. Returns the number written"""
+        with self._flush_lock:
+            with self._lock:
+                events, self._events = self._events, []
+            written = 0
+            try:
+                written = self._insert(events)
+            except Exception:
+                self.counters['failed_flushes'] += 1
+                logger.exception('audit log flush failed, %s events kept', len(events) - written)
+            finally:
+                if written < len(events):
+                    with self._lock:
+                        self._events[:0] = events[written:]
+            return written
+
+    def _insert(self, events):
+        """multi-row INSERTs of AUDIT_BATCH_SIZE events, one transaction each. Returns the events written"""
+        written = 0
+        engine = db.get_engine(self.app)
+        table = AuditEvent.__table__
+        while written < len(events):
+            batch = events[written:written + self.batch_size]
+            with engine.begin() as connection:
+                connection.execute(table.insert().values(batch))
+            written += len(batch)
+            with self._lock:
+                self.counters['written'] += len(batch)
+        return written
+
+    def close(self):
+        """flushes the buffer on exit, what can't be written is spooled to a file"""
+        if self._pid != os.getpid():
+            return
+        self._stopping = True
+        self._wakeup.set()
+        self.flush()
+        with self._lock:
+            events, self._events = self._events, []
+        if events:
+            self._spool(events)
+
+    def _spool(self, events):
+        os.makedirs(self.spool_dir, exist_ok=True)
+        path = os.path.join(self.spool_dir, 'audit-%s-%s.jsonl' % (os.getpid(), int(time.time() * 1000)))
+        with open(path + '.part', 'w') as f:
+            for item in events:
+                f.write(json.dumps(dict(item, created_date=item['created_date'].isoformat(timespec='microseconds'))))
+                f.write('\n')
+        os.replace(path + '.part', path)
+        self.counters['spooled'] += len(events)
+        logger.warning('audit log: %s events saved to %s', len(events), path)
+
+    def _replay_spool(self):
+        """writes the events spooled by workers that exited with the database down"""
+        for path in sorted(glob.glob(os.path.join(self.spool_dir, 'audit-*.jsonl'))):
+            claimed = '%s.%s' % (path, os.getpid())
+            try:
+                os.rename(path, claimed) # only one worker takes each file
+            except OSError:
+                continue
+            with open(claimed) as f:
+                events = [json.loads(line) for line in f if line.strip()]
+            for item in events:
+                item['created_date'] = datetime.strptime(item['created_date'], '%Y-%m-%dT%H:%M:%S.%f')
+            try:
+                self._insert(events)
+                os.remove(claimed)
+            except Exception:
+                os.rename(claimed, path) # next start tries again
+                logger.exception('audit log: replay of %s failed', path)
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, buffered=len(self._events))
+
+
+def init_audit(app):
+    if app.config['AUDIT_ENABLED']:
+        log = AuditLog(app)
+        app.extensions['audit_log'] = log
+        app.before_request(log.ensure_started)
+
+
+def audit_log():
+    return current_app.extensions.get('audit_log')
+
+
+def close_audit_log(app):
+    """for the gunicorn worker_exit hook"""
+    log = app.extensions.get('audit_log')
+    if log is not None:
+        log.close()
+
+
+def _actor_id():
+    if has_request_context() and 'jwt_claims' in g: # see auth.py
+        return g.jwt_claims.get(jwt_config.user_claims_key, {}).get('id')
+    return None
+
+
+def audit(action, instance, **data):
+    """
+    logs `action` on `instance` (a model object) when the current transaction commits,
+    `data` is saved as a json object.
+    """
+    session = db.session()
+    if 'audit_log' not in session.app.extensions:
+        return
+    session.info.setdefault('pending_audit', []).append((action, instance, _actor_id(), data))
+
+
+def _on_commit(session):
+    if session.transaction.nested: # a savepoint released, the transaction is still open
+        return
+    pending = session.info.pop('pending_audit', None)
+    if not pending:
+        return
+    now = datetime.now()
+    events = []
+    for action, instance, actor_id, data in pending:
+        identity = inspect(instance).identity # read from the identity map, expired objects aren't reloaded
+        events.append({
+            'created_date': now,
+            'action': action,
+            'entity_type': instance.__tablename__,
+            'entity_id': identity[0] if identity else None,
+            'actor_id': actor_id,
+            'data': json.dumps(data, default=str) if data else None,
+        })
+    session.app.extensions['audit_log'].add(events)
+
+
+def _on_rollback(session, previous_transaction):
+    if previous_transaction.parent is None:
+        session.info.pop('pending_audit', None)
+
+
+event.listen(RoutingSession, 'after_commit', _on_commit)
+event.listen(RoutingSession, 'after_soft_rollback', _on_rollback)
+
+
+def query_events(entity_type=None, entity_id=None, actor_id=None, since=None, until=None, before=None, limit=100):
+    """
+    events newest first, in [since, until). `before` is the (created_date, id) of the last event
+    of the previous page. Served by ix_audit_event_entity with an entity, ix_audit_event_created_date otherwise.
+    """
+    query = AuditEvent.query
+    if entity_type is not None:
+        query = query.filter(AuditEvent.entity_type == entity_type)
+        if entity_id is not None:
+            query = query.filter(AuditEvent.entity_id == entity_id)
+    if actor_id is not None:
+        query = query.filter(AuditEvent.actor_id == actor_id)
+    if since is not None:
+        query = query.filter(AuditEvent.created_date >= since)
+    if until is not None:
+        query = query.filter(AuditEvent.created_date < until)
+    if before is not None:
+        date, event_id = before
+        query = query.filter(or_(
+            AuditEvent.created_date < date,
+            and_(AuditEvent.created_date == date, AuditEvent.id < event_id)
+        ))
+    return query.order_by(AuditEvent.created_date.desc(), AuditEvent.id.desc()).limit(limit).all()
@@ -0,0 +1,130 @@
+"""
+JWT verification fast path.
+The access token is decoded once per request and its claims stored on flask.g. Verified
+tokens are also kept in a bounded LRU (per app, keyed by the token signature), so the
+tokens of active users skip the base64/JSON decoding and the HMAC check on later requests.
+Entries are dropped as soon as the token expires, and the revocation check (if enabled)
+still runs on every request.
+
+`jwt_required` and `jwt_admin_required` replace the flask_jwt_extended decorators, after
+them get_jwt_identity() and get_jwt_claims() work as usual.
+"""
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from re import split
+
+from flask import current_app, g, jsonify, request
+try:
+    from flask import _app_ctx_stack as ctx_stack
+except ImportError: # pragma: no cover
+    from flask import _request_ctx_stack as ctx_stack
+from flask_jwt_extended import verify_jwt_in_request as verify_jwt_in_request_slow
+from flask_jwt_extended.config import config
+from flask_jwt_extended.exceptions import InvalidHeaderError, NoAuthorizationError
+from flask_jwt_extended.utils import (
+    decode_token, get_unverified_jwt_headers, verify_token_claims, verify_token_not_blacklisted,
+    verify_token_type
+)
+
+
+class TokenCache:
+    """LRU of verified tokens: signature -> (token, claims, header), bounded to `size` entries"""
+    def __init__(self, size=4096):
+        self.size = size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, token, now):
+        signature = token.rpartition('.')[2]
+        with self._lock:
+            entry = self._entries.get(signature)
+            if entry is None or entry[0] != token:
+                return None
+            expires = entry[1].get('exp')
+            if expires is not None and expires + config.leeway <= now: # expired, decode_token raises the proper error
+                del self._entries[signature]
+                return None
+            self._entries.move_to_end(signature)
+            return entry[1], entry[2]
+
+    def put(self, token, claims, header):
+        signature = token.rpartition('.')[2]
+        with self._lock:
+            self._entries[signature] = (token, claims, header)
+            self._entries.move_to_end(signature)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+
+def init_auth(app):
+    app.extensions['jwt_cache'] = TokenCache(app.config['JWT_CACHE_SIZE'])
+
+
+def _token_from_headers():
+    # same rules as flask_jwt_extended: <HeaderName>: <HeaderType> <JWT>
+    header_name, header_type = config.header_name, config.header_type
+    auth_header = request.headers.get(header_name, None)
+    if not auth_header:
+        raise NoAuthorizationError("Missing {} Header".format(header_name))
+    if not header_type:
+        parts = auth_header.split()
+        if len(parts) != 1:
+            raise InvalidHeaderError("Bad {} header. Expected value '<JWT>'".format(header_name))
+        return parts[0]
+    for field in split(r',\s*', auth_header):
+        parts = field.split()
+        if parts and parts[0] == header_type:
+            if len(parts) != 2:
+                break
+            return parts[1]
+    raise InvalidHeaderError("Bad {} header. Expected value '{} <JWT>'".format(header_name, header_type))
+
+
+def verify_jwt_in_request():
+    """
+    Ensures the request has a valid access token, decoding it at most once per request.
+    Raises the flask_jwt_extended exceptions, so its error handlers answer as before.
+    """
+    if request.method in config.exempt_methods or 'jwt_claims' in g:
+        return
+    if tuple(config.token_location) != ('headers',): # cookies, query string... keep the library path
+        verify_jwt_in_request_slow()
+        g.jwt_claims = ctx_stack.top.jwt
+        return
+
+    token = _token_from_headers()
+    cache = current_app.extensions['jwt_cache']
+    cached = cache.get(token, time.time())
+    if cached is None:
+        claims = decode_token(token)
+        verify_token_type(claims, 'access')
+        header = get_unverified_jwt_headers(token)
+        cache.put(token, claims, header)
+    else:
+        claims, header = cached
+
+    verify_token_not_blacklisted(claims, 'access')
+    verify_token_claims(claims)
+    ctx_stack.top.jwt = claims
+    ctx_stack.top.jwt_header = header
+    g.jwt_claims = claims
+
+
+def jwt_required(fn):
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        verify_jwt_in_request()
+        return fn(*args, **kwargs)
+    return wrapper
+
+
+def jwt_admin_required(fn):
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        verify_jwt_in_request()
+        if g.jwt_claims[config.user_claims_key].get('role') != 'admin':
+            return jsonify({'msg': 'Admins Only'}), 401
+        return fn(*args, **kwargs)
+    return wrapper
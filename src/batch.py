@@ -0,0 +1,107 @@
+"""
+Several api calls in one round trip, ej: the calls made by the SPA when it starts.
+
+    POST /batch {"requests": [{"method": "GET", "path": "/user/get_profile"},
+                              {"method": "PUT", "path": "/offer/3", "body": {...}}]}
+    -> {"responses": [{"status": 200, "body": {...}}, ...]}   same order as the requests
+
+Each sub-request goes through the whole app (hooks, auth, rate limits, response cache) in a
+request context of its own, built with werkzeug's EnvironBuilder. The Authorization header and
+client address (REMOTE_ADDR and X-Forwarded-For) of the batch are shared by all of them, the
+headers of an item can't replace them: the per-IP limits of the sub-requests count the batch's
+client. /batch itself consumes a token of its limit per sub-request (batch_cost).
+
+Consecutive read-only sub-requests (GET, HEAD) run concurrently in a pool of BATCH_WORKERS
+threads. Writes run one at a time, in order, and the reads after a write wait for it, so they see
+its changes. Every sub-request runs in a thread of the pool, writes too: the DB session is scoped
+per thread (flask_sqlalchemy), a sub-request run in the batch's thread would share the batch's
+session and close it in its teardown. Each sub-request has its own app context, thread and session.
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app, request
+from werkzeug.test import EnvironBuilder
+
+from routing import READ_METHODS
+
+SHARED_HEADERS = ('Authorization', 'X-Forwarded-For', 'User-Agent')
+BATCH_PATH = '/batch'
+
+
+def batch_cost():
+    """tokens of the rate limit of /batch: one per sub-request"""
+    body = request.get_json(silent=True)
+    items = body.get('requests') if isinstance(body, dict) else None
+    return max(len(items), 1) if isinstance(items, list) else 1
+
+
+def init_batch(app):
+    app.extensions['batch_executor'] = ThreadPoolExecutor(
+        max_workers=app.config['BATCH_WORKERS'], thread_name_prefix='batch'
+    )
+
+
+def run_batch(items):
+    """responses of the `items` sub-requests, in the same order"""
+    app = current_app._get_current_object()
+    executor = app.extensions['batch_executor']
+    shared = {
+        'headers': {name: request.headers[name] for name in SHARED_HEADERS if name in request.headers},
+        'environ_base': {'REMOTE_ADDR': request.remote_addr or '127.0.0.1'},
+    }
+    results = [None] * len(items)
+    reads = [] # consecutive reads, run together before the next write
+
+    def run_reads():
+        for i, result in zip(reads, executor.map(lambda i: _dispatch(app, items[i], shared), reads)):
+            results[i] = result
+        del reads[:]
+
+    for i, item in enumerate(items):
+        if item['method'] in READ_METHODS:
+            reads.append(i)
+        else:
+            run_reads()
+            results[i] = executor.submit(_dispatch, app, item, shared).result()
+    run_reads()
+    return results
+
+
+def _dispatch(app, item, shared):
+    path = item['path']
+    if path.split('?', 1)[0].rstrip('/') == BATCH_PATH:
+        return {'status': 400, 'body': {'Error': 'nested batch requests are not allowed'}}
+    shared_names = {name.lower() for name in SHARED_HEADERS}
+    headers = {name: value for name, value in item.get('headers', {}).items() if name.lower() not in shared_names}
+    headers.update(shared['headers'])
+    builder = EnvironBuilder(
+        path=path, method=item['method'], json=item.get('body'),
+        headers=headers, environ_base=shared['environ_base']
+    )
+    try:
+        environ = builder.get_environ()
+    finally:
+        builder.close()
+
+    # an app context of its own: own flask.g (auth claims, replica choice...) and DB session
+    with app.app_context(), app.request_context(environ):
+        try:
+            response = app.full_dispatch_request()
+        except Exception:
+            app.logger.exception('batch sub-request %s %s failed', item['method'], path)
+            return {'status': 500, 'body': {'Error': 'internal server error'}}
+        try:
+            return _result(response)
+        finally:
+            response.close() # files sent by send_from_directory
+
+
+def _result(response):
+    result = {'status': response.status_code}
+    if response.is_json:
+        result['body'] = response.get_json()
+    elif response.mimetype.startswith('text/'):
+        result['body'] = response.get_data(as_text=True)
+    if 'ETag' in response.headers:
+        result['etag'] = response.headers['ETag']
+    return result
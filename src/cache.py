@@ -0,0 +1,265 @@
+"""
+Response cache for the authenticated GET endpoints polled by the SPA (/my-provider-info,
+/my-employer-info, /offer/<id>, /user/get_profile).
+Entries are keyed by (endpoint, user id, url args) and expire after RESPONSE_CACHE_TTL seconds.
+The cache is an LRU bounded to RESPONSE_CACHE_MAX_ENTRIES and RESPONSE_CACHE_MAX_BYTES.
+
+Every entry has tags ('user:<id>', 'offer:<id>'). After each flush, the changed Offer,
+Contract, Review, Request, User, Provider and Employer rows are turned into the tags of the
+responses they appear in. Those tags are invalidated when the transaction commits. Bulk UPDATEs
+are not seen by the flush hooks, so the views running them call `mark_stale()`.
+
+An invalidation saves the time of the commit for each tag in a stamp store, an entry is stale
+when one of its tags was invalidated after its view started. The entries live in the worker
+memory but the stamps must be seen by every worker and dyno, RESPONSE_CACHE_STORAGE_URL=redis://...
+(the RATELIMIT_STORAGE_URL by default): a hit reads the stamps of its tags with one MGET, no
+database query, and a user always reads its own writes wherever its next request lands. With
+memory:// the stamps are the worker's own, the cache is off by default then (config.py).
+Read from a replica and invalidated less than REPLICA_PIN_SECONDS ago, the response isn't stored.
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import current_app, g, request
+from flask_jwt_extended import get_jwt_claims
+from sqlalchemy import event, select
+
+from models import db, User, Provider, Employer, Offer, Contract, Review, Request
+from routing import RoutingSession
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryStamps:
+    """invalidation times of this worker, tag -> time.time() of its last invalidation"""
+    def __init__(self, keep_seconds, max_keys=10000):
+        self.keep_seconds = keep_seconds
+        self.max_keys = max_keys
+        self._stamps = {}
+
+    def invalidate(self, tags, now):
+        for tag in tags:
+            self._stamps[tag] = now
+        if len(self._stamps) > self.max_keys:
+            # entries older than keep_seconds are expired anyway, their invalidations can be forgotten
+            for tag, at in list(self._stamps.items()):
+                if now - at > self.keep_seconds:
+                    self._stamps.pop(tag, None)
+
+    def last(self, tags):
+        """time of the last invalidation of any of `tags`, 0 when never invalidated"""
+        return max([self._stamps.get(tag, 0.0) for tag in tags] or [0.0])
+
+
+class RedisStamps:
+    """invalidation times shared by every worker, a key per tag expiring after keep_seconds"""
+    def __init__(self, url, keep_seconds):
+        import redis # optional dependency, only needed for this store
+        self.keep_seconds = keep_seconds
+        self._client = redis.Redis.from_url(url)
+        self._errors = redis.RedisError
+
+    def invalidate(self, tags, now):
+        try:
+            pipeline = self._client.pipeline(transaction=False)
+            for tag in tags:
+                pipeline.set('cache-tag:%s' % tag, repr(now), ex=int(self.keep_seconds) + 1)
+            pipeline.execute()
+        except self._errors: # the transaction is committed, its entries expire with the ttl
+            logger.exception('response cache invalidation of %s tags not saved', len(tags))
+
+    def last(self, tags):
+        try:
+            values = self._client.mget(['cache-tag:%s' % tag for tag in tags])
+        except self._errors:
+            return float('inf') # unknown: every entry is stale
+        return max([float(value) for value in values if value is not None] or [0.0])
+
+
+def stamp_store(url, keep_seconds):
+    if url.startswith('memory://'):
+        return MemoryStamps(keep_seconds)
+    if url.startswith('redis://') or url.startswith('rediss://'):
+        return RedisStamps(url, keep_seconds)
+    raise ValueError('unknown RESPONSE_CACHE_STORAGE_URL: %s' % url)
+
+
+class ResponseCache:
+    def __init__(self, ttl=30, max_entries=10000, max_bytes=32 * 1024 * 1024, replica_lag=0, stamps=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.replica_lag = replica_lag
+        self.stamps = stamps if stamps is not None else MemoryStamps(max(ttl, replica_lag))
+        self.size = 0
+        self._entries = OrderedDict() # key -> (expires, stamp, tags, body, status, mimetype, etag)
+        self._lock = threading.Lock()
+
+    def stamp(self):
+        """taken before the view runs, an entry is stale if one of its tags is invalidated after it"""
+        return time.time()
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= now or self.stamps.last(entry[2]) >= entry[1]:
+            with self._lock:
+                if self._entries.get(key) is entry:
+                    self._remove(key)
+            return None
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+        return entry[3:]
+
+    def put(self, key, stamp, tags, body, status, mimetype, etag=None, from_replica=False):
+        last = self.stamps.last(tags)
+        if last >= stamp:
+            return
+        # read from a replica: it may not have the last change of these tags yet
+        if from_replica and time.time() - last < self.replica_lag:
+            return
+        now = time.monotonic()
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (now + self.ttl, stamp, tags, body, status, mimetype, etag)
+            self.size += len(body)
+            while self._entries and (len(self._entries) > self.max_entries or self.size > self.max_bytes):
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        self.size -= len(self._entries.pop(key)[3])
+
+    def invalidate(self, tags):
+        self.stamps.invalidate(tags, time.time())
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+
+def init_response_cache(app):
+    ttl = app.config['RESPONSE_CACHE_TTL']
+    replica_lag = app.config['REPLICA_PIN_SECONDS'] if app.config.get('SQLALCHEMY_REPLICA_URIS') else 0
+    app.extensions['response_cache'] = ResponseCache(
+        ttl=ttl,
+        max_entries=app.config['RESPONSE_CACHE_MAX_ENTRIES'],
+        max_bytes=app.config['RESPONSE_CACHE_MAX_BYTES'],
+        replica_lag=replica_lag,
+        stamps=stamp_store(app.config['RESPONSE_CACHE_STORAGE_URL'], max(ttl, replica_lag))
+    )
+
+
+def cached_response(tags=None):
+    """
+    Decorator for GET views, goes below @jwt_required. `tags` is a function receiving the view
+    arguments and returning the tags of the response besides 'user:<id>':
+        @cached_response(tags=lambda offer_id: ['offer:%s' % offer_id])
+    Only 200 responses are stored. Tokens issued before the 'id' claim existed are not cached.
+    """
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            user_id = get_jwt_claims().get('id')
+            if request.method != 'GET' or not current_app.config['RESPONSE_CACHE_ENABLED'] or user_id is None:
+                return fn(*args, **kwargs)
+
+            cache = current_app.extensions['response_cache']
+            key = (
+                request.endpoint, user_id,
+                tuple(sorted(request.view_args.items())), tuple(sorted(request.args.items(multi=True)))
+            )
+            hit = cache.get(key)
+            if hit is not None:
+                body, status, mimetype, etag = hit
+                response = current_app.response_class(body, status=status, mimetype=mimetype)
+                if etag is not None:
+                    response.headers['ETag'] = etag
+                return response
+
+            stamp = cache.stamp()
+            response = current_app.make_response(fn(*args, **kwargs))
+            if response.status_code == 200 and not response.is_streamed:
+                entry_tags = ('user:%s' % user_id,) + tuple(tags(*args, **kwargs) if tags else ())
+                cache.put(
+                    key, stamp, entry_tags, response.get_data(), response.status_code, response.mimetype,
+                    etag=response.headers.get('ETag'), from_replica=g.get('db_replica') is not None
+                )
+            return response
+        return wrapper
+    return decorator
+
+
+def _tags_of(session, instances):
+    """tags of the cached responses showing any of `instances`"""
+    tags, request_ids = set(), set()
+    for obj in instances:
+        if isinstance(obj, (User, Provider, Employer)):
+            tags.add('user:%s' % obj.id)
+        elif isinstance(obj, Offer):
+            tags.update(('offer:%s' % obj.id, 'user:%s' % obj.provider_id))
+        elif isinstance(obj, Contract):
+            tags.update(('user:%s' % obj.employer_id, 'user:%s' % obj.provider_id))
+        elif isinstance(obj, Review): # the summary of the reviewed side
+            tags.add('user:%s' % (obj.provider_id if obj.provider_id is not None else obj.employer_id))
+        elif isinstance(obj, Request):
+            tags.add('user:%s' % obj.employer_id)
+            request_ids.add(obj.id)
+
+    if request_ids: # a request is shown inside each of its offers
+        offer_t = Offer.__table__
+        rows = session.execute(
+            select([offer_t.c.id, offer_t.c.provider_id]).where(offer_t.c.request_id.in_(request_ids))
+        )
+        for offer_id, provider_id in rows:
+            tags.update(('offer:%s' % offer_id, 'user:%s' % provider_id))
+    return tags
+
+
+def _cache(session):
+    return session.app.extensions.get('response_cache')
+
+
+def mark_stale(*instances):
+    """
+    For changes made with bulk UPDATEs: the responses showing `instances` are invalidated
+    when the current transaction commits, ej: mark_stale(offer.request) after updating its offers.
+    """
+    session = db.session()
+    if _cache(session) is not None:
+        session.info.setdefault('stale_tags', set()).update(_tags_of(session, instances))
+
+
+def _on_flush(session):
+    if _cache(session) is None:
+        return
+    changed = list(session.new) + list(session.dirty) + list(session.deleted)
+    tags = _tags_of(session, changed)
+    if tags:
+        session.info.setdefault('stale_tags', set()).update(tags)
+
+
+def _on_commit(session):
+    if session.transaction.nested: # a savepoint released, the transaction is still open
+        return
+    tags = session.info.pop('stale_tags', None)
+    if tags:
+        _cache(session).invalidate(tags)
+
+
+def _on_rollback(session, previous_transaction):
+    if previous_transaction.parent is None: # the whole transaction, not a savepoint
+        session.info.pop('stale_tags', None)
+
+
+event.listen(RoutingSession, 'after_flush', lambda session, flush_context: _on_flush(session))
+event.listen(RoutingSession, 'after_commit', _on_commit)
+event.listen(RoutingSession, 'after_soft_rollback', _on_rollback)
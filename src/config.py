@@ -0,0 +1,154 @@
+"""
+Configurations used by create_app(config), environment variables are read here
+and nowhere else.
+"""
+import os
+from datetime import timedelta
+
+
+class Config:
+    SQLALCHEMY_DATABASE_URI = os.environ.get('DB_CONNECTION_STRING')
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # read replicas, comma separated connection strings. See routing.py
+    SQLALCHEMY_REPLICA_URIS = [uri for uri in os.environ.get('DB_REPLICA_CONNECTION_STRINGS', '').split(',') if uri]
+    REPLICA_PIN_SECONDS = 5 # reads stay on the primary this long after a write of the same user
+    # shared by the workers and dynos, see routing.py
+    REPLICA_PIN_STORAGE_URL = os.environ.get('REPLICA_PIN_STORAGE_URL', os.environ.get('RATELIMIT_STORAGE_URL', 'memory://'))
+    REPLICA_HEALTH_INTERVAL = 5
+    REPLICA_RETRY_SECONDS = 30
+    # region shards, comma separated "<region id>=<connection string>". See sharding.py
+    SQLALCHEMY_SHARD_URIS = dict(
+        item.split('=', 1) for item in os.environ.get('DB_SHARD_CONNECTION_STRINGS', '').split(',') if item
+    )
+    SHARD_FANOUT_WORKERS = 8 # threads running the queries across shards
+    SHARD_ID_BLOCK = 100000000 # ids of the shard of region r start at r * SHARD_ID_BLOCK
+    JWT_SECRET_KEY = os.environ.get('JWT_SECRET_KEY', '1478520.Lucena1953')
+    JWT_ACCESS_TOKEN_EXPIRES = timedelta(days=1)
+    JWT_CACHE_SIZE = 4096 # verified tokens kept in memory by each worker, see auth.py
+    # logout, see revocation.py
+    JWT_BLACKLIST_ENABLED = True
+    JWT_BLACKLIST_TOKEN_CHECKS = ['access']
+    TOKEN_REVOCATION_REFRESH = 30 # seconds between rebuilds of the bloom filter
+    TOKEN_REVOCATION_ERROR_RATE = 0.001
+    ENABLE_MIGRATIONS = False # flask db <command>, see CliConfig
+    API_SPEC_ENABLED = False # GET /spec, the swagger spec of the api
+
+    # rate limiting, see ratelimit.py
+    RATELIMIT_ENABLED = True
+    RATELIMIT_STORAGE_URL = os.environ.get('RATELIMIT_STORAGE_URL', 'memory://')
+    RATELIMIT_PROXY_COUNT = 1 # heroku router
+    RATELIMITS = {
+        'login': {'ip': '20/minute', 'identity': '5/minute'},
+        'register': {'ip': '5/minute'},
+        'search': {'ip': '60/minute', 'identity': '30/minute'},
+        'batch': {'ip': '120/minute'}, # a token per sub-request, their own limits apply too
+    }
+
+    REVIEWS_PER_PAGE = 20
+
+    # cached GET responses of each worker, see cache.py. The invalidations must reach every
+    # worker: off by default without a shared store (RESPONSE_CACHE_ENABLED = True for one worker)
+    RESPONSE_CACHE_STORAGE_URL = os.environ.get('RESPONSE_CACHE_STORAGE_URL', os.environ.get('RATELIMIT_STORAGE_URL', 'memory://'))
+    RESPONSE_CACHE_ENABLED = not RESPONSE_CACHE_STORAGE_URL.startswith('memory://')
+    RESPONSE_CACHE_TTL = 30
+    RESPONSE_CACHE_MAX_ENTRIES = 10000
+    RESPONSE_CACHE_MAX_BYTES = 32 * 1024 * 1024
+
+    # /feed/service-requests, see feed.py
+    FEED_WEIGHTS = {'category': 3.0, 'location': 2.0, 'recency': 1.0, 'competition': 1.0}
+    FEED_RECENCY_HALF_LIFE_DAYS = 7
+    FEED_TOP_K = 50 # max requests per response
+    FEED_POOL_SIZE = 200 # best candidates kept per provider
+    FEED_BATCH_SIZE = 5000 # candidates scored at a time
+    FEED_CACHE_SECONDS = 600 # full re-scoring after this
+    FEED_SETTLE_SECONDS = 60 # changes are looked up this far back, for the transactions committed late
+    FEED_CACHE_SIZE = 2000 # providers
+
+    # background jobs, see jobs.py
+    JOBS_BACKEND = os.environ.get('JOBS_BACKEND', 'memory') # 'memory' or 'database'
+    JOBS_WORKERS = 2 # threads per web worker
+    JOBS_MAX_RETRIES = 5
+    JOBS_RETRY_BACKOFF = 2 # seconds, doubled on each retry
+    JOBS_POLL_SECONDS = 1
+    JOBS_TIMEOUT = 300 # a running database job older than this is queued again
+    JOBS_SHUTDOWN_TIMEOUT = 5
+
+    # uploaded images, see media.py
+    MEDIA_ROOT = os.environ.get('MEDIA_ROOT', os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'media'))
+    MEDIA_URL = '/media/'
+    MEDIA_MAX_BYTES = 5 * 1024 * 1024
+    MEDIA_THUMBNAIL_SIZES = (64, 256)
+    MEDIA_CACHE_SECONDS = 365 * 24 * 3600 # file names change with their content
+
+    # audit log, see audit.py
+    AUDIT_ENABLED = True
+    AUDIT_BATCH_SIZE = 500 # rows per INSERT, a full buffer is flushed right away
+    AUDIT_FLUSH_SECONDS = 2
+    AUDIT_MAX_BUFFER = 50000 # oldest events dropped beyond this while the database is down
+    AUDIT_SPOOL_DIR = os.environ.get('AUDIT_SPOOL_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'audit-spool'))
+    AUDIT_PAGE_SIZE = 100
+
+    # POST /batch, see batch.py
+    BATCH_MAX_REQUESTS = 20
+    BATCH_WORKERS = 4 # threads running the read-only sub-requests of each web worker
+
+    # name -> id lookups of regions, comunas and categories, see snapshot.py
+    REFERENCE_SNAPSHOT_PATH = os.environ.get('REFERENCE_SNAPSHOT_PATH') # None: lookups go to the database
+    REFERENCE_SNAPSHOT_CHECK_SECONDS = 5 # a replaced file is mapped again after this
+
+    # health checks and diagnostics, see diagnostics.py
+    READY_DB_BUDGET_MS = 500 # /readyz fails when SELECT 1 takes longer
+    DEBUG_RECENT_REQUESTS = 1000 # finished requests kept by each worker for /debug/slow
+
+    # flask export
+    EXPORT_DIR = os.environ.get('EXPORT_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'exports'))
+    EXPORT_BATCH_SIZE = 5000
+    EXPORT_SETTLE_SECONDS = 60 # rows newer than this wait for the next export
+
+    # /admin/metrics/activity and flask rollup-activity, see metrics.py
+    METRICS_ROLLUP_SECONDS = 600 # the endpoint queues a rollup when the last one is older
+    METRICS_ROLLUP_BATCH_SIZE = 50000 # ids of a table counted per transaction
+    METRICS_SETTLE_SECONDS = 60 # rows newer than this wait for the next rollup
+    METRICS_DEFAULT_DAYS = 30
+
+    # admin deletes of regions, comunas and categories, see deletions.py
+    DELETION_BATCH_SIZE = 1000 # dependent rows updated per statement and transaction
+
+    # flask archive-requests
+    ARCHIVE_BATCH_SIZE = 500
+    ARCHIVE_CLOSED_AFTER_DAYS = 7
+    REQUEST_EXPIRATION_DAYS = 90
+
+
+class ProductionConfig(Config):
+    pass
+
+
+class CliConfig(Config):
+    ENABLE_MIGRATIONS = True # APP_CONFIG=cli, set by the Pipfile scripts of flask db (release phase too)
+
+
+class TestingConfig(Config):
+    TESTING = True
+    SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    SQLALCHEMY_REPLICA_URIS = []
+    SQLALCHEMY_SHARD_URIS = {}
+    REFERENCE_SNAPSHOT_PATH = None # lookups go to the database
+    RATELIMIT_ENABLED = False
+
+
+CONFIGS = {
+    'default': Config,
+    'production': ProductionConfig,
+    'cli': CliConfig,
+    'testing': TestingConfig,
+}
+
+
+def load_config(config=None):
+    """returns the config class for a name, a class, or a dict of overrides (applied over Config)"""
+    if config is None or isinstance(config, dict):
+        return CONFIGS[os.environ.get('APP_CONFIG', 'default')]
+    if isinstance(config, str):
+        return CONFIGS[config]
+    return config
@@ -0,0 +1,139 @@
+"""
+Deletion of regions, comunas and categories from the admin endpoints.
+
+The row is soft deleted right away (deleted_at, filtered out of the lookups and listings, its
+name can be used again) and the rows depending on it are updated in the background by the
+'reference-delete' job, in batches of DELETION_BATCH_SIZE rows:
+    SELECT id FROM request WHERE category_id = :deleted LIMIT n
+    UPDATE request SET category_id = :reassign_to WHERE id IN (<those ids>) AND category_id = :deleted
+nothing is loaded into the session, and each batch commits on its own so locks are short. The ids
+are selected first: MySQL doesn't take a LIMIT in an IN subquery, nor a subquery over the table
+being updated.
+
+    category    requests and provider categories move to `reassign_to`, or lose it
+    comuna      users and requests move to `reassign_to`, or lose it
+    region      comunas move to `reassign_to`, or are deleted too, their users and requests
+                losing their comuna
+
+The progress is kept in models.DeletionTask, served by /admin/deletions/<id>. The job can run
+again after a failure, each step only picks the rows still pointing at the deleted one.
+Requests live in their region database (sharding.py), so with shards a comuna or region can't be
+reassigned to another region.
+"""
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy import and_, func, select
+
+from jobs import job, enqueue, enqueue_after_commit
+from models import db, User, Comuna, Request, DeletionTask, provider_category
+from sharding import for_each_database
+from snapshot import bump_reference_version
+
+
+def start_deletion(instance, reassign_to=None):
+    """soft deletes `instance` and queues the update of its dependent rows, returns the DeletionTask"""
+    instance.deleted_at = datetime.now()
+    task = DeletionTask(entity_type=instance.__tablename__, entity_id=instance.id, reassign_to=reassign_to)
+    db.session.add(task)
+    db.session.flush()
+    enqueue_after_commit('reference-delete', task.id)
+    return task
+
+
+class Step:
+    """
+    rows of `table` matching `condition`, updated with `values` (deleted when None) in batches keyed
+    on `key`. The UPDATE/DELETE checks `match` again (`condition` by default), without subqueries
+    over `table`.
+    """
+    def __init__(self, table, key, condition, values=None, region_tables=False, match=None):
+        self.table, self.key, self.condition, self.values = table, key, condition, values
+        self.match = condition if match is None else match
+        self.region_tables = region_tables # request: run on every database, see sharding.py
+
+    def remaining(self):
+        counts = self._each_database(lambda: db.session.execute(
+            select([func.count()]).select_from(self.table).where(self.condition)
+        ).scalar())
+        return sum(counts)
+
+    def run(self, batch_size, progress):
+        def run_batches():
+            while True:
+                keys = [key for key, in db.session.execute(select([self.key]).where(self.condition).limit(batch_size))]
+                if not keys:
+                    db.session.commit()
+                    return
+                statement = self.table.delete() if self.values is None else self.table.update().values(self._values())
+                count = db.session.execute(statement.where(and_(self.match, self.key.in_(keys)))).rowcount
+                db.session.commit()
+                progress(count)
+        self._each_database(run_batches)
+
+    def _values(self):
+        if 'version_id' in self.table.c: # bulk UPDATEs bypass version_id_col, see versioning.py
+            return dict(self.values, version_id=self.table.c.version_id + 1)
+        return self.values
+
+    def _each_database(self, fn):
+        return for_each_database(fn) if self.region_tables else [fn()]
+
+
+def _steps(task):
+    deleted, target = task.entity_id, task.reassign_to
+    request, user, comuna = Request.__table__, User.__table__, Comuna.__table__
+    if task.entity_type == 'category':
+        links = provider_category
+        steps = [Step(request, request.c.id, request.c.category_id == deleted, {'category_id': target}, region_tables=True)]
+        if target is not None: # providers that already had the target just lose the deleted one
+            had_target = links.c.provider_id.in_(select([links.c.provider_id]).where(links.c.category_id == target))
+            of_deleted = links.c.category_id == deleted
+            steps.append(Step(links, links.c.provider_id, and_(of_deleted, had_target), match=of_deleted))
+            steps.append(Step(links, links.c.provider_id, and_(of_deleted, ~had_target), {'category_id': target}, match=of_deleted))
+        else:
+            steps.append(Step(links, links.c.provider_id, links.c.category_id == deleted))
+        return steps
+
+    if task.entity_type == 'comuna':
+        comunas = [deleted]
+    elif target is not None:
+        return [Step(comuna, comuna.c.id, and_(comuna.c.region_id == deleted, comuna.c.deleted_at.is_(None)), {'region_id': target})]
+    else:
+        # every comuna of the region, the ones deleted by a previous run of the job too
+        comunas = [comuna_id for comuna_id, in db.session.query(Comuna.id).filter(Comuna.region_id == deleted)]
+    steps = [
+        Step(user, user.c.id, user.c.comuna_id.in_(comunas), {'comuna_id': target}),
+        Step(request, request.c.id, request.c.comuna_id.in_(comunas), {'comuna_id': target}, region_tables=True),
+    ]
+    if task.entity_type == 'region':
+        steps.insert(0, Step(comuna, comuna.c.id, and_(comuna.c.region_id == deleted, comuna.c.deleted_at.is_(None)), {'deleted_at': datetime.now()}))
+    return steps
+
+
+@job('reference-delete')
+def run_deletion(task_id):
+    task = DeletionTask.query.get(task_id)
+    if task is None or task.status == 'done':
+        return
+    steps = _steps(task)
+    task.status = 'running'
+    task.total = task.processed + sum(step.remaining() for step in steps)
+    db.session.commit()
+
+    def progress(count):
+        db.session.query(DeletionTask).filter(DeletionTask.id == task_id).update(
+            {DeletionTask.processed: DeletionTask.processed + count}, synchronize_session=False
+        )
+        db.session.commit()
+
+    for step in steps:
+        step.run(current_app.config['DELETION_BATCH_SIZE'], progress)
+    task = DeletionTask.query.get(task_id)
+    task.status = 'done'
+    task.finished_date = datetime.now()
+    if task.entity_type == 'region': # comunas updated without the session, see snapshot.py
+        bump_reference_version(db.session)
+    db.session.commit()
+    if task.entity_type == 'region':
+        enqueue('reference-snapshot')
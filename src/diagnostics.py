@@ -0,0 +1,177 @@
+"""
+Live diagnostics of a web worker, without attaching a profiler.
+
+Every request is timed and its SQL statements counted (all engines: primary, replicas and
+shards). Finished requests go to a ring buffer of DEBUG_RECENT_REQUESTS entries per worker,
+served sorted by duration in /debug/slow. Requests still running are kept apart, so a hung
+one shows up in /debug/stacks next to the stack of the thread serving it.
+
+The repeated statement of each request (the most executed one) is kept with its count: an
+N+1 loop shows up as the same SELECT run once per row.
+
+Each gunicorn worker has its own buffer, the responses include its pid.
+"""
+import itertools
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import Counter, deque
+from datetime import datetime
+
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+class RequestLog:
+    def __init__(self, size):
+        self.recent = deque(maxlen=size) # finished requests, oldest dropped first
+        self.in_flight = {} # key of the request (see start) -> its entry, with the id of the thread serving it
+        self._keys = itertools.count()
+
+    def start(self):
+        entry = {
+            'method': request.method,
+            'path': request.full_path.rstrip('?'),
+            'endpoint': request.endpoint,
+            'started': datetime.now(),
+            'status': None,
+            'sql_count': 0,
+            'sql_ms': 0.0,
+        }
+        g.diagnostics = entry
+        g.diagnostics_start = time.perf_counter()
+        g.sql_statements = Counter()
+        # per request, not per thread: a thread can serve several at once (sub-requests of /batch)
+        g.diagnostics_key = next(self._keys)
+        self.in_flight[g.diagnostics_key] = dict(entry=entry, thread=threading.get_ident())
+
+    def finish(self):
+        entry = g.pop('diagnostics', None)
+        self.in_flight.pop(g.pop('diagnostics_key', None), None)
+        if entry is None:
+            return
+        entry['duration_ms'] = round((time.perf_counter() - g.diagnostics_start) * 1000, 2)
+        entry['sql_ms'] = round(entry['sql_ms'], 2)
+        if g.sql_statements:
+            statement, count = g.sql_statements.most_common(1)[0]
+            entry['top_statement'] = {'sql': ' '.join(statement.split())[:300], 'count': count}
+        self.recent.append(entry)
+
+    def slowest(self, limit, path=None):
+        entries = [e for e in list(self.recent) if path is None or e['path'].startswith(path)]
+        return sorted(entries, key=lambda e: e['duration_ms'], reverse=True)[:limit]
+
+    def by_endpoint(self):
+        """requests, mean and max duration and mean statements per endpoint of the buffer"""
+        summary = {}
+        for entry in list(self.recent):
+            item = summary.setdefault(entry['endpoint'] or entry['path'], {'requests': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'sql': 0})
+            item['requests'] += 1
+            item['total_ms'] += entry['duration_ms']
+            item['max_ms'] = max(item['max_ms'], entry['duration_ms'])
+            item['sql'] += entry['sql_count']
+        return {
+            name: {
+                'requests': item['requests'],
+                'mean_ms': round(item['total_ms'] / item['requests'], 2),
+                'max_ms': item['max_ms'],
+                'mean_sql': round(item['sql'] / item['requests'], 1),
+            } for name, item in summary.items()
+        }
+
+    def stacks(self):
+        """stack of every thread of the worker, with the request each one is serving"""
+        frames = sys._current_frames()
+        now = datetime.now()
+        serving = {}
+        for item in list(self.in_flight.values()):
+            entry = dict(item['entry'], running_ms=round((now - item['entry']['started']).total_seconds() * 1000, 2))
+            serving.setdefault(item['thread'], []).append(entry)
+        threads = []
+        for thread in threading.enumerate():
+            frame = frames.get(thread.ident)
+            entries = serving.get(thread.ident, [])
+            threads.append({
+                'name': thread.name,
+                'daemon': thread.daemon,
+                'request': entries[-1] if entries else None, # the innermost one
+                'requests': entries,
+                'stack': traceback.format_stack(frame) if frame is not None else [],
+            })
+        return threads
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and 'diagnostics' in g:
+        g.diagnostics['sql_count'] += 1
+        g.sql_statements[statement] += 1
+        conn.info.setdefault('diagnostics_start', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get('diagnostics_start')
+    if starts and has_request_context() and 'diagnostics' in g:
+        g.diagnostics['sql_ms'] += (time.perf_counter() - starts.pop()) * 1000
+
+
+event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+
+
+def init_diagnostics(app):
+    log = RequestLog(app.config['DEBUG_RECENT_REQUESTS'])
+    app.extensions['request_log'] = log
+    app.before_request(log.start)
+
+    @app.after_request
+    def record_status(response):
+        if 'diagnostics' in g:
+            g.diagnostics['status'] = response.status_code
+        return response
+
+    @app.teardown_request
+    def finish(exc):
+        if 'diagnostics' in g and exc is not None:
+            g.diagnostics['status'] = 500
+        log.finish()
+
+
+def request_log():
+    return current_app.extensions['request_log']
+
+
+def pool_status(engine):
+    """checked out connections of a QueuePool and its limit, None for pools without a limit (SQLite)"""
+    pool = engine.pool
+    if not hasattr(pool, 'checkedout') or not hasattr(pool, '_max_overflow'):
+        return None
+    limit = pool.size() + pool._max_overflow if pool._max_overflow >= 0 else None
+    return {'checked_out': pool.checkedout(), 'size': pool.size(), 'overflow': pool.overflow(), 'limit': limit}
+
+
+def check_database(engine, budget_ms):
+    """(ok, details) of a SELECT 1 round trip, skipped when the pool has no free connection"""
+    pool = pool_status(engine)
+    details = {'pool': pool}
+    if pool is not None and pool['limit'] is not None and pool['checked_out'] >= pool['limit']:
+        details['error'] = 'connection pool exhausted'
+        return False, details
+    start = time.perf_counter()
+    try:
+        with engine.connect() as connection:
+            connection.scalar('SELECT 1')
+    except Exception as e:
+        details['error'] = '%s: %s' % (type(e).__name__, e)
+        return False, details
+    details['round_trip_ms'] = round((time.perf_counter() - start) * 1000, 2)
+    if details['round_trip_ms'] > budget_ms:
+        details['error'] = 'round trip over %s ms' % budget_ms
+        return False, details
+    return True, details
+
+
+def worker_info():
+    return {'pid': os.getpid(), 'threads': threading.active_count()}
@@ -0,0 +1,228 @@
+"""
+Export of the marketplace tables for analytics, so reports don't query the live database.
+Rows are read in batches of EXPORT_BATCH_SIZE, keyset paginated by id (WHERE id > last id
+ORDER BY id LIMIT n, no server-side cursor), and written batch by batch: memory use doesn't
+depend on the table size. Reads go to a replica when SQLALCHEMY_REPLICA_URIS is set, the region
+tables are also read from every shard (sharding.py).
+
+Exports are incremental: each run writes the rows of each table whose mark column is in
+[last high-water mark, now - EXPORT_SETTLE_SECONDS), the new mark is saved in the state file.
+The settle time lets the transactions in flight commit, a change is never missed.
+Requests, offers and contracts are marked by updated_date: a row is exported again after each
+change (ej: its status), consumers keep the last copy of each id. Requests and offers moved
+to the archive tables (archive.py) are exported with them, marked by archived_date, which is
+NULL for the live rows.
+Personal data (password, email, rut, addresses) is not exported.
+
+    $ flask export [request offer ...] [--format parquet|csv|jsonl] [--output DIR] [--full]
+
+one file per table and run: DIR/<table>/<table>-<timestamp>.parquet (or .csv.gz, .jsonl.gz)
+"""
+import csv
+import gzip
+import io
+import json
+import os
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import and_, null, or_, select
+from sqlalchemy.types import Boolean, DateTime, Float, Integer
+
+from models import db, User, Request, Offer, Contract, Review, RequestArchive, OfferArchive
+from sharding import REGION_TABLES
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError: # optional, only the parquet format needs it
+    pyarrow = None
+
+# table -> (model, high-water mark column, columns left out, archive model or None)
+EXPORTS = {
+    'request': (Request, 'updated_date', ('street', 'home_number', 'more_info'), RequestArchive),
+    'offer': (Offer, 'updated_date', (), OfferArchive),
+    'contract': (Contract, 'updated_date', (), None),
+    'review': (Review, 'review_date', (), None),
+    'user': (User, 'register_date', ('password', 'email', 'rut', 'rut_serial', 'street', 'home_number', 'more_info'), None),
+}
+EXTENSIONS = {'parquet': 'parquet', 'csv': 'csv.gz', 'jsonl': 'jsonl.gz'}
+
+
+def _columns(table_name):
+    model, _, excluded, archive = EXPORTS[table_name]
+    columns = [column for column in model.__table__.columns if column.name not in excluded]
+    if archive is not None:
+        columns.append(archive.__table__.c.archived_date)
+    return columns
+
+
+def _sources(table_name):
+    """(table, mark column) of each table read for `table_name`: the live one and its archive"""
+    model, mark, _, archive = EXPORTS[table_name]
+    sources = [(model.__table__, model.__table__.c[mark])]
+    if archive is not None:
+        sources.append((archive.__table__, archive.__table__.c.archived_date))
+    return sources
+
+
+class CsvWriter:
+    def __init__(self, path, columns):
+        self.file = io.TextIOWrapper(gzip.open(path, 'wb'), encoding='utf-8', newline='')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow([column.name for column in columns])
+
+    def write(self, rows):
+        self.writer.writerows(
+            [value.isoformat() if isinstance(value, datetime) else value for value in row] for row in rows
+        )
+
+    def close(self):
+        self.file.close()
+
+
+class JsonLinesWriter:
+    def __init__(self, path, columns):
+        self.file = io.TextIOWrapper(gzip.open(path, 'wb'), encoding='utf-8')
+        self.names = [column.name for column in columns]
+
+    def write(self, rows):
+        for row in rows:
+            self.file.write(json.dumps(dict(zip(self.names, row)), default=datetime.isoformat, ensure_ascii=False))
+            self.file.write('\n')
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetWriter:
+    """one row group per batch"""
+    def __init__(self, path, columns):
+        self.schema = pyarrow.schema([(column.name, self._arrow_type(column.type)) for column in columns])
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema, compression='snappy')
+
+    @staticmethod
+    def _arrow_type(sql_type):
+        if isinstance(sql_type, Integer):
+            return pyarrow.int64()
+        if isinstance(sql_type, Float):
+            return pyarrow.float64()
+        if isinstance(sql_type, Boolean):
+            return pyarrow.bool_()
+        if isinstance(sql_type, DateTime):
+            return pyarrow.timestamp('us')
+        return pyarrow.string()
+
+    def write(self, rows):
+        columns = list(zip(*rows))
+        self.writer.write_table(pyarrow.Table.from_arrays(
+            [pyarrow.array(values, type=field.type) for values, field in zip(columns, self.schema)],
+            schema=self.schema
+        ))
+
+    def close(self):
+        self.writer.close()
+
+
+WRITERS = {'parquet': ParquetWriter, 'csv': CsvWriter, 'jsonl': JsonLinesWriter}
+
+
+def _read_engines(table_name):
+    router = current_app.extensions.get('replica_router')
+    engine = router.choose() if router is not None else None
+    engines = [engine if engine is not None else db.engine]
+    shards = current_app.extensions.get('shard_resolver')
+    if shards is not None and table_name in REGION_TABLES:
+        engines += [shards.engines[region_id] for region_id in sorted(shards.engines)]
+    return engines
+
+
+def load_state(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_state(path, state):
+    temp = path + '.tmp'
+    with open(temp, 'w') as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    os.replace(temp, path)
+
+
+def _batches(connection, table, columns, condition, batch_size):
+    """rows of `table` matching `condition`, `batch_size` at a time in id order"""
+    selected = [table.c[column.name] if column.name in table.c else null().label(column.name) for column in columns]
+    last_id = None
+    while True:
+        query = select(selected).where(condition)
+        if last_id is not None:
+            query = query.where(table.c.id > last_id)
+        rows = connection.execute(query.order_by(table.c.id).limit(batch_size)).fetchall()
+        if not rows:
+            return
+        yield rows
+        last_id = rows[-1][table.c.id.name]
+
+
+def export_table(table_name, output, file_format, batch_size, since, until):
+    """
+    writes the rows of `table_name` (and its archive) marked in [since, until) (since None: every
+    row before `until`, and the unmarked ones). Returns (file path, rows), path is None without rows.
+    """
+    columns = _columns(table_name)
+    directory = os.path.join(output, table_name)
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, '%s-%s.%s' % (table_name, until.strftime('%Y%m%dT%H%M%S'), EXTENSIONS[file_format]))
+    writer, total = None, 0
+    for engine in _read_engines(table_name):
+        with engine.connect() as connection:
+            for table, mark in _sources(table_name):
+                condition = mark < until if since is not None else or_(mark < until, mark.is_(None))
+                if since is not None:
+                    condition = and_(condition, mark >= since)
+                for rows in _batches(connection, table, columns, condition, batch_size):
+                    if writer is None:
+                        writer = WRITERS[file_format](path + '.part', columns)
+                    writer.write(rows)
+                    total += len(rows)
+    if writer is None:
+        return None, 0
+    writer.close()
+    os.replace(path + '.part', path)
+    return path, total
+
+
+@click.command('export')
+@click.argument('tables', nargs=-1, type=click.Choice(sorted(EXPORTS)))
+@click.option('--format', 'file_format', type=click.Choice(sorted(WRITERS)), default=None,
+              help='parquet when pyarrow is installed, csv otherwise')
+@click.option('--output', default=None, help='output directory, EXPORT_DIR by default')
+@click.option('--batch-size', type=int, default=None, help='rows fetched and written at a time')
+@click.option('--full', is_flag=True, help='export every row, ignoring the saved high-water marks')
+@with_appcontext
+def export_command(tables, file_format, output, batch_size, full):
+    """Export request, offer, contract, review and user rows for analytics."""
+    config = current_app.config
+    file_format = file_format or ('parquet' if pyarrow is not None else 'csv')
+    if file_format == 'parquet' and pyarrow is None:
+        raise click.UsageError('the parquet format needs pyarrow installed')
+    output = output or config['EXPORT_DIR']
+    os.makedirs(output, exist_ok=True)
+    state_path = os.path.join(output, 'export-state.json')
+    state = load_state(state_path)
+    until = datetime.now().replace(microsecond=0) - timedelta(seconds=config['EXPORT_SETTLE_SECONDS'])
+
+    for table_name in tables or sorted(EXPORTS):
+        since = None if full or table_name not in state else datetime.strptime(state[table_name], '%Y-%m-%dT%H:%M:%S')
+        if since is not None and since >= until:
+            click.echo('%s: up to date' % table_name)
+            continue
+        path, total = export_table(
+            table_name, output, file_format, batch_size or config['EXPORT_BATCH_SIZE'], since, until
+        )
+        state[table_name] = until.isoformat()
+        save_state(state_path, state) # after each table, a failed run keeps the finished ones
+        click.echo('%s: %s rows%s' % (table_name, total, ' -> %s' % path if path else ''))
@@ -0,0 +1,258 @@
+"""
+Recommendation feed: the active service requests ranked for a provider.
+
+score = FEED_WEIGHTS['category'] * category affinity     declared categories, plus past offers and contracts
+      + FEED_WEIGHTS['location'] * proximity             1 same comuna, 0.5 same region
+      + FEED_WEIGHTS['recency'] * 0.5 ** (age / FEED_RECENCY_HALF_LIFE_DAYS)
+      + FEED_WEIGHTS['competition'] / (1 + active offers)
+
+Candidates are read in batches of FEED_BATCH_SIZE and scored with NumPy, only the best
+FEED_POOL_SIZE of them are kept. That pool is cached per provider for FEED_CACHE_SECONDS. Later
+reads score the requests created since (ids above the last one seen) and score again the ones
+that may have gone up: requests edited or reactivated, and requests with an offer withdrawn,
+rejected or accepted (updated_date since the last read, minus FEED_SETTLE_SECONDS for the
+transactions in flight). Then the pool is re-checked: requests no longer active or already offered
+on are dropped, offer counts are re-read and the pool re-scored.
+Otherwise scores only go down (new offers, recency decay), but not at the same pace: the pool keeps
+the best score dropped from it, and every candidate is scored again when the requested top no
+longer scores above it. Changes of the provider (categories, comuna, offers) wait for the full
+re-scoring after FEED_CACHE_SECONDS.
+"""
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import and_, func, select
+
+from models import db, Request, Offer, Contract, Comuna, Category, User, provider_category
+
+np = None # numpy, imported by the first feed read (see _import_numpy), not by every worker at startup
+
+# features kept for each request of the pool, to re-score it without reading it again
+POOL_FIELDS = ('ids', 'static', 'created', 'offers')
+
+
+class FeedPool:
+    def __init__(self, provider_id):
+        self.built_at = time.monotonic()
+        self.checked_at = datetime.now() # changes since then are scored again by the next read
+        self.last_id = 0 # highest request id already scored
+        self.truncated = False # some candidates didn't fit in the pool
+        self.dropped = -np.inf # best score of a candidate left out, an upper bound of its score now
+        # provider profile, read once per pool
+        user = User.query.get(provider_id)
+        comuna = Comuna.query.get(user.comuna_id) if user.comuna_id is not None else None
+        self.comuna_id = comuna.id if comuna is not None else None
+        # comunas of the provider's region, read here: requests can't be joined with comuna when sharded
+        self.region_comunas = np.array([comuna_id for comuna_id, in db.session.query(Comuna.id).filter(
+            Comuna.region_id == comuna.region_id
+        )] if comuna is not None else [], dtype=np.int64)
+        self.affinity = category_affinity(provider_id)
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.static = np.zeros(0) # category + location part of the score
+        self.created = np.zeros(0) # epoch seconds
+        self.offers = np.zeros(0)
+        self.lock = threading.Lock()
+
+    def add(self, ids, static, created, offers, size, weights, half_life, now):
+        arrays = [np.concatenate((getattr(self, name), values)) for name, values in zip(POOL_FIELDS, (ids, static, created, offers))]
+        if len(arrays[0]) > size:
+            scores = score(arrays[1], arrays[2], arrays[3], weights, half_life, now)
+            order = np.lexsort((arrays[0], -scores)) # same order as _top
+            self.dropped = max(self.dropped, float(scores[order[size:]].max()))
+            arrays = [values[order[:size]] for values in arrays]
+            self.truncated = True
+        self.ids, self.static, self.created, self.offers = arrays
+
+    def keep(self, mask):
+        self.ids, self.static, self.created, self.offers = (getattr(self, name)[mask] for name in POOL_FIELDS)
+
+    def complete(self, scores, limit):
+        """True when the best `limit` of the pool are the best `limit` of every candidate"""
+        if not self.truncated:
+            return True
+        return len(scores) >= limit and -np.partition(-scores, limit - 1)[limit - 1] >= self.dropped
+
+
+class FeedCache:
+    """LRU of FeedPool per provider id"""
+    def __init__(self, size):
+        self.size = size
+        self._pools = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, provider_id):
+        with self._lock:
+            pool = self._pools.get(provider_id)
+            if pool is not None:
+                self._pools.move_to_end(provider_id)
+            return pool
+
+    def put(self, provider_id, pool):
+        with self._lock:
+            self._pools[provider_id] = pool
+            self._pools.move_to_end(provider_id)
+            while len(self._pools) > self.size:
+                self._pools.popitem(last=False)
+
+
+def init_feed(app):
+    app.extensions['feed_cache'] = FeedCache(app.config['FEED_CACHE_SIZE'])
+
+
+def _import_numpy():
+    global np
+    if np is None:
+        import numpy
+        np = numpy
+
+
+def score(static, created, offers, weights, half_life, now):
+    age_days = np.maximum(now - created, 0) / 86400.0
+    return static + weights['recency'] * np.power(0.5, age_days / half_life) + weights['competition'] / (1.0 + offers)
+
+
+def category_affinity(provider_id):
+    """array indexed by category id, 1 for the provider's best category"""
+    request_t = Request.__table__
+    size = (db.session.query(func.max(Category.id)).scalar() or 0) + 1
+    affinity = np.zeros(size)
+    declared = db.session.execute(
+        select([provider_category.c.category_id]).where(provider_category.c.provider_id == provider_id)
+    )
+    for category_id, in declared:
+        affinity[category_id] += 1.0
+    # history: each past offer and contract in a category counts too, contracts more
+    for model, join_on, weight in (
+        (Offer, Offer.__table__.c.request_id, 0.2),
+        (Contract, Contract.__table__.c.service_id, 0.5)
+    ):
+        table = model.__table__
+        rows = db.session.execute(
+            select([request_t.c.category_id, func.count()])
+            .select_from(table.join(request_t, join_on == request_t.c.id))
+            .where(table.c.provider_id == provider_id)
+            .group_by(request_t.c.category_id)
+        )
+        for category_id, count in rows:
+            if category_id is not None:
+                affinity[category_id] += weight * count
+    top = affinity.max()
+    return affinity / top if top > 0 else affinity
+
+
+def _offer_counts(request_t):
+    offer_t = Offer.__table__
+    return select([func.count()]).where(and_(
+        offer_t.c.request_id == request_t.c.id, offer_t.c.status == 'active'
+    )).as_scalar() # ix_offer_request_status
+
+
+def _scan(pool, provider_id, config, now, condition=None):
+    """
+    scores the active requests created after the pool's last one (or matching `condition`), in
+    batches, and adds the best ones to it
+    """
+    affinity = pool.affinity
+    weights, half_life = config['FEED_WEIGHTS'], config['FEED_RECENCY_HALF_LIFE_DAYS']
+    request_t, offer_t = Request.__table__, Offer.__table__
+
+    offered = select([offer_t.c.request_id]).where(offer_t.c.provider_id == provider_id)
+    query = select([
+        request_t.c.id, request_t.c.category_id, request_t.c.comuna_id, request_t.c.creation_date, _offer_counts(request_t)
+    ]).where(and_(
+        request_t.c.service_status == 'active',
+        request_t.c.id > pool.last_id if condition is None else condition,
+        request_t.c.employer_id != provider_id,
+        request_t.c.id.notin_(offered)
+    )).order_by(request_t.c.id)
+
+    result = db.session.execute(query)
+    while True:
+        rows = result.fetchmany(config['FEED_BATCH_SIZE'])
+        if not rows:
+            break
+        ids, categories, comunas, created, offers = zip(*rows)
+        ids = np.array(ids, dtype=np.int64)
+        categories = np.array([c if c is not None and c < len(affinity) else 0 for c in categories], dtype=np.int64)
+        comunas = np.array([c or 0 for c in comunas], dtype=np.int64)
+        created = np.array([d.timestamp() if d is not None else 0 for d in created])
+
+        proximity = np.zeros(len(ids))
+        if pool.comuna_id is not None:
+            proximity = np.where(comunas == pool.comuna_id, 1.0, np.where(np.isin(comunas, pool.region_comunas), 0.5, 0.0))
+        static = weights['category'] * affinity[categories] + weights['location'] * proximity
+        pool.add(ids, static, created, np.array(offers, dtype=float), config['FEED_POOL_SIZE'], weights, half_life, now)
+        pool.last_id = max(pool.last_id, int(ids[-1]))
+
+
+def _rescan(pool, provider_id, config, now):
+    """scores again the requests already seen whose score may have gone up since the last read"""
+    request_t, offer_t = Request.__table__, Offer.__table__
+    since = pool.checked_at - timedelta(seconds=config['FEED_SETTLE_SECONDS'])
+    pool.checked_at = datetime.fromtimestamp(now)
+    changed = {request_id for request_id, in db.session.execute(select([request_t.c.id]).where(and_(
+        request_t.c.updated_date >= since, request_t.c.id <= pool.last_id
+    )))} # edited or reactivated
+    changed.update(request_id for request_id, in db.session.execute(select([offer_t.c.request_id]).where(and_(
+        offer_t.c.updated_date >= since, offer_t.c.status != 'active'
+    )))) # one active offer less
+    changed.discard(None)
+    if changed:
+        pool.keep(~np.isin(pool.ids, list(changed)))
+        _scan(pool, provider_id, config, now, request_t.c.id.in_(changed))
+
+
+def _refresh(pool, provider_id):
+    """drops the requests of the pool closed or offered on since, and re-reads their offer counts"""
+    if not len(pool.ids):
+        return
+    request_t, offer_t = Request.__table__, Offer.__table__
+    rows = dict(db.session.execute(
+        select([request_t.c.id, _offer_counts(request_t)]).where(and_(
+            request_t.c.id.in_(pool.ids.tolist()),
+            request_t.c.service_status == 'active'
+        ))
+    ).fetchall())
+    offered = {request_id for request_id, in db.session.execute(
+        select([offer_t.c.request_id]).where(and_(
+            offer_t.c.provider_id == provider_id, offer_t.c.request_id.in_(pool.ids.tolist())
+        ))
+    )}
+    mask = np.array([i in rows and i not in offered for i in pool.ids.tolist()], dtype=bool)
+    pool.keep(mask)
+    pool.offers = np.array([rows[i] for i in pool.ids.tolist()], dtype=float)
+
+
+def ranked_requests(provider_id, limit):
+    """[(request_id, score)] best first"""
+    _import_numpy()
+    config = current_app.config
+    cache = current_app.extensions['feed_cache']
+    now = time.time()
+    pool = cache.get(provider_id)
+    if pool is not None and time.monotonic() - pool.built_at <= config['FEED_CACHE_SECONDS']:
+        with pool.lock:
+            _scan(pool, provider_id, config, now) # requests created since the last read
+            _rescan(pool, provider_id, config, now)
+            _refresh(pool, provider_id)
+            scores = _scores(pool, config, now)
+            if pool.complete(scores, limit):
+                return _top(pool, scores, limit)
+    # first read, expired, or a candidate left out may now be in the top: score every candidate again
+    pool = FeedPool(provider_id)
+    with pool.lock:
+        _scan(pool, provider_id, config, now)
+        cache.put(provider_id, pool)
+        return _top(pool, _scores(pool, config, now), limit)
+
+
+def _scores(pool, config, now):
+    return score(pool.static, pool.created, pool.offers, config['FEED_WEIGHTS'], config['FEED_RECENCY_HALF_LIFE_DAYS'], now)
+
+
+def _top(pool, scores, limit):
+    order = np.lexsort((pool.ids, -scores))[:limit] # ties: oldest request first
+    return [(int(pool.ids[i]), round(float(scores[i]), 4)) for i in order]
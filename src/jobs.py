@@ -0,0 +1,330 @@
+"""
+Background jobs for the side effects of a write (ej: recomputing scores), so the endpoint
+answers as soon as its transaction commits.
+
+    @job('refresh-score')
+    def refresh_score(role, user_id):
+        ...
+
+    enqueue_after_commit('refresh-score', 'provider', 12)
+
+Jobs run in a pool of JOBS_WORKERS threads of each web worker, each one in its own app context
+and DB session. A failing job is retried up to JOBS_MAX_RETRIES times, waiting
+JOBS_RETRY_BACKOFF * 2 ** attempt seconds. Jobs must be idempotent: a retried or recovered job
+may run twice. Arguments must be JSON serializable.
+
+JOBS_BACKEND:
+    'memory': jobs are pushed to an in-process queue when the transaction commits. Queued jobs
+        are lost if the worker dies.
+    'database': jobs are rows of the job table (models.QueuedJob), inserted in the same
+        transaction as the change. Any worker runs them. A job left running by a dead worker
+        is queued again after JOBS_TIMEOUT seconds.
+
+The threads are started on the first request or enqueue of each process, never in the gunicorn
+master (preload_app). On exit, the workers get JOBS_SHUTDOWN_TIMEOUT seconds to finish
+the queue.
+"""
+import atexit
+import heapq
+import itertools
+import json
+import os
+import threading
+import time
+import traceback
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import and_, event, select
+
+from models import db, QueuedJob
+from routing import RoutingSession
+
+JOBS = {} # name -> function, filled by @job
+
+
+def job(name):
+    def decorator(fn):
+        JOBS[name] = fn
+        return fn
+    return decorator
+
+
+class Task:
+    __slots__ = ('id', 'name', 'args', 'attempts')
+
+    def __init__(self, name, args, attempts=0, id=None):
+        self.id, self.name, self.args, self.attempts = id, name, args, attempts
+
+
+class MemoryBackend:
+    """heap of (run at, sequence, task), ordered by the time each task can run"""
+    def __init__(self):
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self.claimed = 0 # popped and not finished yet
+
+    def push(self, task, delay=0):
+        with self._cond:
+            heapq.heappush(self._heap, (time.monotonic() + delay, next(self._seq), task))
+            self._cond.notify()
+
+    def claim(self, timeout):
+        with self._cond:
+            run_at = self._heap[0][0] if self._heap else None
+            now = time.monotonic()
+            if run_at is None or run_at > now:
+                self._cond.wait(timeout if run_at is None else min(timeout, run_at - now))
+                if not self._heap or self._heap[0][0] > time.monotonic():
+                    return None
+            task = heapq.heappop(self._heap)[2]
+            task.attempts += 1
+            self.claimed += 1
+            return task
+
+    def retry(self, task, delay, error):
+        with self._cond:
+            self.claimed -= 1
+        self.push(task, delay)
+
+    def done(self, task):
+        with self._cond:
+            self.claimed -= 1
+
+    def fail(self, task, error):
+        self.done(task)
+
+    def wake(self):
+        with self._cond:
+            self._cond.notify_all()
+
+    def depth(self):
+        return len(self._heap)
+
+
+class DatabaseBackend:
+    """
+    job table as queue. A worker claims the oldest due job with an UPDATE guarded by
+    status = 'queued', if another worker got it first the UPDATE changes no row.
+    """
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self._table = QueuedJob.__table__
+        self._recovered_at = 0
+        self._wakeup = threading.Event()
+
+    def push(self, task, delay=0):
+        # own transaction, the caller's session may have uncommitted changes
+        with db.engine.begin() as connection:
+            connection.execute(self._table.insert().values(
+                name=task.name, args=json.dumps(task.args), status='queued', attempts=0,
+                run_after=datetime.now() + timedelta(seconds=delay), created_date=datetime.now()
+            ))
+
+    def row(self, task, delay=0):
+        return QueuedJob(
+            name=task.name, args=json.dumps(task.args),
+            run_after=datetime.now() + timedelta(seconds=delay)
+        )
+
+    def _recover(self):
+        # jobs of dead workers, running for longer than any job should
+        t = self._table
+        db.session.execute(t.update().where(and_(
+            t.c.status == 'running',
+            t.c.started_date < datetime.now() - timedelta(seconds=self.timeout)
+        )).values(status='queued'))
+        db.session.commit()
+        self._recovered_at = time.monotonic()
+
+    def claim(self, timeout):
+        t = self._table
+        if time.monotonic() - self._recovered_at > self.timeout / 2:
+            self._recover()
+        now = datetime.now()
+        for job_id, in db.session.execute(
+            select([t.c.id]).where(and_(t.c.status == 'queued', t.c.run_after <= now))
+            .order_by(t.c.run_after, t.c.id).limit(5)
+        ).fetchall():
+            claimed = db.session.execute(t.update().where(and_(t.c.id == job_id, t.c.status == 'queued')).values(
+                status='running', started_date=now, attempts=t.c.attempts + 1
+            )).rowcount
+            db.session.commit()
+            if claimed:
+                row = db.session.execute(select([t.c.name, t.c.args, t.c.attempts]).where(t.c.id == job_id)).first()
+                db.session.commit()
+                return Task(row.name, json.loads(row.args), row.attempts, id=job_id)
+        db.session.commit()
+        self._wakeup.wait(timeout)
+        self._wakeup.clear()
+        return None
+
+    def retry(self, task, delay, error):
+        db.session.execute(self._table.update().where(self._table.c.id == task.id).values(
+            status='queued', run_after=datetime.now() + timedelta(seconds=delay), last_error=error
+        ))
+        db.session.commit()
+
+    def done(self, task):
+        db.session.execute(self._table.delete().where(self._table.c.id == task.id))
+        db.session.commit()
+
+    def fail(self, task, error):
+        db.session.execute(self._table.update().where(self._table.c.id == task.id).values(
+            status='failed', last_error=error
+        ))
+        db.session.commit()
+
+    def wake(self):
+        self._wakeup.set()
+
+    def depth(self):
+        return db.session.query(QueuedJob).filter(QueuedJob.status == 'queued').count()
+
+
+class JobQueue:
+    def __init__(self, app):
+        config = app.config
+        self.app = app
+        self.workers = config['JOBS_WORKERS']
+        self.max_retries = config['JOBS_MAX_RETRIES']
+        self.backoff = config['JOBS_RETRY_BACKOFF']
+        self.poll = config['JOBS_POLL_SECONDS']
+        self.shutdown_timeout = config['JOBS_SHUTDOWN_TIMEOUT']
+        if config['JOBS_BACKEND'] == 'memory':
+            self.backend = MemoryBackend()
+        elif config['JOBS_BACKEND'] == 'database':
+            self.backend = DatabaseBackend(config['JOBS_TIMEOUT'])
+        else:
+            raise ValueError('unknown JOBS_BACKEND: %s' % config['JOBS_BACKEND'])
+        self.counters = dict.fromkeys(('enqueued', 'running', 'done', 'retried', 'failed'), 0)
+        self._pid = None
+        self._stopping = False
+        self._lock = threading.Lock()
+
+    def ensure_started(self):
+        """starts the threads once per process, a forked worker starts its own"""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                for i in range(self.workers):
+                    threading.Thread(target=self._work, name='job-worker-%s' % i, daemon=True).start()
+                atexit.register(self.stop)
+
+    def push(self, task):
+        self.ensure_started()
+        if isinstance(self.backend, MemoryBackend):
+            self.backend.push(task)
+        else:
+            self.backend.wake()
+        self._count('enqueued')
+
+    def _count(self, name, delta=1):
+        with self._lock:
+            self.counters[name] += delta
+
+    def _work(self):
+        while not self._stopping:
+            with self.app.app_context():
+                try:
+                    task = self.backend.claim(self.poll)
+                    if task is not None:
+                        self._run(task)
+                except Exception: # the DB may be down, don't let the thread die
+                    self.app.logger.exception('job worker error')
+                    time.sleep(self.poll)
+                finally:
+                    db.session.remove()
+
+    def _run(self, task):
+        self._count('running')
+        try:
+            JOBS[task.name](*task.args)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            error = traceback.format_exc()
+            if task.attempts <= self.max_retries:
+                self.backend.retry(task, self.backoff * 2 ** (task.attempts - 1), error)
+                self._count('retried')
+            else:
+                self.app.logger.error('job %s%r failed after %s attempts\n%s', task.name, task.args, task.attempts, error)
+                self.backend.fail(task, error)
+                self._count('failed')
+        else:
+            self.backend.done(task)
+            self._count('done')
+        finally:
+            self._count('running', -1)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters, workers=self.workers if self._pid == os.getpid() else 0)
+        stats['depth'] = self.backend.depth()
+        return stats
+
+    def wait_idle(self, timeout):
+        """waits until no job is queued nor running (memory backend), returns False on timeout"""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.backend.depth() == 0 and self.backend.claimed == 0:
+                return True
+            time.sleep(0.01)
+        return False
+
+    def stop(self):
+        if isinstance(self.backend, MemoryBackend):
+            self.wait_idle(self.shutdown_timeout)
+        self._stopping = True
+        self.backend.wake()
+
+
+def init_jobs(app):
+    queue = JobQueue(app)
+    app.extensions['job_queue'] = queue
+    app.before_request(queue.ensure_started)
+
+
+def job_queue():
+    return current_app.extensions['job_queue']
+
+
+def enqueue(name, *args):
+    """runs the job as soon as a worker is free, without waiting for any transaction"""
+    queue = job_queue()
+    task = Task(name, list(args))
+    if isinstance(queue.backend, DatabaseBackend):
+        queue.backend.push(task)
+    queue.push(task)
+
+
+def enqueue_after_commit(name, *args):
+    """runs the job once the current transaction commits, never if it's rolled back"""
+    session = db.session()
+    task = Task(name, list(args))
+    queue = session.app.extensions['job_queue']
+    if isinstance(queue.backend, DatabaseBackend):
+        session.add(queue.backend.row(task)) # committed together with the change
+    session.info.setdefault('pending_jobs', []).append(task)
+
+
+def _on_commit(session):
+    if session.transaction.nested: # a savepoint released, the transaction is still open
+        return
+    tasks = session.info.pop('pending_jobs', None)
+    if tasks:
+        queue = session.app.extensions['job_queue']
+        for task in tasks:
+            queue.push(task)
+
+
+def _on_rollback(session, previous_transaction):
+    if previous_transaction.parent is None:
+        session.info.pop('pending_jobs', None)
+
+
+event.listen(RoutingSession, 'after_commit', _on_commit)
+event.listen(RoutingSession, 'after_soft_rollback', _on_rollback)
@@ -1,103 +1,294 @@
 """
 This module takes care of starting the API Server, Loading the DB and Adding the endpoints
 """
-from functools import wraps
-from datetime import timedelta
-import os, re
-from flask import Flask, request, jsonify, url_for
-from flask_migrate import Migrate
-from flask_swagger import swagger
+from datetime import datetime, timedelta
+import os
+from flask import Flask, Blueprint, request, jsonify, url_for, current_app
 from flask_cors import CORS
-from utils import APIException, generate_sitemap
+from config import load_config
+from archive import archive_command
+from export import export_command
+from routing import init_replicas
+from sharding import init_shards, shards_cli, shard_resolver, use_comuna_shard, fan_out, route_to_row
+from ratelimit import init_rate_limiting, rate_limit, json_field, jwt_identity
+from utils import APIException, generate_sitemap, parse_date
+from validation import (
+    validate_json, NAME_SCHEMA, COMUNA_SCHEMA, CATEGORY_SCHEMA, REGISTER_SCHEMA, LOGIN_SCHEMA,
+    PROFILE_SCHEMA, PROVIDER_CATEGORIES_SCHEMA, OFFER_SCHEMA, SERVICE_REQUEST_SCHEMA, CONTRACT_SCHEMA,
+    SERVICE_REQUEST_UPDATE_SCHEMA, SERVICE_REQUEST_STATUS_SCHEMA, REVIEW_SCHEMA, BATCH_SCHEMA
+)
 from models import (
     db, User, Employer, Provider, Category, Contract, Request, 
-    Offer, Review, Region, Comuna
+    Offer, Review, Region, Comuna, ReviewSummary, DeletionTask
 )
+from werkzeug.exceptions import RequestEntityTooLarge
 from sqlalchemy.exc import IntegrityError
-from flask_jwt_extended import (
-    JWTManager, jwt_required, create_access_token, get_jwt_identity, 
-    verify_jwt_in_request, get_jwt_claims, get_raw_jwt, jwt_optional
+from sqlalchemy.orm.exc import StaleDataError
+from sqlalchemy import func
+from sqlalchemy.orm import selectinload
+from flask_jwt_extended import JWTManager, create_access_token, get_jwt_identity, get_raw_jwt
+from auth import init_auth, jwt_required, jwt_admin_required
+from revocation import init_revocation, revocation_list
+from diagnostics import init_diagnostics, request_log, check_database, worker_info
+from batch import init_batch, run_batch, batch_cost
+from audit import init_audit, audit, audit_log, query_events
+from reviews import add_review_to_summary, rebuild_summaries_command
+from cache import init_response_cache, cached_response, mark_stale
+from jobs import init_jobs, job_queue, enqueue_after_commit
+from feed import init_feed, ranked_requests
+from media import init_media, receive_image, media_url, thumbnail_name, send_media
+from deletions import start_deletion
+from versioning import PreconditionFailed, check_if_match, with_etag, bump_version
+from metrics import GROUP_BY as METRICS_GROUP_BY, activity, refresh_if_stale, rollup_command
+from snapshot import (
+    init_reference_snapshot, snapshot_command, region_comunas, serialized_all, region_id_by_name,
+    comuna_id_by_name, exists as reference_exists
 )
 
-app = Flask(__name__)
-app.url_map.strict_slashes = False
-app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DB_CONNECTION_STRING')
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['JWT_SECRET_KEY'] = '1478520.Lucena1953'
-jwt = JWTManager(app)
-MIGRATE = Migrate(app, db)
-db.init_app(app)
-CORS(app)
-
-
-def jwt_admin_required(fn):
-    @wraps(fn)
-    def wrapper(*args, **kwargs):
-        verify_jwt_in_request()
-        claims = get_jwt_claims()
-        if claims['role'] != 'admin':
-            return jsonify({'msg': 'Admins Only'}), 401
-        else:
-            return fn(*args, **kwargs)
-    return wrapper
+api = Blueprint('api', __name__)
+jwt = JWTManager()
+
+
+def create_app(config=None):
+    """
+    Application factory, config can be a name from config.CONFIGS ('production', 'testing'...),
+    a config class or a dict of overrides. Migration tooling is only imported when
+    ENABLE_MIGRATIONS is set (config 'cli'), web workers don't need it.
+    """
+    app = Flask(__name__)
+    app.url_map.strict_slashes = False
+    app.config.from_object(load_config(config))
+    if isinstance(config, dict):
+        app.config.update(config)
+
+    db.init_app(app)
+    init_diagnostics(app) # first, times the rest of the before_request hooks too
+    init_replicas(app)
+    init_shards(app)
+    init_rate_limiting(app)
+    jwt.init_app(app)
+    init_auth(app)
+    init_revocation(app)
+    init_response_cache(app)
+    init_jobs(app)
+    init_audit(app)
+    init_media(app)
+    init_feed(app)
+    init_batch(app)
+    init_reference_snapshot(app)
+    CORS(app)
+
+    if app.config['ENABLE_MIGRATIONS']:
+        from flask_migrate import Migrate
+        Migrate(app, db)
+
+    app.register_blueprint(api)
+    if app.config['API_SPEC_ENABLED']:
+        app.add_url_rule('/spec', 'spec', get_spec)
+    app.cli.add_command(archive_command)
+    app.cli.add_command(export_command)
+    app.cli.add_command(rebuild_summaries_command)
+    app.cli.add_command(shards_cli)
+    app.cli.add_command(snapshot_command)
+    app.cli.add_command(rollup_command)
+    return app
+
+
+def dispose_engines(app):
+    """
+    Drops every pooled connection of the app engines. Must run in each worker after
+    fork (gunicorn --preload), sockets opened by the master can't be shared.
+    """
+    with app.app_context():
+        db.engine.dispose()
+    if 'replica_router' in app.extensions:
+        app.extensions['replica_router'].dispose()
+    if 'shard_resolver' in app.extensions:
+        app.extensions['shard_resolver'].dispose()
+
+
+def get_spec():
+    """
+    swagger spec of the api, generated from the endpoints docstrings. Only routed when
+    API_SPEC_ENABLED is set, see create_app().
+    * PUBLIC ENDPOINT *
+    """
+    from flask_swagger import swagger # imported on demand, only this endpoint uses it
+    return jsonify(swagger(current_app)), 200
 
 
 @jwt.user_claims_loader
 def add_claims_to_access_token(user):
+    # id: key of the user's cached responses, see cache.py
     if user.role == 'admin':
-        return {'role': 'admin'}
+        return {'role': 'admin', 'id': user.id}
     else:
-        return {'role': 'client'}
+        return {'role': 'client', 'id': user.id}
 
 
 @jwt.user_identity_loader
 def user_identity_lookup(user):
     return user.email
 
+
+@jwt.token_in_blacklist_loader
+def check_if_token_revoked(decoded_token):
+    return revocation_list().is_revoked(decoded_token)
+
 # Handle/serialize errors like a JSON object
-@app.errorhandler(APIException)
+@api.app_errorhandler(APIException)
 def handle_invalid_usage(error):
     return jsonify(error.to_dict()), error.status_code
 
 
-@app.route('/')
+# a concurrent request updated the row first, see versioning.py
+@api.app_errorhandler(StaleDataError)
+def handle_stale_data(error):
+    db.session.rollback()
+    return jsonify({'Error': 'the record was modified by another request, reload it'}), 412
+
+
+# If-Match of an outdated version, see versioning.py
+@api.app_errorhandler(PreconditionFailed)
+def handle_precondition_failed(error):
+    return jsonify({'Error': str(error)}), 412
+
+
+@api.route('/')
 def get_site_conf():
     """
     This is a public endpoint. Returns all categories, stats and configurations needed for the front-end app.
     this will be requested for the web app to configure at the start.
     * PUBLIC ENDPOINT *
     """
-    top_categories = Category.query.all()
-    top_categories.sort(reverse=True, key=lambda x: len(x.requests))
+    # con shards cada base de datos se consulta en paralelo y se suman los resultados
+    per_category, offers, contracts = {}, 0, 0
+    for category_counts, offer_count, contract_count in fan_out(_region_stats):
+        for category_id, count in category_counts:
+            per_category[category_id] = per_category.get(category_id, 0) + count
+        offers += offer_count
+        contracts += contract_count
+
+    top_categories = serialized_all(Category)
+    top_categories.sort(reverse=True, key=lambda x: per_category.get(x['id'], 0))
     top_categories[4:] = [] # se eliminan elementos del 4 en adelante para crear el top 4
     response_body = {
-            'top_categories': list(map(lambda x: dict({**x.serialize(), 'requests': len(x.requests)}), top_categories)),
-            'contracts': Contract.query.count(),
-            'offers': Offer.query.count(),
+            'top_categories': list(map(lambda x: dict({**x, 'requests': per_category.get(x['id'], 0)}), top_categories)),
+            'contracts': contracts,
+            'offers': offers,
             'users': User.query.count(),
-            'requests': Request.query.count()
+            'requests': sum(per_category.values())
         }
     return jsonify({'stats': response_body}), 200
 
 
-@app.route('/admin/region/create', methods=['POST']) #ready!
+def _region_stats():
+    """(requests per category, offers, contracts) of one database"""
+    return (
+        db.session.query(Request.category_id, func.count()).group_by(Request.category_id).all(),
+        Offer.query.count(),
+        Contract.query.count()
+    )
+
+
+@api.route('/healthz')
+def healthz():
+    """
+    el proceso está vivo y atiende requests, no consulta la base de datos.
+    * PUBLIC ENDPOINT *
+    """
+    return jsonify({'status': 'ok', 'worker': worker_info()}), 200
+
+
+@api.route('/readyz')
+def readyz():
+    """
+    listo para recibir tráfico: un SELECT 1 a la base de datos (y a cada shard) responde
+    dentro de READY_DB_BUDGET_MS y el pool de conexiones no está agotado. 503 si no.
+    * PUBLIC ENDPOINT *
+    """
+    budget = current_app.config['READY_DB_BUDGET_MS']
+    ok, details = check_database(db.engine, budget)
+    body = {'database': details, 'worker': worker_info()}
+    shards = current_app.extensions.get('shard_resolver')
+    if shards is not None:
+        body['shards'] = {}
+        for region_id, engine in sorted(shards.engines.items()):
+            shard_ok, body['shards'][region_id] = check_database(engine, budget)
+            ok = ok and shard_ok
+    body['status'] = 'ok' if ok else 'unavailable'
+    return jsonify(body), 200 if ok else 503
+
+
+@api.route('/debug/slow', methods=['GET'])
 @jwt_admin_required
-def create_region():
+def debug_slow_requests():
+    """
+    requests más lentos entre los últimos DEBUG_RECENT_REQUESTS de este worker, con su número
+    de consultas SQL y la consulta más repetida (un N+1 aparece como la misma consulta n veces).
+    parametros opcionales en url: ?limit=20&path=/find
+    ENDPOINT PRIVADO
+    """
+    log = request_log()
+    limit = max(min(request.args.get('limit', 20, type=int), 200), 1)
+    return jsonify({
+        'slowest': log.slowest(limit, request.args.get('path')),
+        'endpoints': log.by_endpoint(),
+        'worker': worker_info()
+    }), 200
 
-    if not request.is_json:
-        return jsonify({'Error': 'Missing JSON in request'}), 400
 
-    name = request.json.get('name')
-    if not name:
-        return jsonify({'Error': 'Missing name parameter in request'}), 400
+@api.route('/debug/stacks', methods=['GET'])
+@jwt_admin_required
+def debug_stacks():
+    """
+    stack de cada thread de este worker, con el request que está atendiendo y hace cuánto.
+    ENDPOINT PRIVADO
+    """
+    return jsonify({'threads': request_log().stacks(), 'worker': worker_info()}), 200
+
 
+@api.route('/batch', methods=['POST'])
+@rate_limit('batch', cost=batch_cost)
+@validate_json(BATCH_SCHEMA)
+def batch_requests():
+    """
+    varias llamadas a la api en un solo request (máximo BATCH_MAX_REQUESTS), ej: las del inicio
+    de la app. Se usa el header Authorization del batch para todas. Los GET consecutivos se
+    ejecutan en paralelo, las escrituras una a una y en orden.
+    requerido:
+    {
+        "requests": [
+            {"method": "GET", "path": "/user/get_profile"},
+            {"method": "PUT", "path": "/offer/3", "body": {"description": "..."}, "headers": {}}
+        ]
+    }
+    return json:
+    {
+        "responses": [{"status": 200, "body": {...}}, ...] #en el mismo orden
+    }
+    * PUBLIC ENDPOINT *
+    """
+    items = request.json['requests']
+    if len(items) > current_app.config['BATCH_MAX_REQUESTS']:
+        return jsonify({'Error': 'too many requests in batch, max %s' % current_app.config['BATCH_MAX_REQUESTS']}), 400
+    return jsonify({'responses': run_batch(items)}), 200
+
+
+@api.route('/admin/region/create', methods=['POST']) #ready!
+@jwt_admin_required
+@validate_json(NAME_SCHEMA)
+def create_region():
+
+    name = request.json.get('name')
     try:
         new_region = Region(name=name)
         db.session.add(new_region)
+        audit('region.create', new_region, name=name)
         db.session.commit()
         return jsonify({
             'msg': 'new region crated',
-            'regions': list(map(lambda x: x.serialize(), Region.query.all())),
+            'regions': list(map(lambda x: x.serialize(), Region.active().all())),
         }), 201
         
     except IntegrityError:
@@ -105,40 +296,58 @@ def create_region():
         return jsonify({'Error': 'region alredy exists'}), 400
 
 
-@app.route('/admin/region/<int:reg_id>', methods=['PUT', 'DELETE']) #ready!
+def _deletion_target(model, entity_id):
+    """?reassign_to=<id> of the admin DELETE endpoints, returns (id or None, error response or None)"""
+    if 'reassign_to' not in request.args:
+        return None, None
+    target_id = request.args.get('reassign_to', type=int)
+    if target_id is None or target_id == entity_id:
+        return None, (jsonify({'Error': 'invalid reassign_to'}), 400)
+    target = model.active().filter(model.id == target_id).first()
+    if target is None:
+        return None, (jsonify({'Error': '%s %s not found' % (model.__name__, target_id)}), 404)
+    if model is not Category and shard_resolver() is not None: # requests can't change of database
+        region_id = entity_id if model is Region else Comuna.query.get(entity_id).region_id
+        if region_id != (target.id if model is Region else target.region_id):
+            return None, (jsonify({'Error': 'reassign_to must be in the same region while sharding is on'}), 409)
+    return target_id, None
+
+
+@api.route('/admin/region/<int:reg_id>', methods=['PUT', 'DELETE']) #ready!
 @jwt_admin_required
+@validate_json(NAME_SCHEMA, methods=['PUT'])
 def handle_regions(reg_id=None):
     """
     Edit regions stored in database. This is visible only for de Administrator
     ENDPOINT PRIVADO
     """
-    region_query = Region.query.get(reg_id)
+    region_query = Region.active().filter(Region.id == reg_id).first()
 
     if region_query is None:
         return jsonify({'Error': 'Region %s not found' %reg_id}), 404
 
-    if request.method == 'DELETE': # delete 1 Region
-        db.session.delete(region_query)
+    if request.method == 'DELETE': # delete 1 Region, its comunas move to ?reassign_to=<region_id> or are deleted too
+        reassign_to, error = _deletion_target(Region, reg_id)
+        if error is not None:
+            return error
+        task = start_deletion(region_query, reassign_to)
+        audit('region.delete', region_query, name=region_query.name, reassign_to=reassign_to)
         db.session.commit()
         return jsonify({
             'msg': 'region deleted',
-            'regions': list(map(lambda x: x.serialize(), Region.query.all()))
+            'regions': list(map(lambda x: x.serialize(), Region.active().all())),
+            'task': task.serialize()
         }), 200
     
     if request.method == 'PUT': # update Region data
-        if not request.is_json:
-            return jsonify({'Error': 'Missing JSON in request'}), 400
-        
         name = request.json.get('name')
-        if not name:
-            return jsonify({'Error': 'Missing name parameter in request'}), 400
-
         try:
+            audit('region.update', region_query, name=name, previous=region_query.name)
             region_query.name = name
             db.session.commit()
             return jsonify({
                 'msg': 'region updated',
-                'regions': list(map(lambda x: x.serialize(), Region.query.all()))
+                'regions': list(map(lambda x: x.serialize(), Region.active().all()))
             }), 200
 
         except IntegrityError:
@@ -148,31 +357,26 @@ def handle_regions(reg_id=None):
     raise APIException("Invalid Method", status_code=400)
 
 
-@app.route('/admin/comuna/create', methods=['POST']) #ready!
+@api.route('/admin/comuna/create', methods=['POST']) #ready!
 @jwt_admin_required
+@validate_json(COMUNA_SCHEMA)
 def create_comuna():
     
-    if not request.is_json:
-        return jsonify({'Error': 'Missing JSON in request'}), 400
-
     name = request.json.get('name')
-    if not name:
-        return jsonify({'Error': 'Missing name parameter in request'}), 400
     region_name = request.json.get('region')
-    if not region_name:
-        return jsonify({'Error': 'Missing region parameter in request'}), 400
 
-    region_query = Region.query.filter_by(name=region_name).first()
-    if region_query is None:
+    region_id = region_id_by_name(region_name)
+    if region_id is None:
         return jsonify({'Error': 'Region %s not found' %region_name}), 404
 
     try:
-        new_comuna = Comuna(name=name, region=region_query)
+        new_comuna = Comuna(name=name, region_id=region_id)
         db.session.add(new_comuna)
+        audit('comuna.create', new_comuna, name=name, region=region_name)
         db.session.commit()
         return jsonify({
             'msg': 'new comuna crated',
-            'regions': list(map(lambda x: x.serialize(), Region.query.all()))
+            'regions': list(map(lambda x: x.serialize(), Region.active().all()))
         }), 201
         
     except IntegrityError:
@@ -180,40 +384,41 @@ def create_comuna():
         return jsonify({'Error': 'comuna alredy exists'}), 400
 
 
-@app.route('/admin/comuna/<int:comuna_id>', methods=['PUT', 'DELETE']) #ready!
+@api.route('/admin/comuna/<int:comuna_id>', methods=['PUT', 'DELETE']) #ready!
 @jwt_admin_required
+@validate_json(NAME_SCHEMA, methods=['PUT'])
 def handle_comunas(comuna_id=None):
     """
     Edit comunas stored in database. This is visible only for de Administrator
     ENDPOINT PRIVADO
     """
-    comuna_query = Comuna.query.get(reg_id)
+    comuna_query = Comuna.active().filter(Comuna.id == comuna_id).first()
 
     if comuna_query is None:
-        return jsonify({'Error': 'Comuna %s not found'} %comuna_id), 404
-
-    if request.method == 'DELETE': # delete 1 comuna
-        db.session.delete(comuna_query)
+        return jsonify({'Error': 'Comuna %s not found' %comuna_id}), 404
+
+    if request.method == 'DELETE': # delete 1 comuna, its users and requests move to ?reassign_to=<comuna_id>
+        reassign_to, error = _deletion_target(Comuna, comuna_id)
+        if error is not None:
+            return error
+        task = start_deletion(comuna_query, reassign_to)
+        audit('comuna.delete', comuna_query, name=comuna_query.name, reassign_to=reassign_to)
         db.session.commit()
         return jsonify({
             'msg': 'comuna deleted',
-            'regions': list(map(lambda x: x.serialize(), Region.query.all()))
+            'regions': list(map(lambda x: x.serialize(), Region.active().all())),
+            'task': task.serialize()
         }), 200
     
     if request.method == 'PUT': # update comuna data
-        if not request.is_json:
-            return jsonify({'Error': 'Missing JSON in request'}), 400
-        
         name = request.json.get('name')
-        if not name:
-            return jsonify({'Error': 'Missing name parameter in request'}), 400
-
         try:
+            audit('comuna.update', comuna_query, name=name, previous=comuna_query.name)
             comuna_query.name = name
             db.session.commit()
             return jsonify({
                 'msg': 'comuna updated',
-                'regions': list(map(lambda x: x.serialize(), Region.query.all()))
+                'regions': list(map(lambda x: x.serialize(), Region.active().all()))
             }), 200
 
         except IntegrityError:
@@ -223,45 +428,44 @@ def handle_comunas(comuna_id=None):
     raise APIException("Invalid Method", status_code=400)
 
 
-@app.route('/admin/category/<int:cat_id>', methods=['PUT', 'DELETE']) #ready!
+@api.route('/admin/category/<int:cat_id>', methods=['PUT', 'DELETE']) #ready!
 @jwt_admin_required
+@validate_json(CATEGORY_SCHEMA, methods=['PUT'])
 def handle_categories(cat_id=None):
     """
     Get or Edit categories stored in database. This is visible only for de Administrator
     ENDPOINT PRIVADO
     """
-    category_query = Category.query.get(cat_id)
+    category_query = Category.active().filter(Category.id == cat_id).first()
     if category_query is None:
-        return jsonify({'Error': 'Category %s not found'}), 404
-
-    if request.method == 'DELETE': # delete 1 category
-        db.session.delete(category_query)
+        return jsonify({'Error': 'Category %s not found' %cat_id}), 404
+    check_if_match(category_query) # If-Match: ETag de la respuesta que la creó o actualizó
+
+    if request.method == 'DELETE': # delete 1 category, its requests and providers move to ?reassign_to=<category_id>
+        reassign_to, error = _deletion_target(Category, cat_id)
+        if error is not None:
+            return error
+        task = start_deletion(category_query, reassign_to)
+        audit('category.delete', category_query, name=category_query.name, reassign_to=reassign_to)
         db.session.commit()
         return jsonify({
             'msg': 'category deleted',
-            'categories': list(map(lambda x: x.serialize(), Category.query.all()))
+            'categories': list(map(lambda x: x.serialize(), Category.active().all())),
+            'task': task.serialize()
         }), 200
     
     if request.method == 'PUT': # update category data, need "name" and "logo" in body req.
-        if not request.is_json:
-            return jsonify({'Error': 'Missing JSON in request'}), 400
-
         name = request.json.get('name')
-        if not name:
-            return jsonify({'Error': 'Missing name parameter in request'}), 400
-
         logo = request.json.get('logo')
-        if not logo:
-            return jsonify({'Error': 'Missing logo parameter in request'}), 400
-
         try:
+            audit('category.update', category_query, name=name, logo=logo, previous=category_query.name)
             category_query.name = name
             category_query.logo = logo
             db.session.commit()
-            return jsonify({
+            return with_etag((jsonify({
                 'msg': 'category updated',
-                'categories': list(map(lambda x: x.serialize(), Category.query.all()))
-            }), 200
+                'categories': list(map(lambda x: x.serialize(), Category.active().all()))
+            }), 200), category_query)
 
         except IntegrityError:
             db.session.rollback()
@@ -270,40 +474,154 @@ def handle_categories(cat_id=None):
     raise APIException("Invalid Method", status_code=400)
 
 
-@app.route('/admin/category/create', methods = ['POST']) #ready!
+@api.route('/admin/category/create', methods = ['POST']) #ready!
 @jwt_admin_required
+@validate_json(CATEGORY_SCHEMA)
 def create_category():
     """
     create new category as Administrator.
     need "name" and "logo" in body request
     ENDPOINT PRIVADO
     """
-    if not request.is_json:
-        return jsonify({'Error': 'Missing JSON in request'}), 400
-
     name = request.json.get('name')
-    if not name:
-        return jsonify({'Error': 'Missing name parameter in request'}), 400
-
     logo = request.json.get('logo')
-    if not logo:
-        return jsonify({'Error': 'Missing logo parameter in request'}), 400
-
     try:
         new_category = Category(name=name, logo=logo)
         db.session.add(new_category)
+        audit('category.create', new_category, name=name)
         db.session.commit()
-        return jsonify({
+        return with_etag((jsonify({
             'msg': 'category created',
-            'categories': list(map(lambda x: x.serialize(), Category.query.all()))
-        }), 201
+            'categories': list(map(lambda x: x.serialize(), Category.active().all()))
+        }), 201), new_category)
         
     except IntegrityError:
         db.session.rollback()
         return jsonify({'Error': 'name or logo alredy exists'}), 400
 
 
-@app.route('/registro', methods=['POST']) #ready
+@api.route('/admin/jobs', methods=['GET'])
+@jwt_admin_required
+def get_jobs_stats():
+    """
+    métricas de la cola de trabajos en segundo plano de este worker:
+    depth (en cola), running, enqueued, done, retried, failed y workers.
+    ENDPOINT PRIVADO
+    """
+    return jsonify(job_queue().stats()), 200
+
+
+@api.route('/admin/metrics/activity', methods=['GET'])
+@jwt_admin_required
+def get_activity_metrics():
+    """
+    solicitudes, ofertas y contratos creados por día, comuna y categoría (ver metrics.py).
+    parametros opcionales en url:
+        ?from=2020-01-01&to=2020-02-01&group_by=day,comuna,category&comuna=3&category=2
+    from/to: días en [from, to), por defecto los últimos METRICS_DEFAULT_DAYS.
+    group_by: combinación de day, comuna y category, por defecto day. Vacío: totales del periodo.
+    return json:
+    {
+        "from": "2020-01-01", "to": "2020-02-01", "group_by": ["day"],
+        "series": [{"day", "comuna_id", "category_id", "requests", "offers", "contracts"}, ...],
+        "updated_date": fecha de la última actualización de los totales
+    }
+    ENDPOINT PRIVADO
+    """
+    group_by = [name for name in request.args.get('group_by', 'day').split(',') if name]
+    if any(name not in METRICS_GROUP_BY for name in group_by) or len(set(group_by)) != len(group_by):
+        return jsonify({'Error': 'group_by must combine %s' % ', '.join(METRICS_GROUP_BY)}), 400
+
+    since, until = parse_date(request.args.get('from')), parse_date(request.args.get('to'))
+    if (request.args.get('from') and since is None) or (request.args.get('to') and until is None):
+        return jsonify({'Error': 'invalid date'}), 400
+    until = until.date() if until is not None else datetime.now().date() + timedelta(days=1)
+    since = since.date() if since is not None else until - timedelta(days=current_app.config['METRICS_DEFAULT_DAYS'])
+
+    updated = refresh_if_stale()
+    series = activity(
+        since, until, group_by,
+        comuna_id=request.args.get('comuna', type=int),
+        category_id=request.args.get('category', type=int)
+    )
+    return jsonify({
+        'from': since.isoformat(),
+        'to': until.isoformat(),
+        'group_by': group_by,
+        'series': series,
+        'updated_date': updated
+    }), 200
+
+
+@api.route('/admin/deletions/<int:task_id>', methods=['GET'])
+@jwt_admin_required
+def get_deletion_task(task_id):
+    """
+    avance de la eliminación de una región, comuna o categoría (los registros que dependen de ella
+    se actualizan en segundo plano, ver deletions.py).
+    return json:
+    {
+        "task": {"id", "entity", "entity_id", "reassign_to", "status", "total", "processed", "progress", ...}
+    }
+    ENDPOINT PRIVADO
+    """
+    task = DeletionTask.query.get(task_id)
+    if task is None:
+        return jsonify({'Error': 'deletion task %s not found' % task_id}), 404
+    return jsonify({'task': task.serialize()}), 200
+
+
+@api.route('/admin/audit', methods=['GET'])
+@jwt_admin_required
+def get_audit_events():
+    """
+    registro de cambios (auditoría), del más reciente al más antiguo.
+    parametros opcionales en url:
+        ?entity=offer&entity_id=12&actor=3&from=2020-01-01&to=2020-02-01T12:00:00&limit=100
+    para la página siguiente se envía &before=<next> de la respuesta anterior.
+    return json:
+    {
+        "events": [{"id", "date", "action", "entity", "entity_id", "actor_id", "data"}, ...],
+        "next": "2020-01-13T22:59:46.123456_345" | null,
+        "log": {"buffered", "written", "dropped", "spooled", "failed_flushes"}
+    }
+    ENDPOINT PRIVADO
+    """
+    log = audit_log()
+    if log is None:
+        return jsonify({'Error': 'audit log disabled'}), 404
+    log.flush() # the events of this worker not written yet
+
+    before = None
+    if request.args.get('before'):
+        try:
+            date, event_id = request.args['before'].rsplit('_', 1)
+            before = (datetime.strptime(date, '%Y-%m-%dT%H:%M:%S.%f'), int(event_id))
+        except ValueError:
+            return jsonify({'Error': 'invalid before'}), 400
+
+    page_size = current_app.config['AUDIT_PAGE_SIZE']
+    limit = max(min(request.args.get('limit', page_size, type=int), page_size), 1)
+    events = query_events(
+        entity_type=request.args.get('entity'),
+        entity_id=request.args.get('entity_id', type=int),
+        actor_id=request.args.get('actor', type=int),
+        since=parse_date(request.args.get('from')),
+        until=parse_date(request.args.get('to')),
+        before=before,
+        limit=limit
+    )
+    last = events[-1] if len(events) == limit else None
+    return jsonify({
+        'events': [e.serialize() for e in events],
+        'next': '%s_%s' % (last.created_date.isoformat(timespec='microseconds'), last.id) if last else None,
+        'log': log.stats()
+    }), 200
+
+
+@api.route('/registro', methods=['POST']) #ready
+@rate_limit('register')
+@validate_json(REGISTER_SCHEMA)
 def create_new_user():
     """
     * PUBLIC ENDPOINT *
@@ -318,28 +636,10 @@ def create_new_user():
         "success":"nuevo usuario registrado", 200
     }
     """
-        #Regular expression that checks a valid email
-    ereg = '^\w+([\.-]?\w+)*@\w+([\.-]?\w+)*(\.\w{2,3})+$'
-
-    if not request.is_json:
-        return jsonify({'Error':'Missing JSON in request'}), 400
-
-    email = request.json.get('email', None)
-    password = request.json.get('password', None)
-    fname = request.json.get('f_name', None)
-    lname = request.json.get('l_name', None)
-
-    if not (re.search(ereg, email)):
-        return jsonify({'Error':'Formato del Email inválido'}), 400
-    if password is None:
-        return jsonify({'Error':'No se encuentra Contraseña en request'}), 400
-    if fname is None:
-        return jsonify({'Error': 'No se encuentra primer nombre en request'}), 400
-    fname = fname.replace(" ", "").capitalize()
-
-    if lname is None: 
-        return jsonify({'Error': 'No se encuentra apellido en request'}), 400
-    lname = lname.replace(" ", "").capitalize()
+    email = request.json.get('email')
+    password = request.json.get('password')
+    fname = request.json.get('f_name').replace(" ", "").capitalize()
+    lname = request.json.get('l_name').replace(" ", "").capitalize()
 
     try:
         new_user = User(email=email, password=password, fname=fname, lname=lname)
@@ -357,29 +657,27 @@ def create_new_user():
 
     return jsonify({"success":"Nuevo usuario registrado"}), 201  # 201 = Created
 
-@app.route('/region/<region_name>/comunas', methods=['GET'])
+@api.route('/region/<region_name>/comunas', methods=['GET'])
 def get_comunas(region_name):
-    region_q = Region.query.filter(Region.name == region_name).first()
+    comunas = region_comunas(region_name)
 
-    if region_q is None:
+    if comunas is None:
         return jsonify({'Error': 'Region: %s no encontrada' %region_name}), 404
 
-    return jsonify({'comunas': list(map(lambda x: x.serialize(), region_q.comunas))})
+    return jsonify({'comunas': comunas})
 
-@app.route('/app-data', methods=['GET'])
+@api.route('/app-data', methods=['GET'])
 def app_data():
-    all_categories = Category.query.all()
-    all_regions = Region.query.all()
-    all_comunas = Comuna.query.all()
-
     response_body = {
-        'all_categories': list(map(lambda x: x.serialize(), all_categories)),
-        'all_regions': list(map(lambda x: x.serialize(), all_regions))
+        'all_categories': serialized_all(Category),
+        'all_regions': serialized_all(Region)
     }
     return jsonify({'app_data': response_body}), 200
 
 
-@app.route('/login', methods=['POST']) #ready
+@api.route('/login', methods=['POST']) #ready
+@rate_limit('login', identity=json_field('email'))
+@validate_json(LOGIN_SCHEMA)
 def user_login():
     """
     user login with email and password
@@ -408,16 +706,9 @@ def user_login():
         }
     }
     """
-    if not request.is_json:
-        return jsonify({'Error': 'Missing JSON in request'}), 400
-    
-    email = request.json.get('email', None)
-    password = request.json.get('password', None)
-    if email is None:
-        return jsonify({'Error': 'No se envió email en request'}), 400
-    if password is None:
-        return jsonify({'Error': 'No se envió contraseña en request'}), 400
-    
+    email = request.json.get('email')
+    password = request.json.get('password')
+
     user_query = User.query.filter_by(email=email).first()
     if user_query is None:
         return jsonify({'Error': "Email no registrado."}), 404
@@ -425,7 +716,7 @@ def user_login():
     if user_query.password != password:
         return jsonify({'Error': 'Contraseña incorrecta, intenta de nuevo...'}), 404
     
-    access_token = create_access_token(identity=user_query, expires_delta=timedelta(days=1))
+    access_token = create_access_token(identity=user_query) # expires after JWT_ACCESS_TOKEN_EXPIRES
     data = {
         'access_token': access_token,
         'user': dict({**user_query.serialize(), **user_query.serialize_private_info()}),
@@ -435,8 +726,31 @@ def user_login():
     return jsonify(data), 200
 
 
-@app.route('/user/get_profile', methods=['GET'])
+@api.route('/logout', methods=['POST'])
 @jwt_required
+def user_logout():
+    """
+    revoca el token usado en el request
+    *PRIVATE ENDPOINT*
+    """
+    revocation_list().revoke(get_raw_jwt())
+    return jsonify({'success': 'Sesión cerrada'}), 200
+
+
+@api.route('/logout/all', methods=['POST'])
+@jwt_required
+def user_logout_all():
+    """
+    revoca todos los tokens emitidos hasta ahora para el usuario, cierra la sesión en todos sus dispositivos
+    *PRIVATE ENDPOINT*
+    """
+    revocation_list().revoke_all(get_jwt_identity())
+    return jsonify({'success': 'Sesiones cerradas en todos los dispositivos'}), 200
+
+
+@api.route('/user/get_profile', methods=['GET'])
+@jwt_required
+@cached_response()
 def get_user():
     current_user = User.query.filter(User.email == get_jwt_identity()).first()
     if current_user is None:
@@ -447,11 +761,12 @@ def get_user():
         **current_user.serialize_private_info()
     })
 
-    return jsonify({'user': response_body}), 200
+    return with_etag((jsonify({'user': response_body}), 200), current_user)
 
 
-@app.route('/user/profile', methods=['PUT']) #ready
+@api.route('/user/profile', methods=['PUT']) #ready
 @jwt_required
+@validate_json(PROFILE_SCHEMA)
 def set_user_profile():
     """
     actualiza los datos personales del usuario en la bd
@@ -484,15 +799,9 @@ def set_user_profile():
     }
     """
     current_user = User.query.filter(User.email == get_jwt_identity()).first()
-
-    if not request.is_json:
-        return jsonify({'Error': 'Missing JSON in request'}), 400
-
+    check_if_match(current_user) # If-Match: ETag de /user/get_profile
     body = request.get_json()
 
-    if body is None:
-        return jsonify({'Error': 'no se encuentra datos JSON en cuerpo de request'}), 400
-
     if 'fname' in body:
         current_user.fname = body['fname']
     if 'lname' in body:
@@ -510,20 +819,56 @@ def set_user_profile():
     if 'profile_img' in body:
         current_user.profile_img = body['profile_img']
     if 'comuna' in body:
-        comuna_q = Comuna.query.get(body['comuna'])
-        if comuna_q is None:
+        if not reference_exists(Comuna, body['comuna']):
             raise APIException("Comuna %s not found" %body['comuna'], status_code=404)
-        current_user.comuna = comuna_q
+        current_user.comuna_id = body['comuna']
     db.session.commit()
 
-    return jsonify({'user': dict(
+    return with_etag((jsonify({'user': dict(
         **current_user.serialize(),
         **current_user.serialize_private_info()
-    )}), 200
+    )}), 200), current_user)
+
+
+@api.route('/user/profile/image', methods=['POST'])
+@jwt_required
+def upload_profile_image():
+    """
+    sube la imagen de perfil del usuario, multipart/form-data con el archivo en el campo "image".
+    formatos: jpg, png o webp, hasta MEDIA_MAX_BYTES.
+    las miniaturas se generan en segundo plano, mientras tanto sus urls entregan la imagen original.
+    *PRIVATE ENDPOINT*
+    """
+    current_user = User.query.filter(User.email == get_jwt_identity()).first()
+    try:
+        name = receive_image(request.environ)
+    except RequestEntityTooLarge:
+        return jsonify({'Error': 'image larger than %s bytes' % current_app.config['MEDIA_MAX_BYTES']}), 413
+    if name is None:
+        return jsonify({'Error': 'image field with a jpg, png or webp file is required'}), 400
+
+    current_user.profile_img = media_url(name)
+    enqueue_after_commit('make-thumbnails', name)
+    db.session.commit()
+    return jsonify({
+        'profile_img': current_user.profile_img,
+        'thumbnails': {
+            str(size): media_url(thumbnail_name(name, size)) for size in current_app.config['MEDIA_THUMBNAIL_SIZES']
+        }
+    }), 201
 
 
-@app.route('/provider/categories', methods=['PUT']) #ready
+@api.route('/media/<name>', methods=['GET'])
+def get_media(name):
+    response = send_media(name)
+    if response is None:
+        return jsonify({'Error': 'file not found'}), 404
+    return response
+
+
+@api.route('/provider/categories', methods=['PUT']) #ready
 @jwt_required
+@validate_json(PROVIDER_CATEGORIES_SCHEMA)
 def update_provider_categories():
     """
     Configur las categorias favoritas del usuario como empleador
@@ -537,9 +882,6 @@ def update_provider_categories():
         ]
     }
     """
-    if not request.is_json:
-        return jsonify({'Error': 'Missing JSON in request'}), 400
-
     request_body = request.get_json()
     provider_id = User.query.filter(User.email == get_jwt_identity()).first().id  #ID del provedor haciendo la consulta 
     provider_q = Provider.query.get(provider_id)
@@ -549,7 +891,7 @@ def update_provider_categories():
 
     # se agregan categorias entrantes
     for c in request_body['categories']:  # recorre la lista
-        new_cat = Category.query.get_or_404(c['id'])
+        new_cat = Category.active().filter(Category.id == c['id']).first_or_404()
         provider_q.categories.append(new_cat)
     db.session.commit()
     # se eliminan categorias previas que no estan en las categorias entrantes
@@ -569,8 +911,9 @@ def update_provider_categories():
     })), 200
 
 
-@app.route('/find/service-request', methods=['GET']) #consulted as a provider
+@api.route('/find/service-request', methods=['GET']) #consulted as a provider
 @jwt_required
+@rate_limit('search', identity=jwt_identity)
 def get_service_requests():
     """
     consulta para obtener los servicios que cumplan con ciertos filtros
@@ -608,39 +951,71 @@ def get_service_requests():
         if 'cat' in arg:
             cat_filter.append(int(request.args[arg]))
     
-    f_requests = Request.query.filter(
-        Request.comuna_id == com_filter,
-        Request.employer_id != emp_filter #evita que el usuaruo reciba como resultados solicitudes hechas por el mismo
-    )
-   
-    if cat_filter != []: #Si se envian categorias como filtros en el request
-        f_requests = f_requests.filter(Request.category_id.in_(cat_filter))
-    else:
-        user_categories = list(map(lambda x: x.id, current_user.provider.categories)) #utiliza como filtro las categorias ajustadas por el usuario
-        f_requests = f_requests.filter(Request.category_id.in_(user_categories))
-
-    f_requests.all() #se ejecutan los filtros
-
-    not_repeated = [] # not_repeated contiene todas las solicitudes que cumplen con los filtros, pero a las que el usuario actual no ha ofertado
-    for r in f_requests:
-        exist = False
-        for o in r.offers:
-            if current_user.id == o.provider_id:
-                exist = True
-        if not exist:
-            not_repeated.append(r)
+    if cat_filter == []:
+        cat_filter = list(map(lambda x: x.id, current_user.provider.categories)) #utiliza como filtro las categorias ajustadas por el usuario
+
+    with use_comuna_shard(com_filter): #las solicitudes y sus ofertas estan en el shard de la region de la comuna
+        f_requests = Request.query.filter(
+            Request.comuna_id == com_filter,
+            Request.service_status == 'active', #solicitudes pausadas o cerradas no reciben ofertas
+            Request.employer_id != emp_filter, #evita que el usuaruo reciba como resultados solicitudes hechas por el mismo
+            Request.category_id.in_(cat_filter)
+        ).options(
+            selectinload(Request.offers),
+            *_request_loads(),
+            selectinload(Request.employer).selectinload(Employer.user).selectinload(User.comuna) # serialize_employer()
+        ).all() #se ejecutan los filtros
+
+        not_repeated = [] # not_repeated contiene todas las solicitudes que cumplen con los filtros, pero a las que el usuario actual no ha ofertado
+        for r in f_requests:
+            exist = False
+            for o in r.offers:
+                if current_user.id == o.provider_id:
+                    exist = True
+            if not exist:
+                not_repeated.append(r)
+        services = list(map(lambda x: dict({**x.serialize(), **x.serialize_employer()}), not_repeated))
 
     response_body = {
-        "services": list(map(lambda x: dict({**x.serialize(), **x.serialize_employer()}), not_repeated)), 
-        **current_user.serialize_provider_activity(),
+        "services": services,
+        **_provider_activity(current_user),
         "user": current_user.serialize()
     }
 
     return jsonify(response_body), 200
 
 
-@app.route("/service-request/<int:request_id>/offer", methods=['POST', 'GET'])
+@api.route('/feed/service-requests', methods=['GET']) #consulted as a provider
+@jwt_required
+@rate_limit('search', identity=jwt_identity)
+def get_service_requests_feed():
+    """
+    solicitudes activas ordenadas por relevancia para el proveedor: categorías (declaradas y de
+    sus ofertas y contratos anteriores), cercanía de la comuna, antigüedad y número de ofertas.
+    *ENDPOINT PRIVADO*
+    parametro opcional en url: ?limit=20 (máximo FEED_TOP_K)
+    return json:
+    {
+        "services": [{...solicitud, "score": 4.2}, ...]
+    }
+    """
+    current_user = User.query.filter(User.email == get_jwt_identity()).first()
+    limit = max(min(request.args.get('limit', 20, type=int), current_app.config['FEED_TOP_K']), 1)
+    ranked = ranked_requests(current_user.id, limit)
+
+    requests_q = Request.query.filter(Request.id.in_([request_id for request_id, _ in ranked])).options(
+        *_request_loads()
+    ).all()
+    by_id = {r.id: r for r in requests_q}
+    return jsonify({
+        'services': [dict(by_id[request_id].serialize(), score=score) for request_id, score in ranked if request_id in by_id]
+    }), 200
+
+
+@api.route("/service-request/<int:request_id>/offer", methods=['POST', 'GET'])
 @jwt_required
+@validate_json(OFFER_SCHEMA, methods=['POST'])
+@route_to_row(Request, arg='request_id')
 def create_new_offer(request_id): #Crea una oferta a un servicio ->prov; Obtiene las offertas a un servicio ->emp
     """
     required:
@@ -649,24 +1024,33 @@ def create_new_offer(request_id): #Crea una oferta a un servicio ->prov; Obtiene
     }
     """
     current_user = User.query.filter(User.email == get_jwt_identity()).first()
-    request_q = Request.query.get(request_id)
+    request_q = Request.query
+    if request.method == 'GET': # serialize_offers(), with the provider of each offer
+        offer_provider = selectinload(Request.offers).selectinload(Offer.provider)
+        request_q = request_q.options(
+            *_request_loads(),
+            offer_provider.selectinload(Provider.user).selectinload(User.comuna),
+            offer_provider.selectinload(Provider.categories)
+        )
+    request_q = request_q.get(request_id)
     if request_q is None:
         return jsonify({'Error': 'request ID not found'}), 404
 
     if request.method == 'POST':
 
-        if not request.is_json:
-            raise APIException('missing JSON in request', status_code=400)
-
         if request_q.employer_id == current_user.id:
             raise APIException('current user as employer in service-request', status_code=401)
 
+        if request_q.service_status != 'active':
+            return jsonify({'Error': 'service-request is %s, not accepting offers' %request_q.service_status}), 409
+
         new_offer = Offer(
             description = request.json.get('description', None),
             provider = Provider.query.get(current_user.id), #Usuario haciendo la consulta se considera proveedor, ya que está creando una oferta de servicio
             request = request_q
         )
         db.session.add(new_offer)
+        audit('offer.create', new_offer, request_id=request_id)
         db.session.commit()
         return jsonify({'msg': 'offer created'}), 201
 
@@ -675,13 +1059,25 @@ def create_new_offer(request_id): #Crea una oferta a un servicio ->prov; Obtiene
         if request_q.employer_id != current_user.id:
             raise APIException('access denied', status_code=401)
 
-        return jsonify(request_q.serialize_offers()), 200
+        return with_etag((jsonify(request_q.serialize_offers()), 200), request_q)
 
 
-@app.route("/offer/<int:offer_id>", methods=['GET']) #As provider owner of the offer, obtiene info detallada sobre una oferta
+@api.route("/offer/<int:offer_id>", methods=['GET', 'PUT', 'DELETE']) #As provider owner of the offer
 @jwt_required
-def get_offer_details(offer_id):
-
+@validate_json(OFFER_SCHEMA, methods=['PUT'])
+@cached_response(tags=lambda offer_id: ['offer:%s' % offer_id])
+@route_to_row(Offer, arg='offer_id')
+def handle_offer(offer_id):
+    """
+    GET: obtiene info detallada sobre una oferta
+    PUT: actualiza la descripción de una oferta activa
+    requerido:
+    {
+        "description": "description"
+    }
+    DELETE: retira la oferta, queda con status "withdrawn"
+    *PRIVATE ENDPOINT*
+    """
     current_user = User.query.filter(User.email == get_jwt_identity()).first()
     offer_q = Offer.query.get(offer_id)
     if offer_q is None:
@@ -690,32 +1086,140 @@ def get_offer_details(offer_id):
     if offer_q.provider_id != current_user.id:
         return jsonify({"Error": "offer don't belong to current user"}), 400
 
+    if request.method in ('PUT', 'DELETE'):
+        check_if_match(offer_q)
+
+    if request.method == 'PUT':
+        if offer_q.status != 'active':
+            return jsonify({'Error': 'offer is %s, only active offers can be updated' %offer_q.status}), 409
+        offer_q.description = request.json.get('description')
+        audit('offer.update', offer_q)
+        db.session.commit()
+
+    if request.method == 'DELETE':
+        if not offer_q.can_change_to('withdrawn'):
+            return jsonify({'Error': 'offer is %s, can not be withdrawn' %offer_q.status}), 409
+        offer_q.status = 'withdrawn'
+        audit('offer.withdraw', offer_q)
+        db.session.commit()
+        return with_etag((jsonify({'msg': 'offer withdrawn', 'offer': offer_q.serialize()}), 200), offer_q)
+
     response_body = dict({
         **offer_q.serialize(),
         **offer_q.serialize_request()
     })
 
-    return jsonify(response_body), 200
+    return with_etag((jsonify(response_body), 200), offer_q)
 
 
-@app.route("/my-provider-info", methods=['GET'])
+@api.route("/offer/<int:offer_id>/accept", methods=['POST']) #As employer owner of the service request
 @jwt_required
+@route_to_row(Offer, arg='offer_id')
+def accept_offer(offer_id):
+    """
+    acepta una oferta activa, el resto de las ofertas activas de la solicitud quedan rechazadas.
+    *PRIVATE ENDPOINT*
+    """
+    current_user = User.query.filter(User.email == get_jwt_identity()).first()
+    offer_q = Offer.query.get(offer_id)
+    if offer_q is None:
+        return jsonify({'Error': 'Offer ID not Foud'}), 404
+
+    if offer_q.request.employer_id != current_user.id:
+        raise APIException('access denied', status_code=401)
+
+    if not offer_q.can_change_to('accepted'):
+        return jsonify({'Error': 'offer is %s, can not be accepted' %offer_q.status}), 409
+
+    # One set-based UPDATE over the active offers of the request: the chosen one is accepted and
+    # the rest rejected. Only active rows are touched, so if another accept won the race
+    # the chosen offer is not updated and the transaction is rolled back.
+    Offer.query.filter(
+        Offer.request_id == offer_q.request_id,
+        Offer.status == 'active'
+    ).update({
+        Offer.status: db.case([(Offer.id == offer_id, 'accepted')], else_='rejected'),
+        Offer.version_id: Offer.version_id + 1
+    }, synchronize_session=False)
+    mark_stale(offer_q.request)
+
+    if db.session.query(Offer.status).filter(Offer.id == offer_id).scalar() != 'accepted':
+        db.session.rollback()
+        return jsonify({'Error': 'offer is no longer active'}), 409
+
+    audit('offer.accept', offer_q, request_id=offer_q.request_id) # the other active offers are rejected
+    db.session.commit()
+    return jsonify({
+        'msg': 'offer accepted',
+        **offer_q.request.serialize_offers()
+    }), 200
+
+
+def _request_loads(*path):
+    """
+    selectinload() of what Request.serialize() reads, for the requests reached through the
+    relationships of `path` (ej: Offer.request). Separate queries, not joins: the related tables
+    may be in another database (see sharding.py)
+    """
+    def load(attribute):
+        option = None
+        for step in path + (attribute,):
+            option = selectinload(step) if option is None else option.selectinload(step)
+        return option
+    return [
+        load(Request.category),
+        load(Request.comuna).selectinload(Comuna.region),
+        load(Request.employer).selectinload(Employer.user)
+    ]
+
+
+def _serialized_everywhere(model, column, value, options=()):
+    """serialize() of the rows of `model` with `column` == value, of every database (sharding.py), by id"""
+    def query():
+        rows = model.query.filter(getattr(model, column) == value).options(*options).order_by(model.id)
+        return [row.serialize() for row in rows]
+    return sorted((row for rows in fan_out(query) for row in rows), key=lambda row: row['id'])
+
+
+def _provider_activity(user):
+    """serialize_provider_activity(), with the offers and contracts in the region of each request, not the user's"""
+    provider = user.provider
+    return {'provider': provider.serialize(
+        offers=_serialized_everywhere(Offer, 'provider_id', user.id, [selectinload(Offer.request)] + _request_loads(Offer.request)),
+        contracts=_serialized_everywhere(Contract, 'provider_id', user.id)
+    )}
+
+
+def _employer_activity(user):
+    """serialize_employer_activity(), with the requests and contracts of every region"""
+    employer = user.employer # loaded before its requests, they find it in the session
+    return {'employer': employer.serialize(
+        requests=_serialized_everywhere(Request, 'employer_id', user.id, _request_loads()),
+        contracts=_serialized_everywhere(Contract, 'employer_id', user.id)
+    )}
+
+
+@api.route("/my-provider-info", methods=['GET'])
+@jwt_required
+@cached_response()
 def get_provider_info():
 
     current_user = User.query.filter(User.email == get_jwt_identity()).first()
-    return jsonify(current_user.serialize_provider_activity()), 200
+    return jsonify(_provider_activity(current_user)), 200
 
 
-@app.route("/my-employer-info", methods=['GET'])
+@api.route("/my-employer-info", methods=['GET'])
 @jwt_required
+@cached_response()
 def get_employer_info():
 
     current_user = User.query.filter(User.email == get_jwt_identity()).first()
-    return jsonify(current_user.serialize_employer_activity()), 200
+    return jsonify(_employer_activity(current_user)), 200
 
 
-@app.route("/service-request/create", methods=["POST"]) #ready, as a employer
+@api.route("/service-request/create", methods=["POST"]) #ready, as a employer
 @jwt_required
+@validate_json(SERVICE_REQUEST_SCHEMA)
 def create_service_request():
     """
     crea una solicitud de un servicio
@@ -731,54 +1235,126 @@ def create_service_request():
     }
     """
     current_user = User.query.filter(User.email == get_jwt_identity()).first()
-
-    if not request.is_json:
-        return jsonify({'Error': 'missing JSON in request'}), 400
     body = request.get_json()
 
-    if 'name' not in body or body['name'] == '':
-        return jsonify({'Error': 'Ingresa un nombre a tu solicitud'}), 400
-
-    if 'description' not in body or body['description'] == '':
-        return jsonify({'Error': 'ingresa una descripción a tu solicitud'}), 400
-
-    if 'street' not in body or body['street'] == '':
-        return jsonify({'Error': 'Dirección incompleta...'}), 400
-
-    if 'home_number' not in body:
-        return jsonify({'Error': 'Dirección incompleta...'}), 400
-    if 'comuna' not in body or body['comuna'] == 'Comuna...':
-        return jsonify({'Error': 'Selecciona tu comuna'}), 400
-    if 'category' not in body:
-        return jsonify({'Error': 'Selecciona una categoría para tu solicitud'}), 400
-
-    comuna_q = Comuna.query.filter(Comuna.name == body['comuna']).first() #En body llega el nombre de la comuna
-    if comuna_q is None:
+    comuna_id = comuna_id_by_name(body['comuna']) #En body llega el nombre de la comuna
+    if comuna_id is None:
         return jsonify({'Error': 'Comuna: %s no encontrada' %body['comuna']}), 404
     
-    category_q = Category.query.get(int(body['category']))
-    if category_q is None:
-        return jsonify({'Error': 'Categoría: %s no encontrada'} %body['category']), 404
+    category_id = int(body['category'])
+    if not reference_exists(Category, category_id):
+        return jsonify({'Error': 'Categoría: %s no encontrada' %body['category']}), 404
 
     new_request = Request(
         name = body['name'],
         description = body['description'],
         street = body['street'],
         home_number = body['home_number'],
-        more_info = body['more_info'],
+        more_info = body.get('more_info'),
         employer = Employer.query.get(current_user.id), #Se considera al current_user como empleador, ya que el empleador es el unico que puede solicitar un servicio.
-        category = category_q,
-        comuna = comuna_q
+        category_id = category_id,
+        comuna_id = comuna_id
     )
-    db.session.add(new_request)
-    db.session.commit()
+    with use_comuna_shard(comuna_id): #se guarda en el shard de la region de la comuna
+        db.session.add(new_request)
+        db.session.commit()
 
     return jsonify({
         'Success': 'Solicitud de Servicio creada Exitosamente'
     }), 200
 
 
-@app.route("/contract", methods=["GET"])
+@api.route("/service-request/<int:request_id>", methods=["PUT"]) #as the employer owner of the request
+@jwt_required
+@validate_json(SERVICE_REQUEST_UPDATE_SCHEMA)
+@route_to_row(Request, arg='request_id')
+def update_service_request(request_id):
+    """
+    actualiza los datos de una solicitud, todos los campos son opcionales
+    requerido:
+    {
+        "name": "service_name",
+        "description": "service_description",
+        "street": "street_address",
+        "home_number": "home_number_address",
+        "more_info": "more info about home",
+        "comuna": <comuna_name>,
+        "category" <category_id>
+    }
+    """
+    current_user = User.query.filter(User.email == get_jwt_identity()).first()
+    request_q = Request.query.get(request_id)
+    if request_q is None:
+        return jsonify({'Error': 'request ID not found'}), 404
+
+    if request_q.employer_id != current_user.id:
+        raise APIException('access denied', status_code=401)
+
+    check_if_match(request_q)
+    if request_q.service_status == 'closed':
+        return jsonify({'Error': 'service-request is closed'}), 409
+
+    body = request.get_json()
+    for field in ('name', 'description', 'street', 'home_number', 'more_info'):
+        if field in body:
+            setattr(request_q, field, body[field])
+
+    if 'comuna' in body:
+        comuna_id = comuna_id_by_name(body['comuna']) #En body llega el nombre de la comuna
+        if comuna_id is None:
+            return jsonify({'Error': 'Comuna: %s no encontrada' %body['comuna']}), 404
+        request_q.comuna_id = comuna_id
+
+    if 'category' in body:
+        category_id = int(body['category'])
+        if not reference_exists(Category, category_id):
+            return jsonify({'Error': 'Categoría: %s no encontrada' %body['category']}), 404
+        request_q.category_id = category_id
+
+    db.session.commit()
+    return with_etag((jsonify({'msg': 'service-request updated', 'service': request_q.serialize()}), 200), request_q)
+
+
+@api.route("/service-request/<int:request_id>/status", methods=["PUT"]) #as the employer owner of the request
+@jwt_required
+@validate_json(SERVICE_REQUEST_STATUS_SCHEMA)
+@route_to_row(Request, arg='request_id')
+def set_service_request_status(request_id):
+    """
+    pausa, reactiva o cierra una solicitud.
+    al cerrarla, todas sus ofertas activas quedan rechazadas.
+    requerido:
+    {
+        "status": "active" | "paused" | "closed"
+    }
+    """
+    current_user = User.query.filter(User.email == get_jwt_identity()).first()
+    request_q = Request.query.get(request_id)
+    if request_q is None:
+        return jsonify({'Error': 'request ID not found'}), 404
+
+    if request_q.employer_id != current_user.id:
+        raise APIException('access denied', status_code=401)
+
+    check_if_match(request_q)
+    status = request.json.get('status')
+    if not request_q.can_change_to(status):
+        return jsonify({'Error': 'service-request is %s, can not change to %s' %(request_q.service_status, status)}), 409
+
+    audit('request.status', request_q, status=status, previous=request_q.service_status)
+    request_q.service_status = status
+    if status == 'closed':
+        request_q.closed_date = datetime.now()
+        Offer.query.filter(
+            Offer.request_id == request_id,
+            Offer.status == 'active'
+        ).update({Offer.status: 'rejected', Offer.version_id: Offer.version_id + 1}, synchronize_session=False)
+
+    db.session.commit()
+    return with_etag((jsonify({'msg': 'service-request %s' %status, 'service': request_q.serialize()}), 200), request_q)
+
+
+@api.route("/contract", methods=["GET"])
 @jwt_required
 def get_contract():
     """
@@ -787,8 +1363,10 @@ def get_contract():
     """
 
 
-@app.route("/contract/create", methods=["POST"]) #ready
+@api.route("/contract/create", methods=["POST"]) #ready
 @jwt_required
+@validate_json(CONTRACT_SCHEMA)
+@route_to_row(Request, field='service')
 def create_new_contract():
     """
     crea un nuevo contrato entre un empleador y un proveedor.
@@ -803,46 +1381,134 @@ def create_new_contract():
         "success": "contract created" ,200
     }
     """
-    if not request.is_json:
-        return jsonify({'Error': 'Missing JSON in request'}), 400
-
     current_user = User.query.filter(User.email == get_jwt_identity()).first()
-
-    provider = request.json.get('provider', None)
-    if provider is None:
-        return jsonify({'Error': 'Missing provider id in body'}), 400
-
-    service = request.json.get('service', None)
-    if service is None:
-        return jsonify({'Error': 'Missing service id in body'}), 400
+    provider = request.json.get('provider')
+    service = request.json.get('service')
 
     provider_q = Provider.query.get(provider)
     if provider_q is None:
-        return jsonify({'Error', 'provider %s not found' %provider}), 404
+        return jsonify({'Error': 'provider %s not found' %provider}), 404
 
     if provider_q.id == current_user.id:
         return jsonify({'Error': 'proveedor no puede crear un contrato'}), 401
 
     service_q = Request.query.get(service)
     if service_q is None:
-        return jsonify({'Error', 'service %s not found' %service}), 404
+        return jsonify({'Error': 'service %s not found' %service}), 404
+
+    if service_q.service_status != 'active':
+        return jsonify({'Error': 'service %s is %s, can not be contracted' %(service, service_q.service_status)}), 409
+
+    if service_q.contract is not None:
+        return jsonify({'Error': 'service %s already has a contract' %service}), 409
+
+    # If-Match: ETag de la solicitud. Su versión sube con el contrato, con un UPDATE condicionado a
+    # la versión leída, a que siga activa y a que no tenga contrato: dos contratos sobre la misma
+    # solicitud no se crean ambos, con o sin If-Match
+    check_if_match(service_q)
+    if not bump_version(service_q, Request.service_status == 'active', ~Request.contract.has()):
+        db.session.rollback()
+        return jsonify({'Error': 'service %s was modified, reload it' %service}), 412
 
     new_contract = Contract(employer=Employer.query.get(current_user.id), provider=provider_q, request=service_q) #Se considera empleador al current_user, ya que solo el empleador puede crear un contrato
     db.session.add(new_contract)
+    audit('contract.create', new_contract, provider_id=provider_q.id, request_id=service_q.id)
     db.session.commit() #commit3
 
-    return jsonify({
+    return with_etag((jsonify({
         'msg': 'contract created',
         'contract': new_contract.serialize()
+    }), 200), new_contract)
+
+
+@api.route("/review", methods=["POST"])
+@jwt_required
+@validate_json(REVIEW_SCHEMA)
+@route_to_row(Contract, field='contract')
+def create_review():
+    """
+    crea una evaluación de la otra parte de un contrato: el empleador evalúa al proveedor y viceversa.
+    *PRIVATE ENDPOINT*
+    requerido:
+    {
+        "contract": contract_id,
+        "score": 1 a 5,
+        "body": "comentario" #is optional
+    }
+    """
+    current_user = User.query.filter(User.email == get_jwt_identity()).first()
+    contract_q = Contract.query.get(request.json.get('contract'))
+    if contract_q is None:
+        return jsonify({'Error': 'contract %s not found' %request.json.get('contract')}), 404
+
+    if contract_q.employer_id == current_user.id: #el empleador evalúa al proveedor
+        role, reviewed = 'provider', {'provider_id': contract_q.provider_id}
+    elif contract_q.provider_id == current_user.id: #el proveedor evalúa al empleador
+        role, reviewed = 'employer', {'employer_id': contract_q.employer_id}
+    else:
+        raise APIException('access denied', status_code=401)
+
+    score = request.json.get('score')
+    new_review = Review(
+        score=score,
+        body=request.json.get('body'),
+        contract_id=contract_q.id,
+        review_author=current_user.id,
+        **reviewed
+    )
+    try:
+        db.session.add(new_review)
+        db.session.flush()
+    except IntegrityError:
+        db.session.rollback()
+        return jsonify({'Error': 'contract already reviewed by current user'}), 400
+
+    add_review_to_summary(role, list(reviewed.values())[0], score)
+    db.session.commit()
+    return jsonify({'msg': 'review created', 'review': new_review.serialize()}), 201
+
+
+def _list_reviews(role, user_id):
+    page = request.args.get('page', 1, type=int)
+    per_page = min(request.args.get('per_page', current_app.config['REVIEWS_PER_PAGE'], type=int), 100)
+    column = Review.provider_id if role == 'provider' else Review.employer_id
+    page_q = Review.query.filter(column == user_id).options(selectinload(Review.user)) \
+        .order_by(Review.review_date.desc(), Review.id.desc()) \
+        .paginate(page=page, per_page=per_page, error_out=False)
+
+    return jsonify({
+        'reviews': list(map(lambda x: x.serialize(), page_q.items)),
+        'summary': ReviewSummary.serialize_or_empty(ReviewSummary.query.get((role, user_id))),
+        'page': page_q.page,
+        'pages': page_q.pages,
+        'total': page_q.total
     }), 200
 
 
+@api.route("/provider/<int:provider_id>/reviews", methods=["GET"])
+@jwt_required
+def get_provider_reviews(provider_id):
+    """
+    evaluaciones recibidas como proveedor, paginadas: ?page=1&per_page=20
+    *PRIVATE ENDPOINT*
+    """
+    return _list_reviews('provider', provider_id)
+
+
+@api.route("/employer/<int:employer_id>/reviews", methods=["GET"])
+@jwt_required
+def get_employer_reviews(employer_id):
+    """
+    evaluaciones recibidas como empleador, paginadas: ?page=1&per_page=20
+    *PRIVATE ENDPOINT*
+    """
+    return _list_reviews('employer', employer_id)
+
+
 """
 What's missing:
-    3) endpoint for update or delete a service request
     4) endpoint for get contract info as a provider
     5) endpoint for get contract info as a employer
-    7) endpoint for update or delete a offer
 
 """
 
@@ -850,4 +1516,4 @@ What's missing:
 # this only runs if `$ python src/main.py` is executed
 if __name__ == '__main__':
     PORT = int(os.environ.get('PORT', 3000))
-    app.run(host='0.0.0.0', port=PORT, debug=False)
+    create_app().run(host='0.0.0.0', port=PORT, debug=False)
@@ -0,0 +1,179 @@
+"""
+Uploaded images (profile pictures).
+The multipart body is streamed to a temporary file in chunks while it's hashed, it's never held
+in memory. The file is then stored as <sha256[:32]>.<ext>, so the same image is stored once and
+its url never changes content: /media/ responses are cached by browsers and CDNs for a year.
+In production MEDIA_ROOT can be served by the web server or a CDN in front of /media/.
+
+Thumbnails (<hash>_<size>.<ext>, MEDIA_THUMBNAIL_SIZES) are made by a background job after the
+upload commits. They need Pillow; without it only the original is stored, and the thumbnail
+urls answer with the original image.
+
+Storage backends implement temp_file(), save(temp_path, name), exists(name) and send(name).
+LocalStorage keeps the files in MEDIA_ROOT, an object store would implement the same methods.
+"""
+import hashlib
+import os
+import re
+import tempfile
+
+from flask import current_app, send_from_directory
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.formparser import parse_form_data
+
+from jobs import job
+
+# first bytes of each accepted format -> extension
+SIGNATURES = (
+    (b'\xff\xd8\xff', 'jpg'),
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+)
+NAME_RE = re.compile(r'^(?P<hash>[0-9a-f]{32})(?:_(?P<size>\d+))?\.(?P<ext>jpg|png|webp)$')
+
+
+def sniff_extension(head):
+    for signature, ext in SIGNATURES:
+        if head.startswith(signature):
+            return ext
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'webp'
+    return None
+
+
+class LocalStorage:
+    def __init__(self, root):
+        self.root = root
+        self.tmp = os.path.join(root, 'tmp')
+        os.makedirs(self.tmp, exist_ok=True)
+
+    def temp_file(self):
+        return tempfile.NamedTemporaryFile(dir=self.tmp, delete=False)
+
+    def save(self, temp_path, name):
+        """moves the temporary file to `name`, an existing file with that name has the same content"""
+        if self.exists(name):
+            os.remove(temp_path)
+        else:
+            os.replace(temp_path, os.path.join(self.root, name))
+
+    def exists(self, name):
+        return os.path.isfile(os.path.join(self.root, name))
+
+    def path(self, name):
+        return os.path.join(self.root, name)
+
+    def send(self, name, max_age):
+        return send_from_directory(self.root, name, cache_timeout=max_age, conditional=True)
+
+
+class HashingFile:
+    """temporary file target of the multipart parser, hashes each chunk as it's written"""
+    def __init__(self, fileobj):
+        self.file = fileobj
+        self.sha256 = hashlib.sha256()
+        self.head = b''
+        self.size = 0
+
+    def write(self, chunk):
+        if len(self.head) < 16:
+            self.head += chunk[:16 - len(self.head)]
+        self.sha256.update(chunk)
+        self.size += len(chunk)
+        return self.file.write(chunk)
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+
+def init_media(app):
+    if len(app.config['MEDIA_URL']) + 32 + len('.webp') > 60: # user.profile_img is a String(60)
+        raise ValueError('MEDIA_URL is too long for user.profile_img')
+    app.extensions['media_storage'] = LocalStorage(app.config['MEDIA_ROOT'])
+
+
+def storage():
+    return current_app.extensions['media_storage']
+
+
+def media_url(name):
+    return current_app.config['MEDIA_URL'] + name
+
+
+def thumbnail_name(name, size):
+    base, ext = name.rsplit('.', 1)
+    return '%s_%s.%s' % (base, size, ext)
+
+
+def receive_image(environ, field='image'):
+    """
+    Streams the multipart body of the request to storage and returns the stored file name,
+    None if `field` is missing or is not a jpg/png/webp image.
+    Raises RequestEntityTooLarge over MEDIA_MAX_BYTES.
+    """
+    files = []
+
+    def stream_factory(total_content_length, filename, content_type, content_length=None):
+        target = HashingFile(storage().temp_file())
+        files.append(target)
+        return target
+
+    try:
+        _, _, uploaded = parse_form_data(
+            environ, stream_factory=stream_factory,
+            max_content_length=current_app.config['MEDIA_MAX_BYTES'] + 64 * 1024, # + multipart headers
+            silent=False
+        )
+        image = uploaded.get(field)
+        if image is None:
+            return None
+        target = image.stream
+        if target.size > current_app.config['MEDIA_MAX_BYTES']:
+            raise RequestEntityTooLarge()
+        ext = sniff_extension(target.head)
+        if ext is None:
+            return None
+        target.close()
+        name = '%s.%s' % (target.sha256.hexdigest()[:32], ext)
+        storage().save(target.name, name)
+        files.remove(target)
+        return name
+    finally:
+        for target in files: # other fields, rejected files
+            target.close()
+            if os.path.exists(target.name):
+                os.remove(target.name)
+
+
+@job('make-thumbnails')
+def make_thumbnails(name):
+    try:
+        from PIL import Image, ImageOps # imported by the first job, not by every worker at startup
+    except ImportError: # optional, thumbnails are skipped without it
+        return
+    store = storage()
+    for size in current_app.config['MEDIA_THUMBNAIL_SIZES']:
+        thumbnail = thumbnail_name(name, size)
+        if store.exists(thumbnail):
+            continue
+        with Image.open(store.path(name)) as image:
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail((size, size))
+            with store.temp_file() as temp:
+                image.save(temp, format=Image.registered_extensions()['.' + name.rsplit('.', 1)[1]])
+            store.save(temp.name, thumbnail)
+
+
+def send_media(name):
+    """response for /media/<name>, None when the file doesn't exist"""
+    match = NAME_RE.match(name)
+    if match is None:
+        return None
+    store = storage()
+    if store.exists(name):
+        response = store.send(name, current_app.config['MEDIA_CACHE_SECONDS'])
+        response.headers['Cache-Control'] = 'public, max-age=%s, immutable' % current_app.config['MEDIA_CACHE_SECONDS']
+        return response
+    original = '%s.%s' % (match.group('hash'), match.group('ext'))
+    if match.group('size') is not None and store.exists(original): # thumbnail not made yet
+        return store.send(original, 60)
+    return None
@@ -0,0 +1,186 @@
+"""
+Activity metrics for the admins: service requests, offers and contracts created per day, comuna
+and category. /admin/metrics/activity reads them from the daily rollup (models.ActivityDaily),
+never with GROUP BYs over the live tables.
+
+The rollup is incremental: each run counts the rows of request, offer and contract (of every
+database when sharded) with an id above the watermark of the table (models.RollupWatermark),
+METRICS_ROLLUP_BATCH_SIZE ids per transaction, and adds them to the daily buckets in the same
+transaction that moves the watermark. Rows created in the last METRICS_SETTLE_SECONDS, and the ids
+above them, wait for the next run: a transaction in flight could still commit a lower id. The
+watermark only moves if no other run moved it first, a row is never counted twice.
+
+It runs from the CLI (ej: every 10 minutes with heroku scheduler) or as the 'rollup-activity'
+job, queued by the endpoint when the rollup is older than METRICS_ROLLUP_SECONDS.
+Offers and contracts count in the comuna and category of their request at the time of the run,
+later changes (ej: a deleted comuna, see deletions.py) don't move them. Rows archived before
+their first rollup (archive.py) are not counted.
+
+    $ flask rollup-activity
+"""
+import time
+from datetime import date, datetime, timedelta
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import and_, func, select
+from sqlalchemy.exc import IntegrityError
+
+from jobs import job, enqueue
+from models import db, Request, Offer, Contract, ActivityDaily, RollupWatermark
+from sharding import shard_resolver, use_shard
+
+# (model, date column, column referencing request.id, bucket column)
+SOURCES = (
+    (Request, 'creation_date', None, 'requests'),
+    (Offer, 'offer_date', 'request_id', 'offers'),
+    (Contract, 'contract_start_date', 'service_id', 'contracts'),
+)
+GROUP_BY = ('day', 'comuna', 'category')
+_queued_at = {'time': 0.0} # last 'rollup-activity' job queued by this worker
+
+
+def _to_date(value):
+    return value if isinstance(value, date) else datetime.strptime(value, '%Y-%m-%d').date() # SQLite: a string
+
+
+def _watermark(source):
+    last_id = db.session.query(RollupWatermark.last_id).filter(RollupWatermark.source == source).scalar()
+    if last_id is not None:
+        return last_id
+    try:
+        db.session.add(RollupWatermark(source=source, last_id=0))
+        db.session.commit()
+    except IntegrityError: # created by a concurrent run
+        db.session.rollback()
+    return 0
+
+
+def _upper_id(table, date_column, low, cutoff, batch_size):
+    """highest id of the next batch, below the first row not settled yet. None: nothing to count"""
+    unsettled = db.session.execute(select([func.min(table.c.id)]).where(and_(table.c.id > low, date_column >= cutoff))).scalar()
+    high = db.session.execute(select([func.max(table.c.id)])).scalar()
+    if unsettled is not None:
+        high = unsettled - 1
+    if high is None or high <= low:
+        return None
+    return min(high, low + batch_size)
+
+
+def _add_to_buckets(column, rows):
+    t = ActivityDaily.__table__
+    for day, comuna_id, category_id, count in rows:
+        key = dict(day=_to_date(day), comuna_id=comuna_id or 0, category_id=category_id or 0)
+        updated = db.session.execute(t.update().where(and_(
+            t.c.day == key['day'], t.c.comuna_id == key['comuna_id'], t.c.category_id == key['category_id']
+        )).values({column: t.c[column] + count})).rowcount
+        if not updated:
+            values = dict(key, requests=0, offers=0, contracts=0)
+            values[column] = count
+            db.session.execute(t.insert().values(values))
+
+
+def _rollup_source(model, date_name, join_name, column, source, cutoff, batch_size):
+    """counts the settled rows of a table above its watermark, returns the rows counted"""
+    table, request_t = model.__table__, Request.__table__
+    date_column = table.c[date_name]
+    day = func.date(date_column)
+    from_ = table if join_name is None else table.join(request_t, table.c[join_name] == request_t.c.id)
+    w = RollupWatermark.__table__
+    counted = 0
+    while True:
+        low = _watermark(source)
+        high = _upper_id(table, date_column, low, cutoff, batch_size)
+        if high is None: # up to date: the rollup isn't stale, even with no new rows
+            db.session.execute(w.update().where(w.c.source == source).values(updated_date=datetime.now()))
+            db.session.commit()
+            return counted
+        rows = db.session.execute(
+            select([day, request_t.c.comuna_id, request_t.c.category_id, func.count()])
+            .select_from(from_)
+            .where(and_(table.c.id > low, table.c.id <= high, date_column.isnot(None)))
+            .group_by(day, request_t.c.comuna_id, request_t.c.category_id)
+        ).fetchall()
+        moved = db.session.execute(w.update().where(and_(w.c.source == source, w.c.last_id == low)).values(
+            last_id=high, updated_date=datetime.now()
+        )).rowcount
+        if not moved: # another run counted this batch
+            db.session.rollback()
+            return counted
+        try:
+            _add_to_buckets(column, rows)
+            db.session.commit()
+        except IntegrityError: # a concurrent run created the same bucket, the next run counts the batch
+            db.session.rollback()
+            return counted
+        counted += sum(row[3] for row in rows)
+
+
+def rollup_activity():
+    """brings the daily rollup up to date, returns the rows counted per source table"""
+    config = current_app.config
+    cutoff = datetime.now() - timedelta(seconds=config['METRICS_SETTLE_SECONDS'])
+    resolver = shard_resolver()
+    counted = {}
+    for region_id in (resolver.databases() if resolver is not None else [None]):
+        with use_shard(region_id):
+            for model, date_name, join_name, column in SOURCES:
+                source = model.__tablename__ if region_id is None else '%s@%s' % (model.__tablename__, region_id)
+                counted[model.__tablename__] = counted.get(model.__tablename__, 0) + _rollup_source(
+                    model, date_name, join_name, column, source, cutoff, config['METRICS_ROLLUP_BATCH_SIZE']
+                )
+    return counted
+
+
+@job('rollup-activity')
+def rollup_job():
+    rollup_activity()
+
+
+def rollup_updated_date():
+    """when the least recent watermark moved, None before the first rollup"""
+    return db.session.query(func.min(RollupWatermark.updated_date)).scalar()
+
+
+def refresh_if_stale():
+    """queues a rollup when the last one is older than METRICS_ROLLUP_SECONDS, returns its date"""
+    updated = rollup_updated_date()
+    max_age = current_app.config['METRICS_ROLLUP_SECONDS']
+    stale = updated is None or updated < datetime.now() - timedelta(seconds=max_age)
+    if stale and time.monotonic() - _queued_at['time'] > max_age:
+        _queued_at['time'] = time.monotonic()
+        enqueue('rollup-activity')
+    return updated
+
+
+def activity(since, until, group_by, comuna_id=None, category_id=None):
+    """totals of the days in [since, until) per combination of `group_by` (names of GROUP_BY)"""
+    columns = [{'day': ActivityDaily.day, 'comuna': ActivityDaily.comuna_id, 'category': ActivityDaily.category_id}[name] for name in group_by]
+    query = db.session.query(
+        *(columns + [func.sum(ActivityDaily.requests), func.sum(ActivityDaily.offers), func.sum(ActivityDaily.contracts)])
+    ).filter(ActivityDaily.day >= since, ActivityDaily.day < until)
+    if comuna_id is not None:
+        query = query.filter(ActivityDaily.comuna_id == comuna_id)
+    if category_id is not None:
+        query = query.filter(ActivityDaily.category_id == category_id)
+    series = []
+    for row in query.group_by(*columns).order_by(*columns):
+        item = {}
+        for name, value in zip(group_by, row):
+            if name == 'day':
+                item['day'] = _to_date(value).isoformat()
+            else:
+                item[name + '_id'] = value or None
+        requests, offers, contracts = row[len(group_by):]
+        item.update(requests=int(requests or 0), offers=int(offers or 0), contracts=int(contracts or 0))
+        series.append(item)
+    return series
+
+
+@click.command('rollup-activity')
+@with_appcontext
+def rollup_command():
+    """Add the requests, offers and contracts created since the last run to the daily activity rollup."""
+    counted = rollup_activity()
+    click.echo(', '.join('%s %s' % (count, table) for table, count in counted.items()) + ' counted')
@@ -1,16 +1,109 @@
-from flask_sqlalchemy import SQLAlchemy
+import json
 from datetime import datetime
-
-db = SQLAlchemy()
+from sqlalchemy import event
+from sqlalchemy.ext.declarative import declared_attr
+from sqlalchemy.orm import object_session
+from routing import RoutingSQLAlchemy, RoutingSession
+
+db = RoutingSQLAlchemy()
+
+REFERENCE_TABLES = frozenset(['region', 'comuna', 'category'])
+# regions, comunas and categories are soft deleted (deleted_at), see deletions.py
+NOT_DELETED = db.text('deleted_at IS NULL')
+
+
+def active_index(name, *columns, **kwargs):
+    """
+    index over the rows not deleted. A unique one also has not_deleted (NULL for deleted rows, and
+    NULLs never collide): names of deleted rows can be used again, MySQL has no partial indexes.
+    Non-unique ones are partial where supported, MySQL indexes the deleted rows too.
+    """
+    if kwargs.get('unique'):
+        return db.Index(name, *(columns + ('not_deleted',)), **kwargs)
+    return db.Index(name, *columns, postgresql_where=NOT_DELETED, sqlite_where=NOT_DELETED, **kwargs)
+
+
+class SoftDeleteMixin:
+    deleted_at = db.Column(db.DateTime)
+
+    @declared_attr
+    def not_deleted(cls): # 1, NULL once deleted: generated by the database, see active_index
+        return db.Column(db.SmallInteger, db.Computed('CASE WHEN deleted_at IS NULL THEN 1 END', persisted=True))
+
+    @classmethod
+    def active(cls):
+        return cls.query.filter(cls.deleted_at.is_(None))
+
+
+class VersionedMixin:
+    """optimistic locking: each UPDATE checks and increments version_id, see versioning.py"""
+    version_id = db.Column(db.Integer, nullable=False, server_default='1')
+
+    @declared_attr
+    def __mapper_args__(cls):
+        return {'version_id_col': cls.version_id}
+
+
+def serialize_reference(instance, name):
+    """
+    serialize() of instance.<name>, a Comuna, Region or Category, built once per session (request)
+    and id: big responses repeat the same few of them thousands of times, each comuna also loading
+    its region. The relationship isn't loaded again once its dict is memoized. The dict is shared,
+    copy it before changing it.
+    """
+    related = instance.__dict__.get(name, instance) # loaded or just assigned, the foreign key may be outdated
+    if related is None:
+        return None
+    if related is instance:
+        key = getattr(instance, name + '_id')
+        related = None
+    else:
+        key = related.id
+    session = object_session(instance)
+    if key is None or session is None: # pending or detached
+        related = related or getattr(instance, name)
+        return related.serialize() if related is not None else None
+    memo = session.info.setdefault('serialized_references', {}) # (table, id) -> dict, relationships are named after their table
+    value = memo.get((name, key))
+    if value is None:
+        value = memo[(name, key)] = (related or getattr(instance, name)).serialize()
+    return value
+
+
+def serialize_references(instance, name):
+    """serialize() of each object of a collection of reference entities (ej: provider categories), memoized the same way"""
+    session = object_session(instance)
+    if session is None:
+        return [obj.serialize() for obj in getattr(instance, name)]
+    memo = session.info.setdefault('serialized_references', {})
+    values = []
+    for obj in getattr(instance, name):
+        value = memo.get((obj.__tablename__, obj.id))
+        if value is None:
+            value = memo[(obj.__tablename__, obj.id)] = obj.serialize()
+        values.append(value)
+    return values
+
+
+def _forget_references(session, flush_context):
+    if 'serialized_references' in session.info and any(
+        getattr(obj, '__tablename__', None) in REFERENCE_TABLES for obj in session.dirty | session.new | session.deleted
+    ):
+        session.info.pop('serialized_references')
+
+
+event.listen(RoutingSession, 'after_flush', _forget_references)
+# like the loaded attributes, the memo doesn't outlive the transaction
+event.listen(RoutingSession, 'after_commit', lambda session: session.info.pop('serialized_references', None))
 
 # Join table between user and category
 provider_category = db.Table('provider_catgory', db.metadata,
-    db.Column("provider_id", db.Integer, db.ForeignKey("provider.id")),
-    db.Column("category_id", db.Integer, db.ForeignKey("category.id"))
+    db.Column("provider_id", db.Integer, db.ForeignKey("provider.id"), index=True),
+    db.Column("category_id", db.Integer, db.ForeignKey("category.id"), index=True)
 )
 
 
-class User(db.Model):
+class User(VersionedMixin, db.Model):
     __tablename__ = 'user'
     id = db.Column(db.Integer, primary_key=True)
     role = db.Column(db.String(10), default='client', nullable=False) # Role is client or admin
@@ -46,10 +139,19 @@ class User(db.Model):
                 'street': self.street,
                 'home_number': self.home_number,
                 'more_info': self.more_info,
-                'comuna': self.comuna.serialize()
+                'comuna': serialize_reference(self, 'comuna')
             }
         }
 
+    def serialize_basic_info(self):
+        """name and picture, for lists of other users' content (ej: the author of a review)"""
+        return {
+            'id': self.id,
+            'profile_img': self.profile_img,
+            'first_name': self.fname,
+            'last_name': self.lname,
+        }
+
     def serialize_private_info(self):
         return {
             'email': self.email,
@@ -73,16 +175,19 @@ class Employer(db.Model):
     contracts = db.relationship('Contract', back_populates='employer', lazy=True)
     requests = db.relationship('Request', back_populates='employer', lazy=True)
     reviews = db.relationship('Review', back_populates='employer', lazy=True) # reviews obtained as employer
+    review_summary = db.relationship('ReviewSummary', uselist=False, viewonly=True, lazy=True,
+        primaryjoin="and_(foreign(ReviewSummary.user_id) == Employer.id, ReviewSummary.role == 'employer')")
 
     def __repr__(self):
         return '<Employer %r>' % self.id
 
-    def serialize(self):
+    def serialize(self, contracts=None, requests=None):
+        """`contracts` and `requests` serialized from every database (sharding.py), the current one's by default"""
         return {
             'score': self.score,
-            'contracts': list(map(lambda x: x.serialize(), self.contracts)),
-            'requests': list(map(lambda x: x.serialize(), self.requests)),
-            'reviews': list(map(lambda x: x.serialize(), self.reviews)),
+            'contracts': contracts if contracts is not None else list(map(lambda x: x.serialize(), self.contracts)),
+            'requests': requests if requests is not None else list(map(lambda x: x.serialize(), self.requests)),
+            'review_summary': ReviewSummary.serialize_or_empty(self.review_summary), # reviews are listed in /employer/<id>/reviews
         }
 
     def serialize_public_info(self):
@@ -99,41 +204,45 @@ class Provider(db.Model):
     contracts = db.relationship('Contract', back_populates='provider', lazy=True)
     offers = db.relationship('Offer', back_populates='provider', lazy=True)
     reviews = db.relationship('Review', back_populates='provider', lazy=True)
+    review_summary = db.relationship('ReviewSummary', uselist=False, viewonly=True, lazy=True,
+        primaryjoin="and_(foreign(ReviewSummary.user_id) == Provider.id, ReviewSummary.role == 'provider')")
 
     def __repr__(self):
         return '<Provider %r>' % self.id
 
     def serialize_categories(self):
         return {
-            'categories': list(map(lambda x: x.serialize(), self.categories))
+            'categories': serialize_references(self, 'categories')
         }
 
-    def serialize(self):
+    def serialize(self, contracts=None, offers=None):
+        """`contracts` and `offers` serialized from every database (sharding.py), the current one's by default"""
         return {
             'score': self.score,
-            'contracts': list(map(lambda x: x.serialize(), self.contracts)),
-            'offers': list(map(lambda x: x.serialize(), self.offers)),
-            'reviews': list(map(lambda x: x.serialize(), self.reviews)),
-            'categories': list(map(lambda x: x.serialize(), self.categories))
+            'contracts': contracts if contracts is not None else list(map(lambda x: x.serialize(), self.contracts)),
+            'offers': offers if offers is not None else list(map(lambda x: x.serialize(), self.offers)),
+            'review_summary': ReviewSummary.serialize_or_empty(self.review_summary), # reviews are listed in /provider/<id>/reviews
+            'categories': serialize_references(self, 'categories')
         }
 
     def serialize_public_info(self):
         return dict({
             'score': self.score, 
-            'categories': list(map(lambda x: x.serialize(), self.categories))},
+            'categories': serialize_references(self, 'categories')},
             **self.user.serialize()
         )
 
 
-class Contract(db.Model):
+class Contract(VersionedMixin, db.Model):
     __tablename__ = 'contract'
     id = db.Column(db.Integer, primary_key=True)
     contract_status = db.Column(db.String(10), default = 'active', nullable=False) # status options: active, paused, cancelled
     contract_start_date = db.Column(db.DateTime, default = datetime.now, nullable=False)
     contract_end_date = db.Column(db.DateTime)
-    employer_id = db.Column(db.Integer, db.ForeignKey('employer.id'))
-    provider_id = db.Column(db.Integer, db.ForeignKey('provider.id'))
-    service_id = db.Column(db.Integer, db.ForeignKey('request.id'))
+    employer_id = db.Column(db.Integer, db.ForeignKey('employer.id'), index=True)
+    provider_id = db.Column(db.Integer, db.ForeignKey('provider.id'), index=True)
+    service_id = db.Column(db.Integer, db.ForeignKey('request.id'), index=True)
+    updated_date = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now, index=True) # see Request.updated_date
 
     employer = db.relationship('Employer', back_populates='contracts', uselist=False, lazy=True)
     provider = db.relationship('Provider', back_populates='contracts', uselist=False, lazy=True)
@@ -146,7 +255,7 @@ class Contract(db.Model):
         return {
             'id': self.id,
             'status': self.contract_status,
-            'start_date': self.contract_date,
+            'start_date': self.contract_start_date,
             'end_date': self.contract_end_date,
             'service_id': self.service_id
         }
@@ -161,11 +270,15 @@ class Contract(db.Model):
         return {'service': self.request.serialize()}
 
 
-class Category(db.Model):
+class Category(SoftDeleteMixin, VersionedMixin, db.Model):
     __tablename__ = 'category'
+    __table_args__ = (
+        active_index('uq_category_name', 'name', unique=True),
+        active_index('uq_category_logo', 'logo', unique=True),
+    )
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(60), unique=True, nullable=False)
-    logo = db.Column(db.String(60), unique=True, nullable=False) #From Font-awsome
+    name = db.Column(db.String(60), nullable=False)
+    logo = db.Column(db.String(60), nullable=False) #From Font-awsome
 
     providers = db.relationship('Provider', secondary=provider_category, back_populates='categories', lazy=True) #many to many with provider
     requests = db.relationship('Request', back_populates='category', lazy=True)
@@ -181,8 +294,19 @@ class Category(db.Model):
         }
 
 
-class Request(db.Model):
+# Request status state machine, closed requests are moved to the archive tables by archive.py
+REQUEST_TRANSITIONS = {
+    'active': {'paused', 'closed'},
+    'paused': {'active', 'closed'},
+    'closed': set(),
+}
+
+
+class Request(VersionedMixin, db.Model):
     __tablename__ = 'request'
+    __table_args__ = (
+        db.Index('ix_request_search', 'comuna_id', 'service_status', 'category_id'), # filters of /find/service-request
+    )
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(60), nullable=False)
     description = db.Column(db.Text, nullable=False)
@@ -190,10 +314,12 @@ class Request(db.Model):
     home_number = db.Column(db.String(20), nullable=False)
     more_info = db.Column(db.String(60))
     creation_date = db.Column(db.DateTime, default=datetime.now)
+    closed_date = db.Column(db.DateTime)
     service_status = db.Column(db.String(20), default='active') #options are: active, paused, closed
-    employer_id = db.Column(db.Integer, db.ForeignKey('employer.id'))
+    employer_id = db.Column(db.Integer, db.ForeignKey('employer.id'), index=True)
     category_id = db.Column(db.Integer, db.ForeignKey('category.id'))
     comuna_id = db.Column(db.Integer, db.ForeignKey('comuna.id'))
+    updated_date = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now, index=True) # set by the ORM and Core UPDATEs too, incremental exports (export.py)
 
     employer = db.relationship('Employer', back_populates='requests', uselist=False, lazy=True)
     category = db.relationship('Category', back_populates='requests', uselist=False, lazy=True)
@@ -211,12 +337,12 @@ class Request(db.Model):
             'description': self.description,
             'date_created': self.creation_date,
             'status': self.service_status,
-            'category': self.category.serialize(),
+            'category': serialize_reference(self, 'category'),
             'address': {
                 'street': self.street,
                 'home_number': self.home_number,
                 'more_info': self.more_info,
-                'comuna': self.comuna.serialize()
+                'comuna': serialize_reference(self, 'comuna')
             },
             'employer': self.employer.user.fname,
         }
@@ -232,14 +358,30 @@ class Request(db.Model):
             return {'contract': "No contract"}
         return {'contract': self.contract.serialize()}
 
-class Offer(db.Model):
+    def can_change_to(self, status):
+        return status in REQUEST_TRANSITIONS.get(self.service_status, ())
+
+# Offer status state machine, key: current status, value: statuses it can move to
+OFFER_TRANSITIONS = {
+    'active': {'accepted', 'rejected', 'withdrawn'},
+    'accepted': set(),
+    'rejected': set(),
+    'withdrawn': set(),
+}
+
+
+class Offer(VersionedMixin, db.Model):
     __tablename__ = 'offer'
+    __table_args__ = (
+        db.Index('ix_offer_request_status', 'request_id', 'status'), # offers of a request by status, used by the batch transitions
+    )
     id = db.Column(db.Integer, primary_key=True)
     offer_date = db.Column(db.DateTime, default=datetime.now)
     description = db.Column(db.Text)
-    status = db.Column(db.String(30), default='active')
-    provider_id = db.Column(db.Integer, db.ForeignKey('provider.id'))
+    status = db.Column(db.String(30), default='active', nullable=False) # options in OFFER_TRANSITIONS
+    provider_id = db.Column(db.Integer, db.ForeignKey('provider.id'), index=True)
     request_id = db.Column(db.Integer, db.ForeignKey('request.id'))
+    updated_date = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now, index=True) # see Request.updated_date
 
     provider = db.relationship('Provider', back_populates='offers', uselist=False, lazy=True)
     request = db.relationship('Request', back_populates='offers', uselist=False, lazy=True)
@@ -247,6 +389,9 @@ class Offer(db.Model):
     def __repr__(self):
         return '<Offer %r>' % self.id
 
+    def can_change_to(self, status):
+        return status in OFFER_TRANSITIONS.get(self.status, ())
+
     def serialize(self):
         return {
             'id': self.id,
@@ -265,10 +410,16 @@ class Offer(db.Model):
 
 class Review(db.Model):
     __tablename__ = 'review'
+    __table_args__ = (
+        db.UniqueConstraint('contract_id', 'review_author', name='uq_review_contract_author'), # one review per party of a contract
+        db.Index('ix_review_provider_date', 'provider_id', 'review_date'),
+        db.Index('ix_review_employer_date', 'employer_id', 'review_date'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     score = db.Column(db.Integer, nullable=False) # score del 1 al 5
     body = db.Column(db.Text)
     review_date = db.Column(db.DateTime, default=datetime.now)
+    contract_id = db.Column(db.Integer) # contract.id, no foreign key: the contract can be in a region database (sharding.py)
     review_author = db.Column(db.Integer, db.ForeignKey('user.id')) # user who makes the review
     provider_id = db.Column(db.Integer, db.ForeignKey('provider.id')) #provider being evaluated
     employer_id = db.Column(db.Integer, db.ForeignKey('employer.id')) #employer being evaluated
@@ -286,7 +437,7 @@ class Review(db.Model):
             'score': self.score,
             'body': self.body,
             'date': self.review_date,
-            'review_author': self.user.serialize(),
+            'review_author': self.user.serialize_basic_info(),
         }
     
     def serialize_employer(self): #employer who owns the review
@@ -296,10 +447,233 @@ class Review(db.Model):
         return {'provider': self.provider.serialize_public_info()}
 
 
-class Region(db.Model):
+class ReviewSummary(db.Model):
+    """
+    Aggregated reviews of a user as provider or as employer, kept up to date by reviews.py
+    when a review is created, so profiles don't need to load the review rows.
+    """
+    __tablename__ = 'review_summary'
+    role = db.Column(db.String(10), primary_key=True) # provider or employer
+    user_id = db.Column(db.Integer, primary_key=True)
+    count = db.Column(db.Integer, default=0, nullable=False)
+    total = db.Column(db.Integer, default=0, nullable=False) # sum of the scores
+    score_1 = db.Column(db.Integer, default=0, nullable=False)
+    score_2 = db.Column(db.Integer, default=0, nullable=False)
+    score_3 = db.Column(db.Integer, default=0, nullable=False)
+    score_4 = db.Column(db.Integer, default=0, nullable=False)
+    score_5 = db.Column(db.Integer, default=0, nullable=False)
+
+    def __repr__(self):
+        return '<ReviewSummary %r %r>' % (self.role, self.user_id)
+
+    def serialize(self):
+        return {
+            'count': self.count,
+            'mean': round(self.total / self.count, 2) if self.count else None,
+            'histogram': {str(n): getattr(self, 'score_%s' % n) for n in range(1, 6)},
+        }
+
+    @staticmethod
+    def serialize_or_empty(summary):
+        if summary is None:
+            return {'count': 0, 'mean': None, 'histogram': {str(n): 0 for n in range(1, 6)}}
+        return summary.serialize()
+
+
+class RequestArchive(db.Model):
+    """closed or expired service requests, same columns as Request plus the archive date"""
+    __tablename__ = 'request_archive'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    name = db.Column(db.String(60), nullable=False)
+    description = db.Column(db.Text, nullable=False)
+    street = db.Column(db.String(60), nullable=False)
+    home_number = db.Column(db.String(20), nullable=False)
+    more_info = db.Column(db.String(60))
+    creation_date = db.Column(db.DateTime)
+    closed_date = db.Column(db.DateTime)
+    service_status = db.Column(db.String(20))
+    employer_id = db.Column(db.Integer, index=True)
+    category_id = db.Column(db.Integer)
+    comuna_id = db.Column(db.Integer)
+    archived_date = db.Column(db.DateTime, default=datetime.now, nullable=False)
+
+    def __repr__(self):
+        return '<RequestArchive %r>' % self.id
+
+
+class OfferArchive(db.Model):
+    """offers of the archived service requests"""
+    __tablename__ = 'offer_archive'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    offer_date = db.Column(db.DateTime)
+    description = db.Column(db.Text)
+    status = db.Column(db.String(30))
+    provider_id = db.Column(db.Integer, index=True)
+    request_id = db.Column(db.Integer, index=True)
+    archived_date = db.Column(db.DateTime, default=datetime.now, nullable=False)
+
+    def __repr__(self):
+        return '<OfferArchive %r>' % self.id
+
+
+class RevokedToken(db.Model):
+    """
+    Denylist of access tokens. A row with jti revokes that token, a row without jti revokes
+    every token of `identity` issued before `issued_before` (logout from all sessions).
+    Rows are useless once `expires` passes, the tokens they revoke have expired too.
+    """
+    __tablename__ = 'revoked_token'
+    id = db.Column(db.Integer, primary_key=True)
+    jti = db.Column(db.String(36), unique=True)
+    identity = db.Column(db.String(120), nullable=False, index=True) # user email
+    issued_before = db.Column(db.Integer) # epoch seconds, only for rows without jti
+    revoked_date = db.Column(db.DateTime, default=datetime.now, nullable=False)
+    expires = db.Column(db.DateTime, nullable=False, index=True)
+
+    def __repr__(self):
+        return '<RevokedToken %r>' % (self.jti or self.identity)
+
+
+class QueuedJob(db.Model):
+    """
+    Background jobs of the 'database' JOBS_BACKEND, see jobs.py. A job is added in the same
+    transaction as the change that needs it, so it's never lost once that change is committed.
+    Finished jobs are deleted, failed ones are kept with their last error.
+    """
+    __tablename__ = 'job'
+    __table_args__ = (
+        db.Index('ix_job_status_run_after', 'status', 'run_after'), # next queued job
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(60), nullable=False)
+    args = db.Column(db.Text, nullable=False) # json list
+    status = db.Column(db.String(10), default='queued', nullable=False) # queued, running, failed
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    run_after = db.Column(db.DateTime, default=datetime.now, nullable=False)
+    started_date = db.Column(db.DateTime)
+    last_error = db.Column(db.Text)
+    created_date = db.Column(db.DateTime, default=datetime.now, nullable=False)
+
+    def __repr__(self):
+        return '<QueuedJob %r %r>' % (self.id, self.name)
+
+
+class DeletionTask(db.Model):
+    """
+    Cascade of a deleted region, comuna or category, run in the background by deletions.py.
+    processed / total rows of the dependent tables updated so far.
+    """
+    __tablename__ = 'deletion_task'
+    id = db.Column(db.Integer, primary_key=True)
+    entity_type = db.Column(db.String(20), nullable=False) # region, comuna or category
+    entity_id = db.Column(db.Integer, nullable=False)
+    reassign_to = db.Column(db.Integer) # id of the same type taking the dependent rows, None: unset
+    status = db.Column(db.String(10), default='queued', nullable=False) # queued, running, done
+    total = db.Column(db.Integer, default=0, nullable=False)
+    processed = db.Column(db.Integer, default=0, nullable=False)
+    created_date = db.Column(db.DateTime, default=datetime.now, nullable=False)
+    finished_date = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return '<DeletionTask %r %r %r>' % (self.id, self.entity_type, self.entity_id)
+
+    def serialize(self):
+        return {
+            'id': self.id,
+            'entity': self.entity_type,
+            'entity_id': self.entity_id,
+            'reassign_to': self.reassign_to,
+            'status': self.status,
+            'total': self.total,
+            'processed': self.processed,
+            'progress': round(100.0 * self.processed / self.total, 1) if self.total else (100.0 if self.status == 'done' else 0.0),
+            'created_date': self.created_date,
+            'finished_date': self.finished_date
+        }
+
+
+class ActivityDaily(db.Model):
+    """
+    Requests, offers and contracts created per day, comuna and category, see metrics.py.
+    comuna_id / category_id 0: the request had none.
+    """
+    __tablename__ = 'activity_daily'
+    __table_args__ = (
+        db.Index('uq_activity_daily_bucket', 'day', 'comuna_id', 'category_id', unique=True),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    day = db.Column(db.Date, nullable=False)
+    comuna_id = db.Column(db.Integer, nullable=False) # no foreign keys: buckets outlive the comunas
+    category_id = db.Column(db.Integer, nullable=False)
+    requests = db.Column(db.Integer, default=0, nullable=False)
+    offers = db.Column(db.Integer, default=0, nullable=False)
+    contracts = db.Column(db.Integer, default=0, nullable=False)
+
+    def __repr__(self):
+        return '<ActivityDaily %r %r %r>' % (self.day, self.comuna_id, self.category_id)
+
+
+class RollupWatermark(db.Model):
+    """highest id of each source table (and database, when sharded) already counted in ActivityDaily"""
+    __tablename__ = 'rollup_watermark'
+    source = db.Column(db.String(40), primary_key=True) # ej: offer, offer@13
+    last_id = db.Column(db.Integer, default=0, nullable=False)
+    updated_date = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return '<RollupWatermark %r %r>' % (self.source, self.last_id)
+
+
+class ReferenceVersion(db.Model):
+    """incremented by each change of regions, comunas and categories: a snapshot built from an older one is stale (snapshot.py)"""
+    __tablename__ = 'reference_version'
+    id = db.Column(db.Integer, primary_key=True) # a single row, id 1
+    version = db.Column(db.Integer, default=0, nullable=False)
+
+    def __repr__(self):
+        return '<ReferenceVersion %r>' % self.version
+
+
+class AuditEvent(db.Model):
+    """
+    Append-only log of the changes made through the api, see audit.py. Rows are never updated,
+    they're written in batches a few seconds after the change commits.
+    """
+    __tablename__ = 'audit_event'
+    __table_args__ = (
+        db.Index('ix_audit_event_entity', 'entity_type', 'entity_id', 'created_date'), # history of one row
+        db.Index('ix_audit_event_created_date', 'created_date'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    created_date = db.Column(db.DateTime, nullable=False) # when the change committed
+    action = db.Column(db.String(40), nullable=False) # ej: offer.accept
+    entity_type = db.Column(db.String(30), nullable=False) # table name
+    entity_id = db.Column(db.Integer)
+    actor_id = db.Column(db.Integer) # user id, no foreign key: events outlive users
+    data = db.Column(db.Text) # json object
+
+    def __repr__(self):
+        return '<AuditEvent %r %r>' % (self.id, self.action)
+
+    def serialize(self):
+        return {
+            'id': self.id,
+            'date': self.created_date,
+            'action': self.action,
+            'entity': self.entity_type,
+            'entity_id': self.entity_id,
+            'actor_id': self.actor_id,
+            'data': json.loads(self.data) if self.data else {}
+        }
+
+
+class Region(SoftDeleteMixin, db.Model):
     __tablename__ = 'region'
+    __table_args__ = (
+        active_index('uq_region_name', 'name', unique=True),
+    )
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(60), nullable = False, unique=True)
+    name = db.Column(db.String(60), nullable = False)
 
     comunas = db.relationship('Comuna', back_populates='region', lazy=True)
 
@@ -312,10 +686,14 @@ class Region(db.Model):
             'name': self.name,
         }
 
-class Comuna(db.Model):
+class Comuna(SoftDeleteMixin, db.Model):
     __tablename__ = 'comuna'
+    __table_args__ = (
+        active_index('uq_comuna_name', 'name', unique=True),
+        active_index('ix_comuna_region_active', 'region_id'), # comunas of a region
+    )
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(60), nullable = False, unique=True)
+    name = db.Column(db.String(60), nullable = False)
     region_id = db.Column(db.Integer, db.ForeignKey('region.id'))
 
     region = db.relationship('Region', back_populates='comunas', uselist=False, lazy=True)
@@ -330,7 +708,7 @@ class Comuna(db.Model):
             'id': self.id,
             'name': self.name,
             'region_id': self.region_id,
-            'region_name': self.region.name
+            'region_name': serialize_reference(self, 'region')['name']
         }
     
     def serialize_region(self):
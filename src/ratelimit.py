@@ -0,0 +1,149 @@
+"""
+Token bucket rate limiting.
+Each limited endpoint has a scope in RATELIMITS (config.py) with a per-IP and/or a per-identity
+rate like '10/minute'. The `rate_limit` decorator consumes one token of each bucket and answers
+429 before the view runs, so rejected requests never reach the DB or the password checks.
+
+The default store keeps the buckets in the worker memory. With several workers or dynos each
+one enforces the limit on its own, set RATELIMIT_STORAGE_URL=redis://... to share them.
+"""
+import math
+import time
+from functools import wraps
+
+from flask import current_app, jsonify, request
+from flask_jwt_extended import get_jwt_identity
+
+PERIODS = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400}
+
+
+def parse_rate(rate):
+    """'10/minute' -> (capacity=10, refill rate in tokens per second)"""
+    amount, period = rate.split('/')
+    amount = int(amount)
+    return amount, amount / float(PERIODS[period.strip()])
+
+
+class MemoryStore:
+    """
+    In-process buckets. The state of a bucket is a (tokens, timestamp) tuple replaced with a
+    single dict assignment and no lock: two racing requests may read the same state and one
+    of them is not counted, which only makes the limit a bit lenient under contention.
+    """
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self._buckets = {}
+
+    def consume(self, key, capacity, rate, cost=1):
+        """returns (allowed, seconds until `cost` tokens are available)"""
+        now = time.monotonic()
+        tokens, last = self._buckets.get(key, (capacity, now))
+        tokens = min(capacity, tokens + (now - last) * rate)
+        allowed = tokens >= cost
+        self._buckets[key] = (tokens - cost if allowed else tokens, now)
+        if len(self._buckets) > self.max_keys:
+            self._evict(now)
+        return allowed, 0 if allowed else (cost - tokens) / rate
+
+    def _evict(self, now):
+        # buckets untouched for an hour are full again, forgetting them changes nothing
+        for key, (tokens, last) in list(self._buckets.items()):
+            if now - last > 3600:
+                self._buckets.pop(key, None)
+
+
+class RedisStore:
+    """Buckets shared by every worker, the refill and consume run atomically in a Lua script."""
+    SCRIPT = """
+    local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+    local capacity, rate, now, cost = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3]), tonumber(ARGV[4])
+    local tokens = math.min(capacity, (tonumber(state[1]) or capacity) + (now - (tonumber(state[2]) or now)) * rate)
+    local allowed = 0
+    if tokens >= cost then
+        tokens = tokens - cost
+        allowed = 1
+    end
+    redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+    redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+    return {allowed, tostring(tokens)}
+    """
+
+    def __init__(self, url):
+        import redis # optional dependency, only needed for this store
+        self._client = redis.Redis.from_url(url)
+        self._script = self._client.register_script(self.SCRIPT)
+
+    def consume(self, key, capacity, rate, cost=1):
+        allowed, tokens = self._script(keys=['ratelimit:%s' % key], args=[capacity, rate, time.time(), cost])
+        if allowed:
+            return True, 0
+        return False, (cost - float(tokens)) / rate
+
+
+def init_rate_limiting(app):
+    url = app.config['RATELIMIT_STORAGE_URL']
+    if url.startswith('memory://'):
+        app.extensions['rate_limiter'] = MemoryStore()
+    elif url.startswith('redis://') or url.startswith('rediss://'):
+        app.extensions['rate_limiter'] = RedisStore(url)
+    else:
+        raise ValueError('unknown RATELIMIT_STORAGE_URL: %s' % url)
+
+
+def client_ip():
+    # behind heroku's router the real client is the last address added to X-Forwarded-For
+    proxies = current_app.config['RATELIMIT_PROXY_COUNT']
+    route = request.access_route
+    if proxies and len(route) >= proxies:
+        return route[-proxies]
+    return request.remote_addr
+
+
+def jwt_identity():
+    """identity of the verified access token, the decorator must go below @jwt_required"""
+    return get_jwt_identity()
+
+
+def json_field(name):
+    """identity taken from the JSON body, ej: the email of /login"""
+    def identity():
+        body = request.get_json(silent=True)
+        value = body.get(name) if isinstance(body, dict) else None
+        return value.strip().lower() if isinstance(value, str) else None
+    return identity
+
+
+def rate_limit(scope, identity=None, cost=None):
+    """
+    Decorator, applies the limits of RATELIMITS[scope]:
+        {'ip': '20/minute', 'identity': '5/minute'}
+    `identity` is a function returning the key of the per-identity bucket, `cost` one returning
+    the tokens the request consumes (1 without it).
+    """
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            config = current_app.config
+            if config['RATELIMIT_ENABLED']:
+                limits = config['RATELIMITS'][scope]
+                keys = []
+                if 'ip' in limits:
+                    keys.append((limits['ip'], '%s:ip:%s' % (scope, client_ip())))
+                if 'identity' in limits and identity is not None:
+                    who = identity()
+                    if who is not None:
+                        keys.append((limits['identity'], '%s:id:%s' % (scope, who)))
+
+                store = current_app.extensions['rate_limiter']
+                tokens = cost() if cost is not None else 1
+                for rate, key in keys:
+                    capacity, refill = parse_rate(rate)
+                    allowed, retry_after = store.consume(key, capacity, refill, min(tokens, capacity))
+                    if not allowed:
+                        retry_after = int(math.ceil(retry_after))
+                        response = jsonify({'Error': 'Demasiadas solicitudes, intenta de nuevo en %s segundos' %retry_after})
+                        response.headers['Retry-After'] = str(retry_after)
+                        return response, 429
+            return fn(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,85 @@
+"""
+Review summaries (count, mean and 1-5 histogram) of every provider and employer.
+A new review adds to its summary row with a single UPDATE ... SET count = count + 1, and the
+provider/employer `score` is refreshed from it by a background job once the review is committed.
+Profiles read the summary, not the reviews.
+
+to rebuild every summary from the review table (ej: after importing reviews):
+    $ flask rebuild-review-summaries
+"""
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import and_, case, func, select
+from sqlalchemy.exc import IntegrityError
+
+from cache import mark_stale
+from jobs import job, enqueue_after_commit
+from models import db, Review, ReviewSummary, Provider, Employer
+
+SCORES = range(1, 6)
+ROLE_MODELS = {'provider': Provider, 'employer': Employer}
+
+
+def _refresh_score(role, user_id=None):
+    """copies the mean of the summaries to provider.score / employer.score"""
+    summary_t, model_t = ReviewSummary.__table__, ROLE_MODELS[role].__table__
+    mean = select([summary_t.c.total * 1.0 / summary_t.c.count]).where(and_(
+        summary_t.c.role == role,
+        summary_t.c.user_id == model_t.c.id,
+        summary_t.c.count > 0
+    )).as_scalar()
+    query = model_t.update().values(score=func.coalesce(mean, 0))
+    if user_id is not None:
+        query = query.where(model_t.c.id == user_id)
+    db.session.execute(query)
+
+
+@job('refresh-score')
+def refresh_score(role, user_id):
+    _refresh_score(role, user_id)
+    mark_stale(ROLE_MODELS[role].query.get(user_id)) # core UPDATE, the cache hooks don't see it
+    db.session.commit()
+
+
+def add_review_to_summary(role, user_id, score):
+    """role: 'provider' or 'employer', the side of the contract being reviewed"""
+    table = ReviewSummary.__table__
+    where = and_(table.c.role == role, table.c.user_id == user_id)
+    increment = {
+        'count': table.c.count + 1,
+        'total': table.c.total + score,
+        'score_%s' % score: table.c['score_%s' % score] + 1,
+    }
+    if db.session.execute(table.update().where(where).values(increment)).rowcount == 0:
+        try:
+            with db.session.begin_nested():
+                db.session.execute(table.insert().values(
+                    role=role, user_id=user_id, count=1, total=score,
+                    **{'score_%s' % n: int(n == score) for n in SCORES}
+                ))
+        except IntegrityError: # another request created the row first
+            db.session.execute(table.update().where(where).values(increment))
+    enqueue_after_commit('refresh-score', role, user_id)
+
+
+def rebuild_review_summaries():
+    summary_t, review_t = ReviewSummary.__table__, Review.__table__
+    db.session.execute(summary_t.delete())
+    for role, column in (('provider', review_t.c.provider_id), ('employer', review_t.c.employer_id)):
+        db.session.execute(summary_t.insert().from_select(
+            ['role', 'user_id', 'count', 'total'] + ['score_%s' % n for n in SCORES],
+            select(
+                [db.literal(role), column, func.count(review_t.c.id), func.sum(review_t.c.score)] +
+                [func.sum(case([(review_t.c.score == n, 1)], else_=0)) for n in SCORES]
+            ).where(column.isnot(None)).group_by(column)
+        ))
+        _refresh_score(role)
+    db.session.commit()
+
+
+@click.command('rebuild-review-summaries')
+@with_appcontext
+def rebuild_summaries_command():
+    """Recompute every review summary from the review table."""
+    rebuild_review_summaries()
+    click.echo('%s review summaries rebuilt' % ReviewSummary.query.count())
@@ -0,0 +1,155 @@
+"""
+Access token revocation (logout).
+Revoked tokens are stored in the revoked_token table, and every worker keeps a bloom filter
+built from it. A token whose jti and identity are not in the filter is not revoked, that's
+the answer for almost every request and it costs no query. Only possible matches (revoked
+tokens and the rare false positive, TOKEN_REVOCATION_ERROR_RATE) are confirmed against the table.
+
+The filter is rebuilt in a background thread every TOKEN_REVOCATION_REFRESH seconds. Tokens
+revoked by this worker are added to it right away, the other workers see them after their
+next rebuild, so a revoked token can still be used on another worker for at most that long.
+"""
+import hashlib
+import math
+import threading
+import time
+from datetime import datetime
+
+from flask import current_app
+from flask_jwt_extended.config import config
+from sqlalchemy import and_, or_
+
+from models import db, RevokedToken
+
+
+class BloomFilter:
+    def __init__(self, capacity, error_rate=0.001):
+        capacity = max(capacity, 1)
+        self.size = max(int(-capacity * math.log(error_rate) / (math.log(2) ** 2)), 8)
+        self.hashes = max(int(round(self.size / capacity * math.log(2))), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        h1, h2 = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, key):
+        for pos in self._positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, key):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+
+
+def _jti_key(jti):
+    return 'jti:%s' % jti
+
+
+def _identity_key(identity):
+    return 'id:%s' % identity
+
+
+class RevocationList:
+    def __init__(self, app):
+        self.app = app
+        self.refresh = app.config['TOKEN_REVOCATION_REFRESH']
+        self.error_rate = app.config['TOKEN_REVOCATION_ERROR_RATE']
+        self._bloom = None
+        self._built_at = 0
+        self._recent = set() # keys added while a rebuild is running
+        self._lock = threading.Lock()
+        self._rebuilding = False
+
+    def _build(self):
+        now = datetime.now()
+        count = RevokedToken.query.filter(RevokedToken.expires >= now).count()
+        bloom = BloomFilter(count * 2 + 1024, self.error_rate)
+        rows = db.session.query(RevokedToken.jti, RevokedToken.identity) \
+            .filter(RevokedToken.expires >= now).yield_per(5000)
+        for jti, identity in rows:
+            bloom.add(_jti_key(jti) if jti is not None else _identity_key(identity))
+        return bloom
+
+    def _rebuild_in_background(self):
+        with self.app.app_context():
+            try:
+                # expired rows revoke nothing anymore
+                RevokedToken.query.filter(RevokedToken.expires < datetime.now()).delete(synchronize_session=False)
+                db.session.commit()
+                bloom = self._build()
+                with self._lock:
+                    for key in self._recent:
+                        bloom.add(key)
+                    self._bloom, self._built_at = bloom, time.monotonic()
+            finally:
+                db.session.remove()
+                with self._lock:
+                    self._recent.clear()
+                    self._rebuilding = False
+
+    def _current(self):
+        if self._bloom is None: # first use in this worker, the filter is needed right now
+            with self._lock:
+                if self._bloom is None:
+                    self._bloom, self._built_at = self._build(), time.monotonic()
+        elif time.monotonic() - self._built_at > self.refresh and not self._rebuilding:
+            with self._lock:
+                if not self._rebuilding:
+                    self._rebuilding = True
+                    threading.Thread(target=self._rebuild_in_background, daemon=True).start()
+        return self._bloom
+
+    def _remember(self, key):
+        bloom = self._current()
+        with self._lock:
+            bloom.add(key)
+            if self._rebuilding:
+                self._recent.add(key)
+
+    def is_revoked(self, claims):
+        bloom = self._current()
+        jti, identity = claims.get('jti'), claims[config.identity_claim_key]
+        if _jti_key(jti) not in bloom and _identity_key(identity) not in bloom:
+            return False
+        # possible match, confirm it in the table
+        return db.session.query(RevokedToken.query.filter(or_(
+            RevokedToken.jti == jti,
+            and_(
+                RevokedToken.jti.is_(None),
+                RevokedToken.identity == identity,
+                RevokedToken.issued_before > claims['iat']
+            )
+        )).exists()).scalar()
+
+    def revoke(self, claims):
+        """revokes one token (logout)"""
+        db.session.add(RevokedToken(
+            jti=claims['jti'],
+            identity=claims[config.identity_claim_key],
+            expires=datetime.fromtimestamp(claims['exp'])
+        ))
+        db.session.commit()
+        self._remember(_jti_key(claims['jti']))
+
+    def revoke_all(self, identity):
+        """
+        revokes every token of `identity` issued before the current second (logout from all
+        sessions). iat has a precision of seconds: a token issued in this same second, like the
+        login that follows the revoke, stays valid.
+        """
+        db.session.add(RevokedToken(
+            identity=identity,
+            issued_before=int(time.time()),
+            expires=datetime.now() + current_app.config['JWT_ACCESS_TOKEN_EXPIRES']
+        ))
+        db.session.commit()
+        self._remember(_identity_key(identity))
+
+
+def init_revocation(app):
+    app.extensions['revocation_list'] = RevocationList(app)
+
+
+def revocation_list():
+    return current_app.extensions['revocation_list']
@@ -0,0 +1,194 @@
+"""
+Read replica routing for the SQLAlchemy session.
+Queries of read-only http requests (GET, HEAD, OPTIONS) go to one of the replicas listed
+in SQLALCHEMY_REPLICA_URIS, chosen round-robin and skipping the ones that failed a health
+check. Everything else goes to the primary (SQLALCHEMY_DATABASE_URI).
+
+After a user writes, its reads are pinned to the primary for REPLICA_PIN_SECONDS
+(read-your-writes), so the SPA never reads data older than its own last change, size it above
+the replica lag. The next request of the user can reach another worker or dyno, so the pins must
+be shared: REPLICA_PIN_STORAGE_URL=redis://... (the RATELIMIT_STORAGE_URL by default) keeps them
+in redis. With memory:// each worker only sees its own pins, fine for a single worker.
+
+to try it locally with two SQLite files:
+    $ cp example.db replica.db
+    $ DB_CONNECTION_STRING=sqlite:///$PWD/example.db DB_REPLICA_CONNECTION_STRINGS=sqlite:///$PWD/replica.db flask run
+"""
+import itertools
+import logging
+import threading
+import time
+
+from flask import g, has_request_context, request
+from flask_jwt_extended import get_jwt_identity
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import create_engine, event, orm
+
+READ_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS'])
+logger = logging.getLogger(__name__)
+
+
+class MemoryPins:
+    """pins of this worker, identity -> monotonic time when the pin expires"""
+    def __init__(self, max_keys=10000):
+        self.max_keys = max_keys
+        self._pins = {}
+
+    def pin(self, identity, seconds):
+        now = time.monotonic()
+        self._pins[identity] = now + seconds
+        if len(self._pins) > self.max_keys: # drop expired pins, keeps the dict bounded
+            for key, until in list(self._pins.items()):
+                if until < now:
+                    self._pins.pop(key, None)
+
+    def is_pinned(self, identity):
+        until = self._pins.get(identity)
+        return until is not None and until > time.monotonic()
+
+
+class RedisPins:
+    """pins shared by every worker, a key expiring with the pin"""
+    def __init__(self, url):
+        import redis # optional dependency, only needed for this store
+        self._client = redis.Redis.from_url(url)
+        self._errors = redis.RedisError
+
+    def pin(self, identity, seconds):
+        try:
+            self._client.set('replica-pin:%s' % identity, 1, px=int(seconds * 1000))
+        except self._errors: # the write itself succeeded, don't fail the request
+            logger.exception('replica pin of %s not saved', identity)
+
+    def is_pinned(self, identity):
+        try:
+            return bool(self._client.exists('replica-pin:%s' % identity))
+        except self._errors:
+            return True # unknown: the primary is always up to date
+
+
+def pin_store(url):
+    if url.startswith('memory://'):
+        return MemoryPins()
+    if url.startswith('redis://') or url.startswith('rediss://'):
+        return RedisPins(url)
+    raise ValueError('unknown REPLICA_PIN_STORAGE_URL: %s' % url)
+
+
+class ReplicaRouter:
+    def __init__(self, uris, pin_seconds=5, health_interval=5, retry_seconds=30, pins=None):
+        self.engines = [create_engine(uri, pool_pre_ping=True) for uri in uris]
+        self.pin_seconds = pin_seconds
+        self.health_interval = health_interval
+        self.retry_seconds = retry_seconds
+        self._next = itertools.cycle(range(len(self.engines)))
+        self._down_until = [0.0] * len(self.engines)
+        self._checked_at = [0.0] * len(self.engines)
+        self.pins = pins if pins is not None else MemoryPins()
+        self._lock = threading.Lock()
+
+        for engine in self.engines:
+            event.listen(engine, 'handle_error', self._on_error)
+
+    def _on_error(self, context):
+        if context.is_disconnect or context.connection is None:
+            self.mark_down(context.engine)
+
+    def mark_down(self, engine):
+        self._down_until[self.engines.index(engine)] = time.monotonic() + self.retry_seconds
+
+    def _healthy(self, i, now):
+        if self._down_until[i] > now:
+            return False
+        if now - self._checked_at[i] < self.health_interval:
+            return True
+        self._checked_at[i] = now
+        try:
+            self.engines[i].connect().close() # pool_pre_ping validates the pooled connection
+            return True
+        except Exception:
+            self._down_until[i] = now + self.retry_seconds
+            return False
+
+    def choose(self):
+        """next healthy replica, None if all of them are down"""
+        now = time.monotonic()
+        for _ in range(len(self.engines)):
+            with self._lock:
+                i = next(self._next)
+            if self._healthy(i, now):
+                return self.engines[i]
+        return None
+
+    def pin(self, identity):
+        self.pins.pin(identity, self.pin_seconds)
+
+    def is_pinned(self, identity):
+        return self.pins.is_pinned(identity)
+
+    def dispose(self):
+        for engine in self.engines:
+            engine.dispose()
+
+
+def _router(session):
+    return session.app.extensions.get('replica_router')
+
+
+def _read_engine(router):
+    """replica used by the current request, None when it must use the primary"""
+    if not has_request_context() or request.method not in READ_METHODS or g.get('db_pinned'):
+        return None
+    identity = get_jwt_identity()
+    # chosen again once the token is verified: the queries checking it run without the identity
+    if 'db_replica' not in g or g.db_replica_identity != identity:
+        g.db_replica_identity = identity
+        g.db_replica = None if identity is not None and router.is_pinned(identity) else router.choose()
+    return g.db_replica
+
+
+class RoutingSession(SignallingSession):
+    def get_bind(self, mapper=None, clause=None):
+        shards = self.app.extensions.get('shard_resolver') # see sharding.py
+        if shards is not None:
+            engine = shards.bind(mapper, clause)
+            if engine is not None:
+                return engine
+        router = _router(self)
+        if router is not None and not self._flushing:
+            engine = _read_engine(router)
+            if engine is not None:
+                return engine
+        return SignallingSession.get_bind(self, mapper, clause)
+
+
+def _on_write(session):
+    router = _router(session)
+    if router is None or not has_request_context():
+        return
+    g.db_pinned = True # the rest of this request reads from the primary too
+    identity = get_jwt_identity()
+    if identity is not None:
+        router.pin(identity)
+
+
+event.listen(RoutingSession, 'after_flush', lambda session, flush_context: _on_write(session))
+event.listen(RoutingSession, 'after_bulk_update', lambda context: _on_write(context.session))
+event.listen(RoutingSession, 'after_bulk_delete', lambda context: _on_write(context.session))
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+def init_replicas(app):
+    uris = app.config.get('SQLALCHEMY_REPLICA_URIS')
+    if uris:
+        app.extensions['replica_router'] = ReplicaRouter(
+            uris,
+            pin_seconds=app.config['REPLICA_PIN_SECONDS'],
+            health_interval=app.config['REPLICA_HEALTH_INTERVAL'],
+            retry_seconds=app.config['REPLICA_RETRY_SECONDS'],
+            pins=pin_store(app.config['REPLICA_PIN_STORAGE_URL'])
+        )
@@ -0,0 +1,317 @@
+"""
+Optional horizontal partitioning by region.
+The region tables (request, offer, contract and their archives) of the regions listed in
+SQLALCHEMY_SHARD_URIS live in a database of their own, every other table, and the region tables
+of the regions without a shard, stay in the primary (SQLALCHEMY_DATABASE_URI).
+
+RoutingSession.get_bind sends the statements on region tables to the shard of the current region:
+    - the database holding a row, for the endpoints of a request, offer or contract id
+      (`route_to_row`, in the url or the body)
+    - the region of a comuna, inside `with use_comuna_shard(comuna_id)` (service request creation
+      and search, keyed on the comuna of the request)
+    - otherwise the home region of the logged in user (the region of its comuna)
+    - otherwise (public endpoints, CLI, jobs) the primary
+Queries across regions (the stats of /) run once per database with fan_out(), in a thread pool,
+and their results are merged by the caller.
+
+Ids of the region tables are unique across databases: `flask shards create` starts the ids of
+the shard of region r at r * SHARD_ID_BLOCK, the primary's stay below SHARD_ID_BLOCK. An id from a
+block is in that shard. A lower one was created in the primary and may have been moved to a shard
+by `flask shards move`: the primary is checked first, then the shards (remembered per worker).
+
+Limitations while sharding is on:
+    - a statement can't join region tables with the tables of the primary, related rows are
+      loaded with separate queries (lazy or selectinload), each one routed to its database.
+    - the feed (feed.py) ranks the requests of the provider's home region. The listings of a user
+      (/my-provider-info, /my-employer-info) fan out to every database.
+    - reviews stay in the primary, their contract_id has no foreign key.
+
+    $ DB_SHARD_CONNECTION_STRINGS="13=postgres://.../rm,5=postgres://.../valparaiso" flask shards create
+    $ flask shards move 13      # copies the rows of the region from the primary to its shard
+"""
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import wraps
+
+import click
+from flask import current_app, g, has_app_context, has_request_context, request
+from flask.cli import AppGroup
+from flask_jwt_extended import get_jwt_identity
+from sqlalchemy import MetaData, create_engine, exists, func, select
+from sqlalchemy.sql.util import find_tables
+
+from models import db, User, Comuna, Request, Offer, Contract, RequestArchive, OfferArchive
+
+REGION_TABLES = frozenset(['request', 'offer', 'contract', 'request_archive', 'offer_archive'])
+ID_TABLES = (Request, Offer, Contract) # the archives keep the ids of these
+# moved together by `flask shards move`: (parent, [(child, column referencing parent.id)])
+REGION_GROUPS = (
+    (Request, [(Offer, 'request_id'), (Contract, 'service_id')]),
+    (RequestArchive, [(OfferArchive, 'request_id')]),
+)
+
+
+class ShardResolver:
+    def __init__(self, uris, workers=8, id_block=100000000):
+        self.engines = {int(region_id): create_engine(uri, pool_pre_ping=True) for region_id, uri in uris.items()}
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='shards')
+        self.id_block = id_block
+        self._regions = {} # comuna id -> region id
+        self._moved = {} # (table, id) -> region id, rows moved from the primary to a shard
+
+    def region_of(self, comuna_id):
+        if comuna_id is None:
+            return None
+        if comuna_id not in self._regions:
+            self._regions[comuna_id] = db.session.query(Comuna.region_id).filter(Comuna.id == comuna_id).scalar()
+        return self._regions[comuna_id]
+
+    def region_of_row(self, model, row_id):
+        """region whose database holds row `row_id` of a region table, None for the primary"""
+        if row_id >= self.id_block:
+            return row_id // self.id_block
+        table = model.__table__
+        key = (table.name, row_id)
+        if key in self._moved:
+            return self._moved[key]
+        for region_id in self.databases(): # created in the primary, maybe moved since
+            with use_shard(region_id):
+                if db.session.query(exists().where(table.c.id == row_id)).scalar():
+                    break
+        else:
+            return None
+        if region_id is not None:
+            if len(self._moved) > 100000:
+                self._moved.clear()
+            self._moved[key] = region_id
+        return region_id
+
+    def bind(self, mapper, clause):
+        """shard engine of a statement, None when it goes to the primary"""
+        if not _on_region_tables(mapper, clause):
+            return None
+        return self.engines.get(current_region(self))
+
+    def databases(self):
+        """None (the primary) and the region id of each shard"""
+        return [None] + sorted(self.engines)
+
+    def dispose(self):
+        for engine in self.engines.values():
+            engine.dispose()
+
+
+def _on_region_tables(mapper, clause):
+    if mapper is not None:
+        return mapper.persist_selectable.name in REGION_TABLES
+    if clause is not None:
+        return any(table.name in REGION_TABLES for table in find_tables(clause, include_crud=True))
+    return False
+
+
+def current_region(resolver):
+    """
+    region whose shard serves the region tables now, None for the primary. The home region of
+    the user is only right for its own rows, endpoints of a row by id use route_to_row
+    """
+    if not has_app_context():
+        return None
+    if 'db_shard' not in g:
+        g.db_shard = None # set before the lookup, the query below is routed too
+        identity = get_jwt_identity() if has_request_context() else None
+        if identity is not None:
+            comuna_id = db.session.query(User.comuna_id).filter(User.email == identity).scalar()
+            g.db_shard = resolver.region_of(comuna_id)
+    return g.db_shard
+
+
+def init_shards(app):
+    uris = app.config.get('SQLALCHEMY_SHARD_URIS')
+    if uris:
+        app.extensions['shard_resolver'] = ShardResolver(
+            uris, workers=app.config['SHARD_FANOUT_WORKERS'], id_block=app.config['SHARD_ID_BLOCK']
+        )
+
+
+def shard_resolver():
+    return current_app.extensions.get('shard_resolver')
+
+
+_UNSET = object()
+
+
+@contextmanager
+def use_shard(region_id):
+    """routes the region tables to the shard of `region_id` (None: the primary) inside the block"""
+    previous = g.get('db_shard', _UNSET)
+    g.db_shard = region_id
+    try:
+        yield
+    finally:
+        if previous is _UNSET:
+            g.pop('db_shard', None)
+        else:
+            g.db_shard = previous
+
+
+def use_comuna_shard(comuna_id):
+    resolver = shard_resolver()
+    return use_shard(resolver.region_of(comuna_id) if resolver is not None else None)
+
+
+def route_to_row(model, arg=None, field=None):
+    """
+    Decorator for views on a row of a region table, goes below @validate_json: the region tables
+    go to the database holding the row whose id is the view argument `arg` or the JSON body `field`.
+        @route_to_row(Offer, arg='offer_id')
+    """
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            resolver = shard_resolver()
+            row_id = kwargs.get(arg) if arg is not None else (request.get_json(silent=True) or {}).get(field)
+            if resolver is None or not isinstance(row_id, int):
+                return fn(*args, **kwargs)
+            with use_shard(resolver.region_of_row(model, row_id)):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def fan_out(fn):
+    """
+    runs fn() once per database holding region tables, in parallel, each call in its own app
+    context and session. Returns the list of results, a single one without sharding.
+    """
+    resolver = shard_resolver()
+    if resolver is None:
+        return [fn()]
+    app = current_app._get_current_object()
+
+    def run(region_id):
+        with app.app_context(), use_shard(region_id):
+            return fn()
+    return list(resolver.executor.map(run, resolver.databases()))
+
+
+def for_each_database(fn):
+    """runs fn() on each database holding region tables, one after the other (CLI commands)"""
+    resolver = shard_resolver()
+    if resolver is None:
+        return [fn()]
+    results = []
+    for region_id in resolver.databases():
+        with use_shard(region_id):
+            results.append(fn())
+    return results
+
+
+def shard_metadata():
+    """the region tables, without the foreign keys to the tables of the primary"""
+    metadata = MetaData()
+    for name in REGION_TABLES:
+        db.metadata.tables[name].tometadata(metadata)
+    for model in ID_TABLES: # SQLite: ids start from sqlite_sequence, see _start_ids
+        metadata.tables[model.__tablename__].dialect_options['sqlite']['autoincrement'] = True
+    for table in metadata.tables.values():
+        for constraint in list(table.foreign_key_constraints):
+            if constraint.elements[0].target_fullname.split('.')[0] not in REGION_TABLES:
+                table.constraints.discard(constraint)
+                for foreign_key in constraint.elements:
+                    foreign_key.parent.foreign_keys.discard(foreign_key)
+                    table.foreign_keys.discard(foreign_key)
+    return metadata
+
+
+shards_cli = AppGroup('shards', help='Region shards, see sharding.py.')
+
+
+def _resolver_or_fail():
+    resolver = shard_resolver()
+    if resolver is None:
+        raise click.UsageError('no shards configured, set DB_SHARD_CONNECTION_STRINGS')
+    return resolver
+
+
+def _start_ids(engine, region_id, id_block):
+    """next ids of the shard of `region_id`: the first free one of its block"""
+    with engine.begin() as connection:
+        for model in ID_TABLES:
+            table = model.__table__
+            start = region_id * id_block
+            last = connection.execute(select([func.max(table.c.id)]).where(table.c.id >= start)).scalar()
+            start = max(start, (last or 0) + 1)
+            if engine.dialect.name == 'postgresql':
+                connection.execute("SELECT setval(pg_get_serial_sequence('%s', 'id'), %d, false)" % (table.name, start))
+            elif engine.dialect.name == 'mysql':
+                connection.execute('ALTER TABLE %s AUTO_INCREMENT = %d' % (table.name, start))
+            elif engine.dialect.name == 'sqlite':
+                connection.execute("DELETE FROM sqlite_sequence WHERE name = '%s'" % table.name)
+                connection.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('%s', %d)" % (table.name, start - 1))
+            else:
+                raise click.UsageError('%s: the ids of its shards can not be set' % engine.dialect.name)
+
+
+@shards_cli.command('create')
+def create_command():
+    """Create the region tables in every shard database, with the ids of each one in its own block."""
+    resolver = _resolver_or_fail()
+    for model in ID_TABLES:
+        if (db.session.query(func.max(model.id)).scalar() or 0) >= resolver.id_block:
+            raise click.UsageError('%s ids of the primary reach SHARD_ID_BLOCK' % model.__tablename__)
+    metadata = shard_metadata()
+    for region_id, engine in sorted(resolver.engines.items()):
+        if (region_id + 1) * resolver.id_block > 2 ** 31:
+            raise click.UsageError('region %s: its ids don\'t fit an INTEGER column, lower SHARD_ID_BLOCK' % region_id)
+        metadata.create_all(engine)
+        _start_ids(engine, region_id, resolver.id_block)
+        click.echo('region %s: tables created, ids from %s' % (region_id, region_id * resolver.id_block))
+
+
+@shards_cli.command('move')
+@click.argument('region_id', type=int)
+@click.option('--batch-size', type=int, default=500, help='requests moved per transaction')
+def move_command(region_id, batch_size):
+    """Move the rows of a region from the primary to its shard."""
+    resolver = _resolver_or_fail()
+    if region_id not in resolver.engines:
+        raise click.UsageError('region %s has no shard' % region_id)
+    primary, shard = db.engine, resolver.engines[region_id]
+    comunas = [comuna_id for comuna_id, in db.session.query(Comuna.id).filter(Comuna.region_id == region_id)]
+    for parent, children in REGION_GROUPS:
+        total = 0
+        while True:
+            moved = _move_batch(primary, shard, parent, children, comunas, batch_size)
+            if not moved:
+                break
+            total += moved
+        tables = [parent.__tablename__] + [child.__tablename__ for child, _ in children]
+        click.echo('%s: %s rows moved' % (', '.join(tables), total))
+    # the copied ids are below the block of the shard, its sequences are left where they are
+
+
+def _move_batch(primary, shard, parent, children, comunas, batch_size):
+    """
+    copies a batch of parent rows of the comunas, and their children, to the shard and then
+    deletes them from the primary. Rows copied by a failed run are replaced, a rerun is safe.
+    """
+    parent_t = parent.__table__
+    with primary.connect() as connection:
+        ids = [row[0] for row in connection.execute(
+            select([parent_t.c.id]).where(parent_t.c.comuna_id.in_(comunas)).order_by(parent_t.c.id).limit(batch_size)
+        )]
+        if not ids:
+            return 0
+        batches = [(parent_t, parent_t.c.id)] + [(child.__table__, child.__table__.c[column]) for child, column in children]
+        rows = [(table, key, connection.execute(select([table]).where(key.in_(ids))).fetchall()) for table, key in batches]
+
+    with shard.begin() as connection:
+        for table, key, table_rows in reversed(rows): # children first
+            connection.execute(table.delete().where(key.in_(ids)))
+        for table, key, table_rows in rows:
+            if table_rows:
+                connection.execute(table.insert(), [dict(row) for row in table_rows])
+    with primary.begin() as connection:
+        for table, key, _ in reversed(rows):
+            connection.execute(table.delete().where(key.in_(ids)))
+    return sum(len(table_rows) for _, _, table_rows in rows)
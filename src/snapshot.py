@@ -0,0 +1,391 @@
+"""
+Read-only snapshot of the reference data (regions, comunas, categories), so name and id lookups
+don't query the database: it changes a few times a year and is read by every write endpoint.
+
+The snapshot is a binary file built by `flask reference-snapshot` (and again by a background job
+after each admin change), mmap'd read-only by every worker: the pages are shared by all the
+processes of the machine and lookups read them in place, without building objects. A worker
+checks the file every REFERENCE_SNAPSHOT_CHECK_SECONDS and maps it again when it was replaced.
+Lookups missing in the snapshot (or without one) fall back to the database. A snapshot built
+from another database (host and name of SQLALCHEMY_DATABASE_URI) is ignored.
+
+Each change of the reference tables increments models.ReferenceVersion in its transaction, and the
+snapshot keeps the version it was built from. At each check the worker reads the version of the
+database: while they differ (a change not rebuilt yet, or made from another machine) the snapshot
+is not used, every lookup goes to the database. A worker checks again right after committing a
+change itself, the others within REFERENCE_SNAPSHOT_CHECK_SECONDS.
+
+layout, little-endian:
+    header      magic, version, built_at (epoch ms), database, reference version, strings offset
+                and size
+    3 tables    (region, comuna, category) count, records offset, name index and id index offsets,
+                index capacity
+    records     RECORD per row, sorted by id (comunas by region and id, so the comunas of a
+                region are contiguous: child_start/child_count of the region record)
+    indexes     open addressing tables of `capacity` (power of 2, >= 2 * count) uint32 slots
+                holding record number + 1 (0: empty), linear probing.
+                name index: crc32 of the utf-8 name, id index: multiplicative hash of the id
+    strings     utf-8 names (and category logos)
+
+    $ flask reference-snapshot [--output PATH]
+"""
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+import zlib
+from datetime import datetime
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import event, select
+from sqlalchemy.engine.url import make_url
+
+from jobs import job, enqueue_after_commit
+from models import db, Region, Comuna, Category, ReferenceVersion, REFERENCE_TABLES
+from routing import RoutingSession
+
+MAGIC = b'REFSNAP1'
+VERSION = 2
+HEADER = struct.Struct('<8sIQIQII')
+TABLE = struct.Struct('<IIIII') # count, records, name index, id index, capacity
+# id, parent id (comuna: region, -1 otherwise), name offset, name length, extra length (category
+# logo), extra offset, child start, child count (region: its comunas)
+RECORD = struct.Struct('<iiIHHIII')
+SLOT = struct.Struct('<I')
+NULL_LENGTH = 0xFFFF # extra length of a category without logo
+TABLES = ('region', 'comuna', 'category')
+
+
+def _id_hash(value):
+    return (value * 2654435761) & 0xFFFFFFFF
+
+
+def database_key(uri):
+    """identifies the database of a connection string, without its credentials"""
+    url = make_url(uri)
+    return zlib.crc32(('%s:%s/%s' % (url.host, url.port, url.database)).encode('utf-8'))
+
+
+def reference_version():
+    """version of the reference tables in the database, 0 before their first change"""
+    t = ReferenceVersion.__table__
+    return db.session.execute(
+        select([t.c.version]).where(t.c.id == 1), bind=db.engine # the primary: a replica can be behind
+    ).scalar() or 0
+
+
+def bump_reference_version(session):
+    """increments the version in the transaction of `session`, for each change of the reference tables"""
+    t = ReferenceVersion.__table__
+    if not session.execute(t.update().where(t.c.id == 1).values(version=t.c.version + 1), bind=db.engine).rowcount:
+        session.execute(t.insert().values(id=1, version=1), bind=db.engine)
+
+
+def _capacity(count):
+    capacity = 8
+    while capacity < count * 2:
+        capacity *= 2
+    return capacity
+
+
+def build_snapshot(path, database):
+    """writes the snapshot of the reference tables to `path` (atomically), returns the row counts"""
+    strings = bytearray()
+
+    def string(value):
+        data = (value or '').encode('utf-8')
+        offset = len(strings)
+        strings.extend(data)
+        return offset, len(data)
+
+    version = reference_version() # read first: a change committed meanwhile leaves the snapshot stale, never the opposite
+    regions = db.session.query(Region.id, Region.name).filter(Region.deleted_at.is_(None)).order_by(Region.id).all()
+    comunas = db.session.query(Comuna.id, Comuna.name, Comuna.region_id).filter(Comuna.deleted_at.is_(None)).all()
+    comunas.sort(key=lambda c: (c.region_id if c.region_id is not None else -1, c.id))
+    categories = db.session.query(Category.id, Category.name, Category.logo) \
+        .filter(Category.deleted_at.is_(None)).order_by(Category.id).all()
+
+    first_comuna = {}
+    for i, comuna in enumerate(comunas):
+        first_comuna.setdefault(comuna.region_id, [i, 0])[1] += 1
+
+    rows = {'region': [], 'comuna': [], 'category': []}
+    for region in regions:
+        start, count = first_comuna.get(region.id, (0, 0))
+        rows['region'].append((region.id, -1) + string(region.name) + (0, 0, start, count))
+    for comuna in comunas:
+        parent = comuna.region_id if comuna.region_id is not None else -1
+        rows['comuna'].append((comuna.id, parent) + string(comuna.name) + (0, 0, 0, 0))
+    for category in categories:
+        name_offset, name_length = string(category.name)
+        logo_offset, logo_length = string(category.logo) if category.logo is not None else (0, NULL_LENGTH)
+        rows['category'].append((category.id, -1, name_offset, name_length, logo_length, logo_offset, 0, 0))
+
+    body = bytearray()
+    directory = []
+    base = HEADER.size + TABLE.size * len(TABLES)
+    for table in TABLES:
+        records = rows[table]
+        capacity = _capacity(len(records))
+        names, ids = [0] * capacity, [0] * capacity
+        for number, record in enumerate(records):
+            name = bytes(strings[record[2]:record[2] + record[3]])
+            for slots, start in ((names, zlib.crc32(name)), (ids, _id_hash(record[0]))):
+                slot = start & (capacity - 1)
+                while slots[slot]:
+                    slot = (slot + 1) & (capacity - 1)
+                slots[slot] = number + 1
+        records_offset = base + len(body)
+        body.extend(b''.join(RECORD.pack(*record) for record in records))
+        names_offset = base + len(body)
+        body.extend(struct.pack('<%dI' % capacity, *names))
+        ids_offset = base + len(body)
+        body.extend(struct.pack('<%dI' % capacity, *ids))
+        directory.append(TABLE.pack(len(records), records_offset, names_offset, ids_offset, capacity))
+
+    strings_offset = base + len(body)
+    header = HEADER.pack(MAGIC, VERSION, int(time.time() * 1000), database, version, strings_offset, len(strings))
+    directory_path = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory_path, exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=directory_path, prefix='.reference-', delete=False) as f:
+        try:
+            f.write(header)
+            f.write(b''.join(directory))
+            f.write(body)
+            f.write(strings)
+        except Exception:
+            os.remove(f.name)
+            raise
+    os.replace(f.name, path) # workers mapping the old file keep reading it until they reopen
+    return {table: len(rows[table]) for table in TABLES}
+
+
+class ReferenceSnapshot:
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        self.buffer = memoryview(self._mmap)
+        magic, version, built_at, self.database, self.reference_version, self.strings_offset, _ = HEADER.unpack_from(self.buffer, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('%s is not a reference snapshot' % path)
+        self.built_at = datetime.fromtimestamp(built_at / 1000.0)
+        self.tables = {
+            table: TABLE.unpack_from(self.buffer, HEADER.size + i * TABLE.size) for i, table in enumerate(TABLES)
+        }
+
+    def _record(self, table, number):
+        return RECORD.unpack_from(self.buffer, self.tables[table][1] + number * RECORD.size)
+
+    def _string(self, offset, length):
+        start = self.strings_offset + offset
+        return str(self.buffer[start:start + length], 'utf-8')
+
+    def _probe(self, table, index, start, matches):
+        count, _, names_offset, ids_offset, capacity = self.tables[table]
+        offset = names_offset if index == 'name' else ids_offset
+        mask = capacity - 1
+        slot = start & mask
+        for _ in range(capacity):
+            number = SLOT.unpack_from(self.buffer, offset + slot * SLOT.size)[0]
+            if number == 0:
+                return None
+            record = self._record(table, number - 1)
+            if matches(record):
+                return record
+            slot = (slot + 1) & mask
+        return None
+
+    def by_name(self, table, name):
+        data = name.encode('utf-8')
+        strings = self.strings_offset
+
+        def matches(record):
+            return record[3] == len(data) and self.buffer[strings + record[2]:strings + record[2] + record[3]] == data
+        return self._probe(table, 'name', zlib.crc32(data), matches)
+
+    def by_id(self, table, record_id):
+        return self._probe(table, 'id', _id_hash(record_id), lambda record: record[0] == record_id)
+
+    def id_of(self, table, name):
+        record = self.by_name(table, name)
+        return record[0] if record is not None else None
+
+    def serialize(self, table, record):
+        """same dict as the model's serialize()"""
+        if table == 'region':
+            return {'id': record[0], 'name': self._string(record[2], record[3])}
+        if table == 'category':
+            return {'id': record[0], 'name': self._string(record[2], record[3]), 'logo': self._string(record[5], record[4]) if record[4] != NULL_LENGTH else None}
+        region = self.by_id('region', record[1]) if record[1] >= 0 else None
+        return {
+            'id': record[0],
+            'name': self._string(record[2], record[3]),
+            'region_id': record[1] if record[1] >= 0 else None,
+            'region_name': self._string(region[2], region[3]) if region is not None else None
+        }
+
+    def all(self, table):
+        return [self.serialize(table, self._record(table, number)) for number in range(self.tables[table][0])]
+
+    def comunas_of(self, region_record):
+        start, count = region_record[6], region_record[7]
+        return [self.serialize('comuna', self._record('comuna', number)) for number in range(start, start + count)]
+
+
+class SnapshotLoader:
+    """the current snapshot of the process, mapped again when the file is replaced, None while it's stale"""
+    def __init__(self, path, database, check_seconds):
+        self.path = path
+        self.database = database
+        self.check_seconds = check_seconds
+        self._mapped = None
+        self._snapshot = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def get(self):
+        if self.path is None:
+            return None
+        now = time.monotonic()
+        if now - self._checked_at < self.check_seconds:
+            return self._snapshot
+        with self._lock:
+            if now - self._checked_at >= self.check_seconds:
+                self._checked_at = now
+                self._mapped = self._reload(self._mapped)
+                fresh = self._mapped is not None and self._mapped.reference_version == reference_version()
+                self._snapshot = self._mapped if fresh else None
+        return self._snapshot
+
+    def _reload(self, current):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None # no snapshot yet, lookups use the database
+        if current is not None and current.key == (stat.st_ino, stat.st_mtime_ns, stat.st_size):
+            return current
+        try:
+            snapshot = ReferenceSnapshot(self.path) # the old mapping is released with its last reader
+        except (OSError, ValueError):
+            current_app.logger.exception('reference snapshot %s could not be loaded', self.path)
+            return current
+        if snapshot.database != self.database:
+            current_app.logger.warning('reference snapshot %s is from another database, ignored', self.path)
+            return None
+        return snapshot
+
+    def invalidate(self):
+        self._checked_at = 0.0
+
+
+def init_reference_snapshot(app):
+    app.extensions['reference_snapshot'] = SnapshotLoader(
+        app.config['REFERENCE_SNAPSHOT_PATH'],
+        database_key(app.config['SQLALCHEMY_DATABASE_URI']),
+        app.config['REFERENCE_SNAPSHOT_CHECK_SECONDS']
+    )
+
+
+def reference_snapshot():
+    return current_app.extensions['reference_snapshot'].get()
+
+
+def region_comunas(region_name):
+    """serialized comunas of a region, None when there's no region with that name"""
+    snapshot = reference_snapshot()
+    record = snapshot.by_name('region', region_name) if snapshot is not None else None
+    if record is not None:
+        return snapshot.comunas_of(record)
+    region = Region.active().filter(Region.name == region_name).first()
+    if region is None:
+        return None
+    return [comuna.serialize() for comuna in Comuna.active().filter(Comuna.region_id == region.id).order_by(Comuna.id)]
+
+
+def serialized_all(model):
+    """serialize() of every Region, Comuna or Category"""
+    snapshot = reference_snapshot()
+    if snapshot is not None:
+        return snapshot.all(model.__tablename__)
+    return [instance.serialize() for instance in model.active().order_by(model.id)]
+
+
+def region_id_by_name(name):
+    snapshot = reference_snapshot()
+    region_id = snapshot.id_of('region', name) if snapshot is not None else None
+    if region_id is None: # created after the snapshot
+        region_id = db.session.query(Region.id).filter(Region.name == name, Region.deleted_at.is_(None)).scalar()
+    return region_id
+
+
+def comuna_id_by_name(name):
+    snapshot = reference_snapshot()
+    comuna_id = snapshot.id_of('comuna', name) if snapshot is not None else None
+    if comuna_id is None:
+        comuna_id = db.session.query(Comuna.id).filter(Comuna.name == name, Comuna.deleted_at.is_(None)).scalar()
+    return comuna_id
+
+
+def exists(model, record_id):
+    """a row of `model` (Region, Comuna or Category) with that id exists and isn't deleted"""
+    snapshot = reference_snapshot()
+    if snapshot is not None and snapshot.by_id(model.__tablename__, record_id) is not None:
+        return True
+    return db.session.query(model.id).filter(model.id == record_id, model.deleted_at.is_(None)).scalar() is not None
+
+
+def _build(path):
+    return build_snapshot(path, database_key(current_app.config['SQLALCHEMY_DATABASE_URI']))
+
+
+@job('reference-snapshot')
+def rebuild_snapshot():
+    if current_app.config['REFERENCE_SNAPSHOT_PATH'] is not None:
+        _build(current_app.config['REFERENCE_SNAPSHOT_PATH'])
+        current_app.extensions['reference_snapshot'].invalidate()
+
+
+def _schedule_rebuild(session, flush_context, instances):
+    """a change of the reference tables rebuilds the snapshot once its transaction commits"""
+    if session.info.get('reference_snapshot_scheduled') or not any(
+        getattr(obj, '__tablename__', None) in REFERENCE_TABLES for obj in session.dirty | session.new | session.deleted
+    ):
+        return
+    session.info['reference_snapshot_scheduled'] = True
+    bump_reference_version(session)
+    enqueue_after_commit('reference-snapshot')
+
+
+def _on_commit(session):
+    if not session.transaction.nested and session.info.pop('reference_snapshot_scheduled', None):
+        loader = session.app.extensions.get('reference_snapshot')
+        if loader is not None:
+            loader.invalidate() # checks the version again on the next lookup of this worker
+
+
+def _on_rollback(session, previous_transaction):
+    if previous_transaction.parent is None:
+        session.info.pop('reference_snapshot_scheduled', None)
+
+
+event.listen(RoutingSession, 'before_flush', _schedule_rebuild)
+event.listen(RoutingSession, 'after_commit', _on_commit)
+event.listen(RoutingSession, 'after_soft_rollback', _on_rollback)
+
+
+@click.command('reference-snapshot')
+@click.option('--output', default=None, help='REFERENCE_SNAPSHOT_PATH by default')
+@with_appcontext
+def snapshot_command(output):
+    """Build the snapshot of regions, comunas and categories read by the workers."""
+    path = output or current_app.config['REFERENCE_SNAPSHOT_PATH']
+    if path is None:
+        raise click.UsageError('REFERENCE_SNAPSHOT_PATH is not set, use --output')
+    counts = _build(path)
+    click.echo('%s: %s' % (path, ', '.join('%s %s' % (counts[table], table) for table in TABLES)))
@@ -1,3 +1,5 @@
+from datetime import datetime
+
 from flask import jsonify, url_for
 
 class APIException(Exception):
@@ -15,6 +17,15 @@ class APIException(Exception):
         rv['message'] = self.message
         return rv
 
+def parse_date(value):
+    """'2020-01-13' or '2020-01-13T22:59:46', None when missing or invalid"""
+    for fmt in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%d'):
+        try:
+            return datetime.strptime(value, fmt)
+        except (TypeError, ValueError):
+            continue
+    return None
+
 def has_no_empty_params(rule):
     defaults = rule.defaults if rule.defaults is not None else ()
     arguments = rule.arguments if rule.arguments is not None else ()
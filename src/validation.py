@@ -0,0 +1,204 @@
+"""
+Schema-driven validation for JSON request bodies.
+Each endpoint declares its Schema once, at import time, and the `validate_json`
+decorator checks the payload before the view runs, so invalid requests never
+open a DB session.
+"""
+import re
+from functools import wraps
+from flask import request, jsonify
+
+# Regular expressions are compiled only once, when the module is imported.
+# EMAIL_RE accepts the same addresses as the old '^\w+([\.-]?\w+)*@...' pattern, but without
+# the optional separator inside a repeated group, which made invalid emails backtrack exponentially.
+EMAIL_RE = re.compile(r'^\w+(?:[.-]\w+)*@\w+(?:[.-]\w+)*\.\w{2,3}$')
+DIGITS_RE = re.compile(r'^\d+$')
+REQUEST_STATUS_RE = re.compile(r'^(active|paused|closed)$')
+
+MISSING_JSON = 'Missing JSON in request'
+
+
+class Field:
+    """
+    Validation spec of a single key of the JSON body.
+    `types` are the accepted python types (true and false only when bool is one of
+    them), `pattern` (a compiled regex) is only checked against str values, and
+    `invalid` holds placeholder values sent by the front-end that must be treated as
+    missing (ej: 'Comuna...'). If `choices` is given
+    the value must be one of them.
+    """
+    __slots__ = ('name', 'required', 'types', 'allow_empty', 'pattern', 'invalid', 'choices', 'each', 'error')
+
+    def __init__(self, name, required=True, types=(str,), allow_empty=False,
+                 pattern=None, invalid=(), choices=None, each=None, error=None):
+        self.name = name
+        self.required = required
+        self.types = tuple(types)
+        self.allow_empty = allow_empty
+        self.pattern = pattern
+        self.invalid = frozenset(invalid)
+        self.choices = frozenset(choices) if choices is not None else None
+        self.each = each
+        self.error = error or 'Missing %s parameter in request' % name
+
+    def check(self, body):
+        """returns None when the value is valid, otherwise the error message"""
+        value = body.get(self.name)
+        if value is None:
+            return self.error if self.required else None
+
+        if not isinstance(value, self.types):
+            return self.error
+        if isinstance(value, bool) and bool not in self.types: # bool is an int subclass: true isn't an id or a score
+            return self.error
+        if isinstance(value, str):
+            if not self.allow_empty and value == '':
+                return self.error
+            if self.pattern is not None and self.pattern.match(value) is None:
+                return self.error
+            if value in self.invalid:
+                return self.error
+        if self.choices is not None and value not in self.choices:
+            return self.error
+        if self.each is not None:
+            for item in value:
+                if self.each.validate(item) is not None:
+                    return self.error
+        return None
+
+
+class Schema:
+    """
+    Ordered group of fields, errors are reported in declaration order,
+    so the first failing field is the one returned to the client.
+    """
+    def __init__(self, *fields):
+        self.fields = tuple(fields)
+
+    def validate(self, body):
+        if not isinstance(body, dict):
+            return MISSING_JSON
+        for field in self.fields:
+            error = field.check(body)
+            if error is not None:
+                return error
+        return None
+
+
+def validate_json(schema, methods=None):
+    """
+    Decorator that validates request.json against `schema`.
+    If `methods` is given, only requests with those http methods are validated
+    (ej: a view handling PUT and DELETE where only PUT carries a body).
+    Invalid payloads get a uniform response: {'Error': <msg>}, 400
+    """
+    methods = frozenset(methods) if methods is not None else None
+
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            if methods is None or request.method in methods:
+                if not request.is_json:
+                    return jsonify({'Error': MISSING_JSON}), 400
+                error = schema.validate(request.get_json(silent=True))
+                if error is not None:
+                    return jsonify({'Error': error}), 400
+            return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# Endpoint schemas
+NAME_SCHEMA = Schema(
+    Field('name')
+)
+
+COMUNA_SCHEMA = Schema(
+    Field('name'),
+    Field('region')
+)
+
+CATEGORY_SCHEMA = Schema(
+    Field('name'),
+    Field('logo')
+)
+
+REGISTER_SCHEMA = Schema(
+    Field('email', pattern=EMAIL_RE, error='Formato del Email inválido'),
+    Field('password', error='No se encuentra Contraseña en request'),
+    Field('f_name', error='No se encuentra primer nombre en request'),
+    Field('l_name', error='No se encuentra apellido en request')
+)
+
+LOGIN_SCHEMA = Schema(
+    Field('email', error='No se envió email en request'),
+    Field('password', error='No se envió contraseña en request')
+)
+
+PROFILE_SCHEMA = Schema(
+    Field('fname', required=False),
+    Field('lname', required=False),
+    Field('rut', required=False, allow_empty=True),
+    Field('rut_serial', required=False, allow_empty=True),
+    Field('street', required=False, allow_empty=True),
+    Field('home_number', required=False, types=(str, int), allow_empty=True),
+    Field('more_info', required=False, allow_empty=True),
+    Field('profile_img', required=False, allow_empty=True),
+    Field('comuna', required=False, types=(int,), error='Comuna inválida')
+)
+
+PROVIDER_CATEGORIES_SCHEMA = Schema(
+    Field('categories', types=(list,), each=Schema(Field('id', types=(int,))),
+        error='Missing categories list in request')
+)
+
+OFFER_SCHEMA = Schema(
+    Field('description', required=False, allow_empty=True)
+)
+
+SERVICE_REQUEST_SCHEMA = Schema(
+    Field('name', error='Ingresa un nombre a tu solicitud'),
+    Field('description', error='ingresa una descripción a tu solicitud'),
+    Field('street', error='Dirección incompleta...'),
+    Field('home_number', types=(str, int), allow_empty=True, error='Dirección incompleta...'),
+    Field('more_info', required=False, allow_empty=True),
+    Field('comuna', invalid=('Comuna...',), error='Selecciona tu comuna'),
+    Field('category', types=(int, str), pattern=DIGITS_RE, error='Selecciona una categoría para tu solicitud')
+)
+
+SERVICE_REQUEST_UPDATE_SCHEMA = Schema(
+    Field('name', required=False, error='Ingresa un nombre a tu solicitud'),
+    Field('description', required=False, error='ingresa una descripción a tu solicitud'),
+    Field('street', required=False, error='Dirección incompleta...'),
+    Field('home_number', required=False, types=(str, int), allow_empty=True, error='Dirección incompleta...'),
+    Field('more_info', required=False, allow_empty=True),
+    Field('comuna', required=False, invalid=('Comuna...',), error='Selecciona tu comuna'),
+    Field('category', required=False, types=(int, str), pattern=DIGITS_RE, error='Selecciona una categoría para tu solicitud')
+)
+
+SERVICE_REQUEST_STATUS_SCHEMA = Schema(
+    Field('status', pattern=REQUEST_STATUS_RE, error='status must be one of: active, paused, closed')
+)
+
+REVIEW_SCHEMA = Schema(
+    Field('contract', types=(int,), error='Missing contract id in body'),
+    Field('score', types=(int,), choices=range(1, 6), error='score must be an integer from 1 to 5'),
+    Field('body', required=False, allow_empty=True)
+)
+
+CONTRACT_SCHEMA = Schema(
+    Field('provider', types=(int,), error='Missing provider id in body'),
+    Field('service', types=(int,), error='Missing service id in body')
+)
+
+BATCH_ITEM_SCHEMA = Schema(
+    Field('method', choices=('GET', 'HEAD', 'POST', 'PUT', 'DELETE')),
+    Field('path', pattern=re.compile(r'^/')),
+    Field('body', required=False, types=(dict, list)),
+    Field('headers', required=False, types=(dict,))
+)
+
+BATCH_SCHEMA = Schema(
+    Field('requests', types=(list,), each=BATCH_ITEM_SCHEMA,
+          error='requests must be a list of {"method", "path", "body", "headers"}')
+)
@@ -0,0 +1,53 @@
+"""
+Optimistic concurrency control of the rows edited through the api: users, service requests,
+offers, contracts and categories (models.VersionedMixin).
+
+Their version_id column is SQLAlchemy's version_id_col: each ORM UPDATE of the row adds
+`WHERE version_id = <version read>` and increments it. When a concurrent request changed the row
+first the UPDATE matches nothing and StaleDataError is raised, answered with 412. No row is
+locked while the request runs.
+
+The version is the ETag of the responses of a row, and PUT/DELETE endpoints take it back in
+If-Match: a change made over an outdated copy gets 412 instead of overwriting what it didn't see.
+Without If-Match the check of the UPDATE still applies.
+
+Bulk UPDATEs (Query.update, Core) bypass version_id_col, they must increment version_id
+themselves: {Offer.status: 'rejected', Offer.version_id: Offer.version_id + 1}
+"""
+from flask import current_app, request
+
+from models import db
+
+
+class PreconditionFailed(Exception):
+    """If-Match of an outdated version, answered with 412 and {'Error': message} (main.py)"""
+
+
+def version_tag(instance):
+    return '%s-%s' % (instance.id, instance.version_id)
+
+
+def check_if_match(instance):
+    """raises PreconditionFailed when the If-Match header doesn't match the version of `instance`"""
+    if request.if_match and not request.if_match.contains(version_tag(instance)):
+        raise PreconditionFailed('%s %s was modified, reload it' % (instance.__tablename__, instance.id))
+
+
+def with_etag(response, instance):
+    """the view response with the version of `instance` as ETag"""
+    response = current_app.make_response(response)
+    response.set_etag(version_tag(instance))
+    return response
+
+
+def bump_version(instance, *criteria):
+    """
+    increments the version of `instance` with a guarded UPDATE, for changes that don't update the
+    row itself (ej: a contract of a request). `criteria` are more conditions of the UPDATE, the state
+    the change requires. False when it was modified since it was read or doesn't meet them.
+    """
+    model = type(instance)
+    updated = db.session.query(model).filter(model.id == instance.id, model.version_id == instance.version_id, *criteria) \
+        .update({model.version_id: model.version_id + 1}, synchronize_session=False)
+    db.session.expire(instance, ['version_id'])
+    return updated == 1